@@ -0,0 +1,737 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the hot paths of the shavar service.
+
+Run with one of the subcommands, e.g.
+
+    python scripts/benchmark.py find_prefix --hashes 200000
+
+Every benchmark works on synthetic data generated on the fly so no list data
+or network access is needed.
+"""
+import argparse
+import hashlib
+import http.server
+import io
+import json
+import os
+import posixpath
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+from types import SimpleNamespace
+import urllib.parse
+
+from boto.s3.connection import OrdinaryCallingFormat, S3Connection
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from shavar.lists import ServingState  # noqa: E402
+from shavar.parse import (  # noqa: E402
+    parse_dir_source,
+    parse_downloads,
+    parse_file_source,
+    parse_gethash)
+from shavar.s3 import S3Client, set_s3_client  # noqa: E402
+from shavar.snapshot import compile_snapshot, parse_snapshot  # noqa: E402
+from shavar.sources import (  # noqa: E402
+    DirectorySource,
+    S3DirectorySource,
+    S3FileSource,
+    SourceData)
+from shavar.types import (  # noqa: E402
+    Chunk,
+    ChunkList,
+    Downloads,
+    LimitExceededError)
+
+
+def make_hashes(count, seed=b''):
+    return [hashlib.sha256(seed + b'%d' % i).digest() for i in range(count)]
+
+
+def make_chunk_list(total_hashes, chunk_size, hash_size=32, seed=b''):
+    chunks = ChunkList()
+    hashes = make_hashes(total_hashes, seed=seed)
+    for number, start in enumerate(range(0, total_hashes, chunk_size), 1):
+        chunks.insert_chunk(Chunk(
+            number=number,
+            hashes=[h[:hash_size] for h in hashes[start:start + chunk_size]]))
+    return chunks, hashes
+
+
+def report(name, seconds, ops):
+    print("%-28s %10.2f us/op" % (name, seconds / ops * 1e6))
+
+
+def linear_find_prefix(chunks, prefix):
+    "The per-chunk scan ChunkList.find_prefix used before the prefix index"
+    return [chunk for chunk in chunks.adds.values()
+            if any(h.startswith(prefix) for h in chunk.hashes)]
+
+
+def bench_find_prefix(args):
+    chunks, hashes = make_chunk_list(args.hashes, args.chunk_size)
+    probes = [h[:4] for h in hashes[::max(1, len(hashes) // args.probes)]]
+    probes += [h[:4] for h in make_hashes(len(probes), seed=b'miss')]
+
+    start = timeit.default_timer()
+    _, used = measure(chunks.index_prefixes)
+    print("index build: %.3fs for %d hashes in %d chunks, %.1f MB (%.1f MB"
+          " of hashes)" % (timeit.default_timer() - start, args.hashes,
+                           len(chunks), used / 1e6, args.hashes * 32 / 1e6))
+
+    seconds = timeit.timeit(
+        lambda: [chunks.find_prefix(p) for p in probes], number=1)
+    report("indexed find_prefix", seconds, len(probes))
+    # Whole digest256 hashes are checked past the key in their chunks
+    full_probes = [h for h in hashes[::max(1, len(hashes) // args.probes)]]
+    seconds = timeit.timeit(
+        lambda: [chunks.find_prefix(p) for p in full_probes], number=1)
+    report("indexed find_prefix, 32 bytes", seconds, len(full_probes))
+    # The scan is slow enough that only a sample of the probes is used
+    scan_probes = probes[::max(1, len(probes) // args.scan_probes)]
+    for prefix in scan_probes:
+        assert chunks.find_prefix(prefix) == linear_find_prefix(chunks,
+                                                                prefix)
+    seconds = timeit.timeit(
+        lambda: [linear_find_prefix(chunks, p) for p in scan_probes],
+        number=1)
+    report("linear find_prefix", seconds, len(scan_probes))
+
+
+class LegacyChunk(object):
+    "The set based Chunk representation used before the packed buffer"
+
+    def __init__(self, number, hashes):
+        self.type = 'a'
+        self.number = number
+        self.hashes = set(hashes)
+        self.hash_len = 32
+        self._prefix_cache = {}
+
+
+def measure(build):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    return result, used
+
+
+def bench_memory(args):
+    hashes = make_hashes(args.hashes)
+    raw = len(hashes) * 32
+    print("%d hashes, %d per chunk, %.1f MB of raw hash data"
+          % (len(hashes), args.chunk_size, raw / 1e6))
+
+    def build(cls):
+        # Copy each hash so the generated list isn't shared with the chunks
+        return [cls(number=n, hashes=[bytes(bytearray(h)) for h in
+                                      hashes[start:start + args.chunk_size]])
+                for n, start in enumerate(range(0, len(hashes),
+                                                args.chunk_size), 1)]
+
+    def build_indexed():
+        # As served, the sources build the PrefixIndex of every list
+        chunks = ChunkList(add_chunks=build(Chunk))
+        chunks.index_prefixes()
+        return chunks
+
+    for name, func in (('set of bytes (before)', lambda: build(LegacyChunk)),
+                       ('packed buffer (after)', lambda: build(Chunk)),
+                       ('+ PrefixIndex (served)', build_indexed)):
+        chunks, used = measure(func)
+        print("%-24s %8.1f MB  %6.1f bytes/hash"
+              % (name, used / 1e6, used / len(hashes)))
+        del chunks
+
+
+def write_chunk_file(fp, size, chunk_size, sort):
+    number = 0
+    written = 0
+    while written < size:
+        number += 1
+        hashes = [os.urandom(32) for _ in range(chunk_size)]
+        if sort:
+            hashes.sort()
+        data = b''.join(hashes)
+        fp.write(b"a:%d:32:%d\n" % (number, len(data)))
+        fp.write(data)
+        written += len(data)
+    return number
+
+
+def run_in_child(argv):
+    "Runs argv and returns its output and peak RSS in MB"
+    proc = subprocess.Popen(argv, stdout=subprocess.PIPE)
+    output = proc.stdout.read().decode().strip()
+    proc.stdout.close()
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = status
+    # ru_maxrss is in kilobytes on Linux
+    return output, rusage.ru_maxrss / 1024.0
+
+
+def bench_parse(args):
+    if args.child == 'compile':
+        compile_snapshot(args.child_file, args.child_file + '.snapshot')
+        return
+    if args.child:
+        start = timeit.default_timer()
+        with open(args.child_file, 'rb') as f:
+            if args.child == 'snapshot':
+                chunks = parse_snapshot(f)
+            else:
+                chunks = parse_file_source(f, use_mmap=args.child == 'mmap')
+        # Sources build the prefix index as part of every load
+        if not chunks.indexed:
+            chunks.index_prefixes()
+        elapsed = timeit.default_timer() - start
+        # Mapped file pages are shared and reclaimable, heap pages aren't
+        with open('/proc/self/status') as status:
+            rss = dict(line.split(':', 1) for line in status
+                       if line.startswith(('RssAnon', 'RssFile')))
+        print("%.3f %d %s %s" % (elapsed, len(chunks),
+                                 rss['RssAnon'].split()[0],
+                                 rss['RssFile'].split()[0]))
+        return
+
+    with tempfile.NamedTemporaryFile(suffix='.chunks') as fp:
+        count = write_chunk_file(fp, args.megabytes * 1000000,
+                                 args.chunk_size, args.sorted)
+        fp.flush()
+        print("%d MB chunk file, %d chunks of %d %s hashes"
+              % (args.megabytes, count, args.chunk_size,
+                 'sorted' if args.sorted else 'unsorted'))
+        # Compiled in a child too so this process stays small, its peak
+        # RSS is inherited by the children it forks
+        snapshot = fp.name + '.snapshot'
+        run_in_child([sys.executable, __file__, 'parse', '--child', 'compile',
+                      '--child-file', fp.name])
+        for mode, path in (('stream', fp.name), ('mmap', fp.name),
+                           ('snapshot', snapshot)):
+            output, rss = run_in_child([sys.executable, __file__, 'parse',
+                                        '--child', mode,
+                                        '--child-file', path])
+            elapsed, _, anon, mapped = output.split()
+            print("%-8s load %7.3fs  peak RSS %7.1f MB  after load: "
+                  "%7.1f MB heap %7.1f MB file backed"
+                  % (mode, float(elapsed), rss, int(anon) / 1024.0,
+                     int(mapped) / 1024.0))
+        os.unlink(snapshot)
+
+
+def write_dir_source(path, chunks, chunk_size, first=1):
+    "Writes chunks add chunk files and an index.json for them into path"
+    index_path = os.path.join(path, 'index.json')
+    index = {'name': 'bench-track-digest256', 'chunks': {}}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+    for number in range(first, first + chunks):
+        data = b''.join(os.urandom(32) for _ in range(chunk_size))
+        with open(os.path.join(path, str(number)), 'wb') as f:
+            f.write(b"a:%d:32:%d\n" % (number, len(data)))
+            f.write(data)
+        index['chunks'][str(number)] = {'path': str(number)}
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+
+
+def bench_reload(args):
+    path = tempfile.mkdtemp()
+    try:
+        write_dir_source(path, args.chunks, args.chunk_size)
+        source = DirectorySource('dir://' + path, 60)
+        start = timeit.default_timer()
+        source.load()
+        print("%-28s %10.3f s" % ("initial load", timeit.default_timer()
+                                  - start))
+        for number in range(args.chunks + 1, args.chunks + 4):
+            write_dir_source(path, 1, args.chunk_size, first=number)
+            start = timeit.default_timer()
+            source.load()
+            print("%-28s %10.3f s" % ("reload, chunk %d added" % number,
+                                      timeit.default_timer() - start))
+        source.loaded_chunk_files.clear()
+        start = timeit.default_timer()
+        source.load()
+        print("%-28s %10.3f s" % ("full reload", timeit.default_timer()
+                                  - start))
+    finally:
+        shutil.rmtree(path)
+
+
+class FakeS3Handler(http.server.BaseHTTPRequestHandler):
+    """
+    Just enough of the S3 REST API, path style, for the S3 sources: HEAD
+    and GET of buckets and keys and single page listings, every request
+    delayed by latency seconds
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes, don't let Nagle and
+    # delayed ACKs add 40ms to every keep-alive request
+    disable_nagle_algorithm = True
+    objects = {}
+    latency = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, status, body=b'', headers={}, length=None):
+        time.sleep(self.latency)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length',
+                         str(len(body) if length is None else length))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _object(self):
+        url = urllib.parse.urlsplit(self.path)
+        bucket, _, key = url.path.lstrip('/').partition('/')
+        return (bucket, urllib.parse.unquote(key),
+                urllib.parse.parse_qs(url.query))
+
+    def do_HEAD(self):
+        bucket, key, _ = self._object()
+        if not key:
+            return self._respond(200)
+        if key not in self.objects:
+            return self._respond(404)
+        data = self.objects[key]
+        self._respond(200, headers={
+            'ETag': '"%s"' % hashlib.md5(data).hexdigest()},
+            length=len(data))
+
+    def do_GET(self):
+        bucket, key, query = self._object()
+        if key:
+            if key not in self.objects:
+                return self._respond(404)
+            data = self.objects[key]
+            return self._respond(200, data, {
+                'ETag': '"%s"' % hashlib.md5(data).hexdigest()})
+        prefix = query.get('prefix', [''])[0]
+        contents = ''.join(
+            '<Contents><Key>%s</Key><ETag>"%s"</ETag><Size>%d</Size>'
+            '<LastModified>2020-01-01T00:00:00.000Z</LastModified>'
+            '</Contents>' % (name, hashlib.md5(data).hexdigest(), len(data))
+            for name, data in sorted(self.objects.items())
+            if name.startswith(prefix))
+        self._respond(200, (
+            '<?xml version="1.0" encoding="UTF-8"?><ListBucketResult>'
+            '<Name>%s</Name><Prefix>%s</Prefix><IsTruncated>false'
+            '</IsTruncated>%s</ListBucketResult>'
+            % (bucket, prefix, contents)).encode())
+
+
+def legacy_s3_dir_load(connection_kwargs, bucket_name, list_name):
+    "S3DirectorySource.load as it was before the shared S3 client"
+    conn = S3Connection(**connection_kwargs)
+    bucket = conn.get_bucket(bucket_name)
+
+    def s3exists(path):
+        return bucket.get_key(posixpath.join(list_name, path))
+
+    def s3open(path, mode):
+        key = s3exists(path)
+        fp = tempfile.TemporaryFile()
+        key.get_contents_to_file(fp)
+        fp.seek(0)
+        return fp
+
+    # _get_key() connected and looked the bucket up once more
+    s3key = S3Connection(**connection_kwargs).get_bucket(bucket_name) \
+        .get_key(posixpath.join(list_name, 'index.json'))
+    with tempfile.TemporaryFile() as fp:
+        s3key.get_contents_to_file(fp)
+        fp.seek(0)
+        return parse_dir_source(fp, exists_cb=s3exists, open_cb=s3open)
+
+
+def bench_s3_load(args):
+    FakeS3Handler.latency = args.latency / 1000.0
+    for number in range(1, args.chunks + 1):
+        data = b''.join(make_hashes(args.chunk_size, seed=b'%d' % number))
+        FakeS3Handler.objects['bench/%d' % number] = (
+            b'a:%d:32:%d\n' % (number, len(data)) + data)
+    FakeS3Handler.objects['bench/index.json'] = json.dumps({
+        'name': 'bench-track-digest256',
+        'chunks': {str(n): {'path': str(n)}
+                   for n in range(1, args.chunks + 1)}}).encode()
+
+    server, connection_kwargs = start_fake_s3()
+    print("%d chunk files, %.1f ms per request"
+          % (args.chunks, args.latency))
+
+    start = timeit.default_timer()
+    legacy_s3_dir_load(connection_kwargs, 'bench', 'bench')
+    print("%-28s %10.3f s" % ("legacy", timeit.default_timer() - start))
+
+    for workers in args.workers:
+        s3 = set_s3_client(S3Client(metrics_prefix=None, **connection_kwargs))
+        source = S3DirectorySource('s3+dir://bench/bench', 60,
+                                   settings={'load_workers': workers})
+        start = timeit.default_timer()
+        source.load()
+        print("%-28s %10.3f s  %s"
+              % ("%d workers" % workers, timeit.default_timer() - start,
+                 dict(s3.round_trips)))
+    server.shutdown()
+
+
+def start_fake_s3():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeS3Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, dict(
+        aws_access_key_id='bench', aws_secret_access_key='bench',
+        host='127.0.0.1', port=server.server_address[1], is_secure=False,
+        calling_format=OrdinaryCallingFormat())
+
+
+class TempFileS3FileSource(S3FileSource):
+    "S3FileSource loading through a temporary file as it did before"
+
+    def load(self):
+        opened, etag = self._take_opened()
+        with opened, tempfile.TemporaryFile() as fp:
+            shutil.copyfileobj(opened, fp)
+            fp.seek(0)
+            self._populate_chunks(fp, parse_file_source)
+            self.current_etag = etag
+        self.no_data = False
+
+
+def bench_s3_stream(args):
+    FakeS3Handler.latency = 0.0
+    fp = io.BytesIO()
+    count = write_chunk_file(fp, args.hashes * 32, args.chunk_size, sort=True)
+    FakeS3Handler.objects['bench/chunks'] = fp.getvalue()
+    server, connection_kwargs = start_fake_s3()
+    print("%d hashes in %d chunks, %.1f MB"
+          % (args.hashes, count, len(fp.getvalue()) / 1e6))
+    del fp
+
+    set_s3_client(S3Client(metrics_prefix=None, **connection_kwargs))
+    for name, cls in (('temp file', TempFileS3FileSource),
+                      ('streamed', S3FileSource)):
+        def load():
+            source = cls('s3+file://bench/bench/chunks', 60)
+            source.load()
+            return source
+
+        best = min(timeit.repeat(load, number=1, repeat=args.repeat))
+        # Traced separately, tracing slows everything down
+        tracemalloc.start()
+        load()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("%-28s %10.3f s  peak %.1f MB traced"
+              % (name, best, peak / 1e6))
+    server.shutdown()
+
+
+# Shaped after what Firefox sends: one line per list, the chunk numbers being
+# publishing timestamps
+DOWNLOADS_BODIES = {
+    'firefox': "\n".join(
+        "%s;a:1593531419" % name for name in (
+            'ads-track-digest256', 'analytics-track-digest256',
+            'base-fingerprinting-track-digest256', 'content-track-digest256',
+            'mozstd-trackwhite-digest256', 'social-track-digest256',
+            'base-cryptomining-track-digest256', 'google-trackwhite-digest256',
+        )) + "\n",
+    'ranges': "moz-abp-shavar;a:1-2000,2002-4000,4005-9000:s:1-100,200-300\n"
+              "mozpub-track-digest256;a:1-3,5,7-9:mac\n",
+    'pathological': "mozpub-track-digest256;a:%s\n" % ','.join(
+        str(n) for n in range(1, 20000, 2)),
+}
+
+
+class LegacyDownloadsListInfo(object):
+    "DownloadsListInfo as it was before claims were kept as ranges"
+
+    def __init__(self, list_name, wants_mac=False, limit=10 * 1000):
+        self.name = list_name
+        self.wants_mac = wants_mac
+        self.limit = limit
+        self.adds = set()
+        self.subs = set()
+
+    def add_claim(self, typ, chunk_num):
+        claims = self.subs if typ == 's' else self.adds
+        claims.add(chunk_num)
+        if len(claims) > self.limit:
+            raise LimitExceededError("Number of chunks(%d) exceeds limit"
+                                     % len(claims))
+
+    def add_range_claim(self, typ, low, high):
+        for i in range(low, high + 1):
+            self.add_claim(typ, i)
+
+
+def legacy_parse_downloads(request):
+    "The line by line parser used before, error handling trimmed"
+    parsed = Downloads()
+    limit = request.registry.settings.get("shavar.max_downloads_chunks",
+                                          10000)
+    for lineno, line in enumerate(request.body_file):
+        line = line.strip()
+        if not line or line.isspace():
+            continue
+        line = line.decode()
+        lname, chunklist = line.split(";", 1)
+        info = LegacyDownloadsListInfo(lname, limit=limit)
+        chunks = chunklist.split(":")
+        if len(chunks) >= 1 and chunks[-1] == "mac":
+            if request.GET.get('pver') == '3.0':
+                raise ValueError('MAC not supported in protocol version 3')
+            info.wants_mac = True
+            chunks.pop(-1)
+        if not chunks or (len(chunks) == 1 and not chunks[0]):
+            parsed.append(info)
+            continue
+        while chunks:
+            ctype = chunks.pop(0)
+            list_of_chunks = chunks.pop(0)
+            for chunk in list_of_chunks.split(','):
+                try:
+                    chunk = int(chunk)
+                except ValueError:
+                    low, high = chunk.split('-', 1)
+                    info.add_range_claim(ctype, int(low), int(high))
+                else:
+                    info.add_claim(ctype, chunk)
+        parsed.append(info)
+    return parsed
+
+
+def bench_downloads(args):
+    for name, body in sorted(DOWNLOADS_BODIES.items()):
+        body = body.encode()
+        request = SimpleNamespace(
+            body=body, GET={'pver': '2.0'},
+            registry=SimpleNamespace(settings={}))
+        for label, func in (('single pass', parse_downloads),
+                            ('legacy', legacy_parse_downloads)):
+
+            def run():
+                # body_file is a fresh stream per request
+                request.body_file = io.BytesIO(body)
+                func(request)
+            seconds = timeit.timeit(run, number=args.number)
+            report("%s %s" % (name, label), seconds, args.number)
+
+
+def legacy_parse_gethash(request):
+    "The stream reading parser used before, error handling trimmed"
+    eoh = request.body.find(b'\n')
+    header = request.body_file.readline().decode()
+    prefix_len, payload_len = [int(x) for x in header.split(':', 1)]
+    prefixes = set()
+    for i in range(payload_len // prefix_len):
+        prefixes.add(request.body_file.read(prefix_len))
+    assert eoh != -1
+    return prefixes
+
+
+def bench_gethash(args):
+    count = 1
+    while count <= args.max_prefixes:
+        prefixes = [h[:4] for h in make_hashes(count)]
+        body = b'4:%d\n' % (count * 4) + b''.join(prefixes)
+        request = SimpleNamespace(body=body)
+        number = max(1, args.number // count)
+        for label, func in (('memoryview', parse_gethash),
+                            ('legacy', legacy_parse_gethash)):
+
+            def run():
+                request.body_file = io.BytesIO(body)
+                func(request)
+            seconds = timeit.timeit(run, number=number)
+            report("%d prefixes %s" % (count, label), seconds, number)
+        count *= 4
+
+
+class BenchList(object):
+    "Just enough of a SafeBrowsingList to be searched by gethash"
+
+    def __init__(self, chunks, prefix_size):
+        self._source = SimpleNamespace(data=SourceData(chunks))
+        self.prefix_size = prefix_size
+        chunks.index_prefixes()
+
+    def find_prefix(self, prefix):
+        if len(prefix) != self.prefix_size:
+            return ()
+        return self._source.data.chunks.find_prefix(prefix)
+
+
+def legacy_lookup_prefixes(serving, prefixes):
+    "The list by list search lookup_prefixes() did before the GethashIndex"
+    found = {}
+    for list_name, sblist in serving.items():
+        for prefix in prefixes:
+            for chunk in sblist.find_prefix(prefix):
+                found.setdefault(list_name, {}).setdefault(
+                    chunk.number, []).extend(chunk.get_hashes(prefix))
+    return found
+
+
+def bench_gethash_lists(args):
+    # Versioned copies of a handful of lists, as served in production
+    serving = {}
+    versioned = {}
+    hashes = []
+    for i in range(args.lists):
+        chunks, list_hashes = make_chunk_list(args.hashes, args.chunk_size,
+                                              seed=b'%d-' % i)
+        hashes.extend(list_hashes)
+        name = 'list%d-track-digest256' % i
+        serving[name] = BenchList(chunks, 32)
+        versioned[name] = []
+        for v in range(args.versions):
+            version = '%d.0' % (69 + v)
+            serving['%s-%s' % (version, name)] = BenchList(chunks, 32)
+            versioned[name].append(version)
+    print("%d lists of %d hashes, %d versions each"
+          % (args.lists, args.hashes, args.versions))
+    probes = hashes[::max(1, len(hashes) // args.probes)]
+    probes += make_hashes(len(probes), seed=b'miss')
+
+    for label, gethash_versioned_lists in (('index', True),
+                                           ('index, unversioned', False)):
+        start = timeit.default_timer()
+        state = ServingState(serving, versioned, list(versioned),
+                             gethash_versioned_lists=gethash_versioned_lists)
+        print("%s build: %.3fs"
+              % (label, timeit.default_timer() - start))
+        seconds = timeit.timeit(
+            lambda: state.gethash_index.lookup(probes), number=1)
+        report(label, seconds, len(probes))
+    assert (state.gethash_index.lookup(probes[:10])
+            == legacy_lookup_prefixes(
+                {name: serving[name] for name in versioned}, probes[:10]))
+    seconds = timeit.timeit(
+        lambda: legacy_lookup_prefixes(serving, probes), number=1)
+    report("list by list", seconds, len(probes))
+
+    # Traced separately, tracing slows the build down
+    state, used = measure(lambda: ServingState(serving, versioned,
+                                               list(versioned)))
+    print("index memory: %.1f MB for %.1f MB of hashes"
+          % (used / 1e6, len(hashes) * 32 / 1e6))
+
+    # One small list changing only has that list indexed again
+    index = state.gethash_index
+    small, _ = make_chunk_list(10, 10)
+    serving['list0-track-digest256']._source.data = SourceData(small)
+    with index._lock:
+        # Keeps the lookups from updating the index themselves
+        seconds = timeit.timeit(lambda: index.lookup(probes), number=1)
+    report("index, one list changed", seconds, len(probes))
+    start = timeit.default_timer()
+    index.update()
+    print("update after one list changed: %.3fs"
+          % (timeit.default_timer() - start))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    p = subparsers.add_parser('find_prefix',
+                              help='indexed vs linear prefix lookups')
+    p.add_argument('--hashes', type=int, default=200000)
+    p.add_argument('--chunk-size', type=int, default=1000)
+    p.add_argument('--probes', type=int, default=2000)
+    p.add_argument('--scan-probes', type=int, default=20)
+    p.set_defaults(func=bench_find_prefix)
+
+    p = subparsers.add_parser('memory',
+                              help='bytes per hash of the list storage')
+    p.add_argument('--hashes', type=int, default=2000000)
+    p.add_argument('--chunk-size', type=int, default=10000)
+    p.set_defaults(func=bench_memory)
+
+    p = subparsers.add_parser('parse',
+                              help='load time and peak RSS of the stream '
+                                   'and mmap chunk file parsers and of '
+                                   'snapshots')
+    p.add_argument('--megabytes', type=int, default=128)
+    p.add_argument('--chunk-size', type=int, default=10000)
+    p.add_argument('--sorted', action='store_true',
+                   help='write the hashes of each chunk in sorted order')
+    p.add_argument('--child', choices=('stream', 'mmap', 'snapshot',
+                                       'compile'),
+                   help=argparse.SUPPRESS)
+    p.add_argument('--child-file', help=argparse.SUPPRESS)
+    p.set_defaults(func=bench_parse)
+
+    p = subparsers.add_parser('reload',
+                              help='incremental vs full directory reloads')
+    p.add_argument('--chunks', type=int, default=200)
+    p.add_argument('--chunk-size', type=int, default=5000)
+    p.set_defaults(func=bench_reload)
+
+    p = subparsers.add_parser('s3_load',
+                              help='s3+dir:// loads against a local stand-in '
+                                   'S3 server with injected latency')
+    p.add_argument('--chunks', type=int, default=1000)
+    p.add_argument('--chunk-size', type=int, default=100)
+    p.add_argument('--latency', type=float, default=5.0,
+                   help='milliseconds added to every request')
+    p.add_argument('--workers', type=int, nargs='+', default=[1, 8, 32])
+    p.set_defaults(func=bench_s3_load)
+
+    p = subparsers.add_parser('s3_stream',
+                              help='s3+file:// loads parsed off the response '
+                                   'vs through a temporary file')
+    p.add_argument('--hashes', type=int, default=1000000)
+    p.add_argument('--chunk-size', type=int, default=10000)
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(func=bench_s3_stream)
+
+    p = subparsers.add_parser('downloads',
+                              help='/downloads request body parsing')
+    p.add_argument('--number', type=int, default=200)
+    p.set_defaults(func=bench_downloads)
+
+    p = subparsers.add_parser('gethash',
+                              help='/gethash request body parsing latency')
+    p.add_argument('--max-prefixes', type=int, default=4096)
+    p.add_argument('--number', type=int, default=200000,
+                   help='prefixes parsed per measurement')
+    p.set_defaults(func=bench_gethash)
+
+    p = subparsers.add_parser('gethash_lists',
+                              help='prefix lookups across every list served, '
+                                   'GethashIndex vs list by list')
+    p.add_argument('--lists', type=int, default=4)
+    p.add_argument('--versions', type=int, default=20)
+    p.add_argument('--hashes', type=int, default=20000)
+    p.add_argument('--chunk-size', type=int, default=1000)
+    p.add_argument('--probes', type=int, default=2000)
+    p.set_defaults(func=bench_gethash_lists)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -30,5 +30,7 @@ setup(name='shavar',
       entry_points="""\
       [paste.app_factory]
       main = shavar:main
+      [console_scripts]
+      shavar-snapshot = shavar.snapshot:main
       """,
       )
@@ -1,15 +1,21 @@
 import logging
+import os
 import threading
 import time
 
+from pyramid.events import NewRequest
+from pyramid.settings import asbool
 import sentry_sdk
 from sentry_sdk.integrations.pyramid import PyramidIntegration
 
 import shavar.lists
+from shavar.metrics import report_background_metrics
+from shavar.s3 import configure_s3_cache
 
 
 __version__ = '0.12.8.5'
 DEFAULT_REFRESH_LISTS_DELAY = 600  # 10m
+DEFAULT_REFRESH_DATA_PERIOD = 10
 logger = logging.getLogger('shavar')
 
 
@@ -30,6 +36,97 @@ def refresh_lists_config(delay, config):
         logger.info("Refreshing lists config ...")
         shavar.lists.includeme(config)
         logger.info("Refreshing lists config done.")
+        report_background_metrics()
+
+
+class RefreshListsDataThread(threading.Thread):
+    """
+    Keeps the data of the lists served fresh so that requests never wait on
+    refresh checks or reloads.  Every period seconds each list whose
+    refresh_check_interval has expired is checked and, if its source
+    changed, reloaded.
+    """
+
+    def __init__(self, period, config):
+        threading.Thread.__init__(self)
+        self.period = period
+        self.config = config
+        self.stopped = threading.Event()
+
+    def run(self):
+        logger.info("Starting RefreshListsDataThread")
+        while not self.stopped.wait(self.period):
+            refresh_lists_data(self.config)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def refresh_lists_data(config):
+    # The lists config refresh may swap in a new set of lists at any time
+    state = config.registry['shavar.serving_state']
+    for list_name, sblist in state.serving.items():
+        try:
+            sblist.refresh()
+        except Exception:
+            # Carry on serving the data loaded last
+            logger.exception('Refreshing list "%s" failed' % list_name)
+    # Index the new data here rather than have a request notice it
+    try:
+        state.gethash_index.update()
+    except Exception:
+        logger.exception('Updating the gethash index failed')
+    report_background_metrics()
+
+
+def start_refresh_threads(config):
+    "Starts the threads refreshing the lists config and data, returns them"
+    refreshListsConfigThread = RefreshListsConfigThread(
+        config.registry.settings.get(
+            'shavar.refresh_lists_delay', DEFAULT_REFRESH_LISTS_DELAY
+        ),
+        config
+    )
+    refreshListsConfigThread.daemon = True
+    refreshListsConfigThread.start()
+    threads = [refreshListsConfigThread]
+    if asbool(config.registry.settings.get('shavar.background_refresh')):
+        refreshListsDataThread = RefreshListsDataThread(
+            float(config.registry.settings.get(
+                'shavar.background_refresh_period',
+                DEFAULT_REFRESH_DATA_PERIOD
+            )),
+            config
+        )
+        refreshListsDataThread.daemon = True
+        refreshListsDataThread.start()
+        threads.append(refreshListsDataThread)
+    return threads
+
+
+class RefreshThreadsStarter(object):
+    """
+    NewRequest subscriber starting the refresh threads in every process on
+    its first request.  Threads don't survive a fork and uWSGI, unless
+    lazy-apps is set, forks its workers off the process that loaded the app
+    so starting them along with the app would leave all the workers but
+    one without them.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.pid = None
+        self.threads = []
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        if self.pid == os.getpid():
+            return
+        with self._lock:
+            if self.pid == os.getpid():
+                return
+            self.threads = start_refresh_threads(self.config)
+            self.pid = os.getpid()
 
 
 def includeme(config):
@@ -37,6 +134,8 @@ def includeme(config):
     # Dependencies first
     config.include("mozsvc")
     config.include('pyramid_mako')
+    # The lists' S3 sources load through the disk cache, if there's one
+    configure_s3_cache(config.registry.settings)
     # Have to get the lists loaded before the views
     shavar.lists.includeme(config)
     config.include("shavar.views")
@@ -73,13 +172,9 @@ def main(global_config, **settings):
 
     config = get_configurator(global_config, **settings)
     configure_sentry(config)
-    app = config.make_wsgi_app()
-    refreshListsConfigThread = RefreshListsConfigThread(
-        config.registry.settings.get(
-            'shavar.refresh_lists_delay', DEFAULT_REFRESH_LISTS_DELAY
-        ),
-        config
-    )
-    refreshListsConfigThread.daemon = True
-    refreshListsConfigThread.start()
-    return app
+    # Before uWSGI forks the workers off this process, or every one of them
+    # would report the startup load again
+    report_background_metrics()
+    # The refresh threads are started in each worker process
+    config.add_subscriber(RefreshThreadsStarter(config), NewRequest)
+    return config.make_wsgi_app()
@@ -0,0 +1,130 @@
+"""
+Discovery of the version branches of shavar-prod-lists
+
+Versioned lists are served for every version branch of the lists repository
+on GitHub.  The branch set changes a few times a year so it's fetched at most
+once per TTL, revalidated with a conditional request and kept on disk so that
+a slow or unreachable GitHub API never holds up loading the lists: the last
+known branch set is used instead.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import requests
+
+
+logger = logging.getLogger('shavar')
+
+GITHUB_API_URL = 'https://api.github.com'
+SHAVAR_PROD_LISTS_BRANCHES_PATH = (
+    '/repos/mozilla-services/shavar-prod-lists/branches?per_page=100'
+)
+DEFAULT_BRANCHES_TTL = 600
+DEFAULT_BRANCHES_TIMEOUT = 5.0
+
+
+class BranchDiscovery(object):
+    """
+    Fetches and caches the branch list at url, in memory and in the JSON
+    file cache_path if given.  Requests time out after timeout seconds.
+    """
+
+    def __init__(self, url=GITHUB_API_URL + SHAVAR_PROD_LISTS_BRANCHES_PATH,
+                 cache_path=None, ttl=DEFAULT_BRANCHES_TTL,
+                 timeout=DEFAULT_BRANCHES_TIMEOUT):
+        self.url = url
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.branches = None
+        self.etag = None
+        self.fetched_at = 0
+        self._lock = threading.Lock()
+        self._read_cache()
+
+    def _read_cache(self):
+        if not self.cache_path:
+            return
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning('Ignoring branches cache %s: %s'
+                           % (self.cache_path, e))
+            return
+        if cached.get('url') != self.url:
+            return
+        self.branches = cached.get('branches')
+        self.etag = cached.get('etag')
+        self.fetched_at = cached.get('fetched_at', 0)
+
+    def _write_cache(self):
+        if not self.cache_path:
+            return
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self.cache_path) or '.', prefix='.')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'url': self.url, 'etag': self.etag,
+                           'fetched_at': self.fetched_at,
+                           'branches': self.branches}, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            logger.warning('Could not write branches cache %s: %s'
+                           % (self.cache_path, e))
+
+    def _fetch(self):
+        headers = {}
+        if self.etag and self.branches is not None:
+            headers['If-None-Match'] = self.etag
+        resp = self.session.get(self.url, headers=headers,
+                                timeout=self.timeout)
+        if resp.status_code == 304:
+            return
+        resp.raise_for_status()
+        branches = resp.json()
+        if not isinstance(branches, list):
+            raise ValueError('Expected a list of branches, got %r'
+                             % (branches,))
+        self.branches = branches
+        self.etag = resp.headers.get('ETag')
+
+    def get_branches(self):
+        """
+        Returns the branches, as decoded from the GitHub API response.  Falls
+        back on the last known ones, if any, when they can't be fetched.
+        """
+        with self._lock:
+            if (self.branches is not None
+                    and time.time() - self.fetched_at < self.ttl):
+                return self.branches
+            try:
+                self._fetch()
+            except (requests.RequestException, ValueError) as e:
+                logger.warning('Could not fetch the branches from %s, using '
+                               'the last known ones: %s' % (self.url, e))
+                return self.branches or []
+            self.fetched_at = time.time()
+            self._write_cache()
+            return self.branches
+
+
+def get_branch_discovery(registry):
+    "Returns the BranchDiscovery of the app, set up from its settings"
+    discovery = registry.get('shavar.branch_discovery')
+    if discovery is None:
+        settings = registry.settings
+        discovery = registry['shavar.branch_discovery'] = BranchDiscovery(
+            cache_path=settings.get('shavar.branches_cache_path'),
+            ttl=float(settings.get('shavar.branches_ttl',
+                                   DEFAULT_BRANCHES_TTL)),
+            timeout=float(settings.get('shavar.branches_timeout',
+                                       DEFAULT_BRANCHES_TIMEOUT)))
+    return discovery
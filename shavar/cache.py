@@ -0,0 +1,66 @@
+from collections import OrderedDict
+import threading
+
+from shavar.metrics import incr
+
+
+class LRUCache(object):
+    """
+    Thread safe mapping with a hard limit on the number of entries that
+    evicts the least recently used entry once the limit is reached.
+
+    Hits, misses and evictions are counted on the instance and, when a
+    metrics prefix is given, reported as the "<prefix>.hit", "<prefix>.miss"
+    and "<prefix>.eviction" metrics.
+    """
+
+    def __init__(self, maxsize, metrics_prefix=None):
+        self.maxsize = int(maxsize)
+        self.metrics_prefix = metrics_prefix
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def _annotate(self, event):
+        if self.metrics_prefix:
+            incr('%s.%s' % (self.metrics_prefix, event))
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                hit = False
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+                hit = True
+        self._annotate('hit' if hit else 'miss')
+        return value if hit else default
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        evicted = 0
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                evicted += 1
+            self.evictions += evicted
+        for _ in range(evicted):
+            self._annotate('eviction')
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -1,17 +1,30 @@
+from array import array
+from concurrent.futures import Future, ThreadPoolExecutor
 import configparser
+import heapq
 import io
 import logging
-import requests
+import threading
+import time
+from types import MappingProxyType
 from packaging import version
+from pyramid.settings import asbool
 from urllib.parse import urlparse
 
+from boto.exception import S3ResponseError
+
+from shavar.branches import get_branch_discovery
+from shavar.cache import LRUCache
 from shavar.exceptions import MissingListDataError, NoDataError
+from shavar.s3 import get_s3_client
 from shavar.sources import (
     DirectorySource,
     FileSource,
     S3DirectorySource,
-    S3FileSource
+    S3FileSource,
+    SnapshotSource
 )
+from shavar.types import bisect_records, ChunkRanges, PrefixIndex
 
 
 logger = logging.getLogger('shavar')
@@ -21,10 +34,8 @@ EMAIL_TRACKER_LISTS = [
     'base-email-track-digest256',
     'content-email-track-digest256'
 ]
-GITHUB_API_URL = 'https://api.github.com'
-SHAVAR_PROD_LISTS_BRANCHES_PATH = (
-    '/repos/mozilla-services/shavar-prod-lists/branches?per_page=100'
-)
+DEFAULT_LIST_LOAD_WORKERS = 4
+DEFAULT_PREFIX_CACHE_SIZE = 10000
 
 
 def create_list(type_, list_name, settings):
@@ -38,6 +49,326 @@ def create_list(type_, list_name, settings):
     return list_
 
 
+def _chunk_records(ref, chunk, width):
+    stride = chunk._stride
+    data = chunk._data
+    for pos in range(chunk._offset, chunk._offset + chunk._size, stride):
+        yield data[pos:pos + width], ref
+
+
+def _hash_count(data):
+    return sum(len(chunk) for chunk in data.chunks.adds.values())
+
+
+def _changes(indexed, current):
+    """
+    Compares the lists of current to the ones indexed, both {name:
+    (SourceData, prefix size)}, and returns the add chunks to index, by
+    list, the (name, number) of the indexed chunks gone or replaced and the
+    names of the lists gone.  Chunks are the same if they're the same
+    object, which reloads keep for the chunks they didn't change.
+    """
+    added = {}
+    removed = set()
+    dropped = {name for name in indexed if name not in current}
+    for name, (data, prefix_size) in current.items():
+        data_before, prefix_size_before = indexed.get(name, (None, None))
+        if data_before is data:
+            continue
+        adds = data.chunks.adds
+        before = {}
+        if prefix_size_before == prefix_size:
+            before = data_before.chunks.adds
+            removed.update((name, number)
+                           for number, chunk in before.items()
+                           if adds.get(number) is not chunk)
+        elif data_before is not None:
+            dropped.add(name)
+        chunks = [chunk for number, chunk in adds.items()
+                  if before.get(number) is not chunk]
+        if chunks:
+            added[name] = chunks
+    return added, removed, dropped
+
+
+class _GethashLayer(object):
+    """
+    One generation of a GethashIndex.  Like a PrefixIndex it keeps no copy
+    of the hashes, only references to their chunks: by prefix size, one
+    buffer of the sorted unique keys, the first PrefixIndex.KEY_SIZE bytes
+    of the hashes, and, in arrays, the offsets of their entries and, for
+    each entry, a chunk with a hash starting with the key as its position
+    in refs, the (name, number) of every chunk indexed.  Prefixes longer
+    than the key are confirmed in the chunk.
+
+    indexed is {name: (SourceData, prefix size)} of every list of the
+    generation and added the chunks it indexes, by list.  The chunks added
+    since the generation before are stacked on top of it, hiding the
+    chunks in removed and the lists in dropped, so that only those are
+    indexed and the tables of the chunks kept are shared.
+    """
+
+    # Most layers updated() stacks up before building the index anew
+    max_depth = 8
+
+    def __init__(self, indexed, added, base=None, removed=frozenset(),
+                 dropped=frozenset()):
+        self.indexed = indexed
+        self.names = tuple(added)
+        self.refs = tuple((name, chunk.number)
+                          for name, chunks in added.items()
+                          for chunk in chunks)
+        self.base = base
+        self.removed = frozenset(removed)
+        self.dropped = frozenset(dropped)
+        self.depth = 0
+        self.stacked = 0
+        if base is not None:
+            self.depth = base.depth + 1
+            self.stacked = base.stacked + sum(
+                len(chunk) for chunks in added.values() for chunk in chunks)
+        self.size = sum(_hash_count(source_data)
+                        for source_data, _ in indexed.values())
+
+        groups = {}
+        ref = 0
+        for name, chunks in added.items():
+            prefix_size = indexed[name][1]
+            width = min(prefix_size, PrefixIndex.KEY_SIZE)
+            records = groups.setdefault(prefix_size, [])
+            for chunk in chunks:
+                # Lookups of longer prefixes can't match shorter hashes
+                if chunk._stride >= prefix_size:
+                    records.append(_chunk_records(ref, chunk, width))
+                ref += 1
+        self.tables = {prefix_size: self._pack(records)
+                       for prefix_size, records in groups.items()}
+
+    @staticmethod
+    def _pack(records):
+        keys = bytearray()
+        starts = array('I')
+        refs = array('I')
+        previous = None
+        for record in heapq.merge(*records):
+            if record == previous:
+                continue
+            key, ref = record
+            if previous is None or key != previous[0]:
+                keys += key
+                starts.append(len(refs))
+            refs.append(ref)
+            previous = record
+        starts.append(len(refs))
+        return bytes(keys), starts, refs
+
+    def updated(self, current):
+        """
+        Returns the generation indexing current, {name: (SourceData, prefix
+        size)} of every list, stacked on top of this one unless too many
+        layers are stacked up already
+        """
+        indexed = self.indexed
+        if len(current) == len(indexed) and all(
+                indexed.get(name, (None,))[0] is source_data
+                for name, (source_data, _) in current.items()):
+            return self
+        added, removed, dropped = _changes(indexed, current)
+        stacked = self.stacked + sum(
+            len(chunk) for chunks in added.values() for chunk in chunks)
+        size = sum(_hash_count(source_data)
+                   for source_data, _ in current.values())
+        if self.depth >= self.max_depth or stacked * 4 > size:
+            return _GethashLayer(current, _changes({}, current)[0])
+        return _GethashLayer(current, added, self, removed, dropped)
+
+    def lookup(self, prefix):
+        """
+        Yields the name and chunk number of every chunk indexed with a hash
+        starting with the first PrefixIndex.KEY_SIZE bytes of prefix, the
+        chunks of the generation before first
+        """
+        if self.base is not None:
+            removed = self.removed
+            dropped = self.dropped
+            for found in self.base.lookup(prefix):
+                if found[0] not in dropped and found not in removed:
+                    yield found
+        table = self.tables.get(len(prefix))
+        if table is None:
+            return
+        keys, starts, refs = table
+        width = min(len(prefix), PrefixIndex.KEY_SIZE)
+        key = prefix[:width]
+        count = len(starts) - 1
+        i = bisect_records(keys, count, width, key)
+        if i == count or keys[i * width:(i + 1) * width] != key:
+            return
+        for j in range(starts[i], starts[i + 1]):
+            yield self.refs[refs[j]]
+
+
+class GethashIndex(object):
+    """
+    Index of the hash prefixes of the add chunks of every list searched by
+    gethash requests so that looking a prefix up is one binary search
+    instead of one search per list.  See _GethashLayer.
+
+    Lists reload their data on their own so update() indexes the chunks
+    the lists changed since the last update into a new generation of the
+    index, swapped in as a whole.  It runs off the request path: when the
+    index is created, e.g. on config loads starting off previous, the index
+    of the lists served before, after the background refresh of the lists
+    and otherwise in a thread of its own started by the first lookup that
+    notices a change.  Until then the lists that changed are searched one
+    by one.
+
+    What a prefix was found in, if anything, is remembered in a cache of
+    cache_size prefixes emptied whenever a new generation is swapped in.
+    """
+
+    def __init__(self, lists, previous=None,
+                 cache_size=DEFAULT_PREFIX_CACHE_SIZE):
+        # The (name, SafeBrowsingList) pairs searched, in serving order
+        self.lists = tuple(lists)
+        self.positions = {name: i for i, (name, _) in enumerate(self.lists)}
+        self._lock = threading.Lock()
+        self.cache = LRUCache(cache_size,
+                              metrics_prefix='shavar.gethash.prefix_cache')
+        self.generation = None
+        if previous is not None:
+            self.generation = previous.generation
+        self.update()
+
+    def _update(self):
+        current = {name: (sblist._source.data, sblist.prefix_size)
+                   for name, sblist in self.lists}
+        generation = self.generation
+        if generation is None:
+            self.generation = _GethashLayer(current,
+                                            _changes({}, current)[0])
+        else:
+            self.generation = generation.updated(current)
+        if self.generation is not generation:
+            self.cache.clear()
+
+    def update(self):
+        "Indexes the lists whose data changed since the last update"
+        with self._lock:
+            self._update()
+
+    def _update_in_background(self):
+        if not self._lock.acquire(blocking=False):
+            # Already on it
+            return
+
+        def run():
+            try:
+                self._update()
+            except Exception:
+                logger.exception('Updating the gethash index failed')
+            finally:
+                self._lock.release()
+        threading.Thread(target=run, daemon=True).start()
+
+    def _find(self, generation, prefix):
+        """
+        The (name, number, hashes) of every chunk generation has hashes
+        starting with prefix in, remembered in the cache.  Entries remember
+        the generation they were found in so a lookup racing with an update
+        can never serve them from another one.
+        """
+        cached = self.cache.get(prefix)
+        if cached is not None and cached[0] is generation:
+            return cached[1]
+        indexed = generation.indexed
+        matches = []
+        for name, number in generation.lookup(prefix):
+            chunk = indexed[name][0].chunks.adds[number]
+            hashes = chunk.get_hashes(prefix)
+            # Empty if only the key matched
+            if hashes:
+                matches.append((name, number, tuple(hashes)))
+        matches = tuple(matches)
+        self.cache.put(prefix, (generation, matches))
+        return matches
+
+    def lookup(self, prefixes):
+        "See lookup_prefixes()"
+        generation = self.generation
+        indexed = generation.indexed
+        # The lists whose data changed since they were indexed
+        stale = [(name, sblist) for name, sblist in self.lists
+                 if indexed.get(name, (None,))[0] is not sblist._source.data]
+        if stale:
+            self._update_in_background()
+        skipped = {name for name, _ in stale}
+        found = {}
+        for prefix in prefixes:
+            for name, number, hashes in self._find(generation, prefix):
+                if name in skipped or name not in self.positions:
+                    continue
+                found.setdefault(name, {}).setdefault(number, []).extend(
+                    hashes)
+            for name, sblist in stale:
+                for chunk in sblist.find_prefix(prefix):
+                    found.setdefault(name, {}).setdefault(
+                        chunk.number, []).extend(chunk.get_hashes(prefix))
+        # Listed in serving order, like searching the lists one by one would
+        return {name: found[name]
+                for name in sorted(found, key=self.positions.get)}
+
+
+class ServingState(object):
+    """
+    The lists served as of one config load.  It's swapped in as a whole and
+    never changed, so a request fetching it once sees the lists of a single
+    config load however they're refreshed meanwhile.
+
+    serving maps the names of the lists served, versioned ones included, to
+    their SafeBrowsingList, versioned_lists the names of the versioned lists
+    to the versions they're served for and list_names are the names of the
+    lists configured, in config order.  Unless gethash_versioned_lists is
+    false, gethash searches the versioned lists too.  previous is the state
+    this one replaces, if any, and prefix_cache_size the size of the cache
+    of gethash lookups, see GethashIndex.
+    """
+
+    __slots__ = ('serving', 'versioned_lists', 'list_names',
+                 'list_names_set', 'sorted_names', 'gethash_index')
+
+    def __init__(self, serving, versioned_lists, list_names,
+                 gethash_versioned_lists=True, previous=None,
+                 prefix_cache_size=DEFAULT_PREFIX_CACHE_SIZE):
+        self.serving = MappingProxyType(dict(serving))
+        self.versioned_lists = MappingProxyType(
+            {name: tuple(versions)
+             for name, versions in versioned_lists.items()})
+        self.list_names = tuple(list_names)
+        # Lookup tables for the views
+        self.list_names_set = frozenset(self.list_names)
+        self.sorted_names = tuple(sorted(self.serving))
+        versioned = set()
+        if not gethash_versioned_lists:
+            versioned = {get_versioned_list_name(ver, name)
+                         for name, versions in self.versioned_lists.items()
+                         for ver in versions}
+        self.gethash_index = GethashIndex(
+            [(name, sblist) for name, sblist in self.serving.items()
+             if name not in versioned],
+            previous.gethash_index if previous is not None else None,
+            cache_size=prefix_cache_size)
+
+
+def get_serving_state(request):
+    "The ServingState of request, the same one however often it's called"
+    state = getattr(request, 'shavar_serving_state', None)
+    if state is None:
+        state = request.registry['shavar.serving_state']
+        request.shavar_serving_state = state
+    return state
+
+
 def get_versioned_list_name(version, list_name):
     return '{0}-{1}'.format(version, list_name)
 
@@ -48,10 +379,128 @@ def get_original_and_versioned_paths(source):
     return 'tracking/', 'tracking/{}/'
 
 
-def add_versioned_lists_to_registry(
-        settings, serving, ver_lists, type_, list_name,
-        shavar_prod_lists_branches
+def get_versioned_source(source, branch_name):
+    original_path, versioned_path = get_original_and_versioned_paths(source)
+    return source.replace(original_path, versioned_path.format(branch_name))
+
+
+class S3VersionListings(object):
+    """
+    Tells which versions of the lists kept in S3 exist from one listing per
+    bucket and versions prefix, e.g. tracking/, shared by every list, rather
+    than by attempting to load every list for every version branch
+    """
+
+    S3_SOURCES = {'s3+file': S3FileSource, 's3+dir': S3DirectorySource}
+
+    def __init__(self):
+        # Key names by bucket and prefix, None for the failed listings
+        self.listings = {}
+
+    def _listing(self, bucket_name, prefix):
+        if (bucket_name, prefix) not in self.listings:
+            try:
+                listing = {key.name.lstrip('/') for key in
+                           get_s3_client().list(bucket_name, prefix=prefix)}
+            except S3ResponseError as e:
+                logger.warning('Could not list the versions in "%s/%s": %s'
+                               % (bucket_name, prefix, e))
+                listing = None
+            self.listings[(bucket_name, prefix)] = listing
+        return self.listings[(bucket_name, prefix)]
+
+    def available(self, source, branch_names):
+        """
+        Returns the branch names for which the versioned source exists, None
+        if it can't be told without loading them
+        """
+        cls = self.S3_SOURCES.get(urlparse(source).scheme.lower())
+        if cls is None:
+            return None
+        if not branch_names:
+            return []
+        # Everything that comes before the version in the key names
+        bucket_name, key_name = cls.s3_location(
+            get_versioned_source(source, '\0'))
+        key_name = key_name.lstrip('/')
+        if '\0' not in key_name:
+            return None
+        listing = self._listing(bucket_name, key_name[:key_name.index('\0')])
+        if listing is None:
+            return None
+        return [branch_name for branch_name in branch_names
+                if key_name.replace('\0', branch_name) in listing]
+
+
+def load_list(type_, list_name, settings):
+    "create_list() that logs how long loading the list took"
+    start = time.time()
+    list_ = create_list(type_, list_name, settings)
+    logger.info('Loaded list "%s" from %s in %.2fs'
+                % (list_name, settings['source'], time.time() - start))
+    return list_
+
+
+def get_versioned_settings(settings, branch_name):
+    # change config to reflect version branches
+    settings = dict(settings)
+    settings['source'] = get_versioned_source(settings['source'], branch_name)
+    return settings
+
+
+def reuse_list(previous, name, type_, settings):
+    """
+    Returns the list served as name in previous if it was created from the
+    same type and settings, None if it has to be created anew
+    """
+    list_ = previous.get(name)
+    if (list_ is not None and list_.type == type_
+            and list_.settings == settings):
+        return list_
+    return None
+
+
+def completed(result):
+    "A Future already done with result, for the lists that aren't loaded"
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def load_versioned_list(type_, list_name, settings, branch_name):
+    """
+    Creates the list list_name for the version branch_name, None if there's
+    no data for that version
+    """
+    settings = get_versioned_settings(settings, branch_name)
+    list_ = load_list(type_, list_name, settings)
+    if list_._source.no_data:
+        log_missing_version(branch_name, list_name)
+        return None
+    return list_
+
+
+def log_missing_version(branch_name, list_name):
+    info_msg = (
+        'Skipping {0} version support for {1} '
+        'since the file does not exist in S3'
+    )
+    logger.info(info_msg.format(branch_name, list_name))
+
+
+def submit_versioned_lists(
+        executor, settings, type_, list_name, shavar_prod_lists_branches,
+        listings=None, previous={}
 ):
+    """
+    Submits the loading of the list list_name for every version branch to
+    executor.  Returns the branch names and futures, in branch order.
+
+    The versions of lists kept in S3 found missing from listings, an
+    S3VersionListings, aren't loaded at all.  Those served unchanged in
+    previous, the lists served by name, are reused instead of loaded again.
+    """
+    branch_names = []
     for branch in shavar_prod_lists_branches:
         try:
             branch_name = branch.get('name')
@@ -67,35 +516,51 @@ def add_versioned_lists_to_registry(
             continue
         ver = version.parse(branch_name)
         if isinstance(ver, version.Version):
-            original_path, versioned_path = get_original_and_versioned_paths(
-                settings['source']
-            )
-            # change config to reflect version branches
-            versioned_source = settings['source'].replace(
-                original_path, versioned_path.format(branch_name))
-            settings['source'] = versioned_source
-            # get new list for the version
-            list_ = create_list(type_, list_name, settings)
-            try:
-                list_._source.load()
-            except NoDataError:
-                info_msg = (
-                    'Skipping {0} version support for {1} '
-                    'since the file does not exist in S3'
-                )
-                logger.info(info_msg.format(ver, list_name))
-                original_source = settings['source'].replace(
-                    versioned_path.format(branch_name), original_path)
-                settings['source'] = original_source
-                continue
-            versioned_list_name = get_versioned_list_name(
-                branch_name, list_name)
-            serving[versioned_list_name] = list_
-            ver_lists[list_name].append(branch_name)
-            # revert settings
-            original_source = settings['source'].replace(
-                versioned_path.format(branch_name), original_path)
-            settings['source'] = original_source
+            branch_names.append(branch_name)
+
+    available = None
+    if listings is not None:
+        available = listings.available(settings['source'], branch_names)
+    submitted = []
+    for branch_name in branch_names:
+        if available is not None and branch_name not in available:
+            log_missing_version(branch_name, list_name)
+            continue
+        list_ = reuse_list(
+            previous, get_versioned_list_name(branch_name, list_name), type_,
+            get_versioned_settings(settings, branch_name))
+        if list_ is not None:
+            future = completed(list_)
+        else:
+            future = executor.submit(load_versioned_list, type_, list_name,
+                                     settings, branch_name)
+        submitted.append((branch_name, future))
+    return submitted
+
+
+def register_versioned_lists(serving, ver_lists, list_name, submitted):
+    "Adds the versioned lists submit_versioned_lists() loaded to the registry"
+    for branch_name, future in submitted:
+        list_ = future.result()
+        if list_ is None:
+            continue
+        versioned_list_name = get_versioned_list_name(branch_name, list_name)
+        serving[versioned_list_name] = list_
+        ver_lists[list_name].append(branch_name)
+
+
+def add_versioned_lists_to_registry(
+        settings, serving, ver_lists, type_, list_name,
+        shavar_prod_lists_branches, workers=1, listings=None
+):
+    if listings is None:
+        listings = S3VersionListings()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        submitted = submit_versioned_lists(
+            executor, settings, type_, list_name, shavar_prod_lists_branches,
+            listings
+        )
+        register_versioned_lists(serving, ver_lists, list_name, submitted)
 
 
 def includeme(config):
@@ -131,19 +596,18 @@ def includeme(config):
                     logger.error(e)
 
     elif lists_to_serve_scheme == 's3+dir':
-        import boto
-        from boto.exception import S3ResponseError
-
+        s3 = get_s3_client()
         try:
-            conn = boto.connect_s3()
-            bucket = conn.get_bucket(lists_to_serve_url.netloc)
+            s3.get_bucket(lists_to_serve_url.netloc)
         except S3ResponseError as e:
             raise NoDataError("Could not find bucket \"%s\": %s" %
                               (lists_to_serve_url.netloc, e))
-        for list_key in bucket.get_all_keys():
+        for list_key in s3.list(lists_to_serve_url.netloc):
             list_key_name = list_key.key
             list_name = list_key_name.rstrip('.ini')
-            list_ini = list_key.get_contents_as_string(encoding='UTF-8')
+            list_ini = io.BytesIO()
+            s3.fetch(list_key, list_ini)
+            list_ini = list_ini.getvalue().decode('UTF-8')
             try:
                 list_config = configparser.ConfigParser()
                 list_config.readfp(io.StringIO(list_ini))
@@ -154,8 +618,10 @@ def includeme(config):
     else:
         raise ValueError('lists_served must be dir:// or s3+dir:// value')
 
-    resp = requests.get(GITHUB_API_URL + SHAVAR_PROD_LISTS_BRANCHES_PATH)
-    shavar_prod_lists_branches = resp.json()
+    shavar_prod_lists_branches = get_branch_discovery(
+        config.registry).get_branches()
+
+    to_load = []
     for list_config in list_configs:
         list_name = list_config['name']
         list_config = list_config['config']
@@ -169,6 +635,12 @@ def includeme(config):
                                                10 * 60)
         if setting_name not in settings:
             settings[setting_name] = default
+        # Lists are refreshed in the background if the app is set up to
+        settings.setdefault('background_refresh', config.registry.settings.get(
+            'shavar.background_refresh', False))
+        # And share their data between processes if it's set up to
+        settings.setdefault('shared_dir', config.registry.settings.get(
+            'shavar.shared_dir'))
 
         # defaults = config.get_map('shavar')
         # settings = {'type': 'shavar',
@@ -176,25 +648,60 @@ def includeme(config):
         #                                                ''), lname)}
 
         type_ = list_config.get(list_name, 'type')
-        list_ = create_list(type_, list_name, settings)
-        serving[list_name] = list_
-        ver_lists[list_name] = []
-
         versioned = (
             list_config.has_option(list_name, 'versioned')
             and list_config.get(list_name, 'versioned')
         )
-        if versioned:
-            add_versioned_lists_to_registry(
-                settings, serving, ver_lists, type_,
-                list_name, shavar_prod_lists_branches
-            )
-
-    config.registry['shavar.serving'] = serving
-    config.registry['shavar.versioned_lists'] = ver_lists
-    config.registry.settings['shavar.list_names_served'] = [
-        list['name'] for list in list_configs
-    ]
+        to_load.append((list_name, type_, settings, versioned))
+
+    # Every list and version of a list loads in parallel, the registry is
+    # filled in in the same order as loading them one after the other would
+    workers = int(config.registry.settings.get('shavar.list_load_workers',
+                                               DEFAULT_LIST_LOAD_WORKERS))
+    start = time.time()
+    # Only the versions found in S3 are loaded
+    listings = S3VersionListings()
+    # On config refreshes, the lists whose config didn't change are served
+    # on with the data they have loaded, only the others are (re)created
+    previous = {}
+    previous_state = config.registry.get('shavar.serving_state')
+    if previous_state is not None:
+        previous = previous_state.serving
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        submitted = []
+        for list_name, type_, settings, versioned in to_load:
+            list_ = reuse_list(previous, list_name, type_, settings)
+            if list_ is not None:
+                future = completed(list_)
+            else:
+                future = executor.submit(load_list, type_, list_name,
+                                         settings)
+            versions = []
+            if versioned:
+                versions = submit_versioned_lists(
+                    executor, settings, type_, list_name,
+                    shavar_prod_lists_branches, listings, previous
+                )
+            submitted.append((list_name, future, versions))
+
+        for list_name, future, versions in submitted:
+            serving[list_name] = future.result()
+            ver_lists[list_name] = []
+            register_versioned_lists(serving, ver_lists, list_name, versions)
+    reused = sum(1 for name, list_ in serving.items()
+                 if previous.get(name) is list_)
+    logger.info('Loaded %d lists, %d of them unchanged, in %.2fs'
+                % (len(serving), reused, time.time() - start))
+
+    list_names = [list['name'] for list in list_configs]
+    # Requests in flight carry on with the state they fetched
+    config.registry['shavar.serving_state'] = ServingState(
+        serving, ver_lists, list_names,
+        gethash_versioned_lists=asbool(config.registry.settings.get(
+            'shavar.gethash_versioned_lists', True)),
+        previous=previous_state,
+        prefix_cache_size=config.registry.settings.get(
+            'shavar.prefix_cache_size', DEFAULT_PREFIX_CACHE_SIZE))
 
 
 def match_with_versioned_list(app_version, supported_versions, list_name):
@@ -233,14 +740,13 @@ def match_with_versioned_list(app_version, supported_versions, list_name):
 
 
 def get_list(request, list_name, app_ver='none'):
-    shavar_lists_served = request.registry['shavar.serving']
-    if list_name not in shavar_lists_served:
+    state = get_serving_state(request)
+    if list_name not in state.serving:
         errmsg = 'Not serving requested list "%s"' % (list_name,)
         raise MissingListDataError(errmsg)
-    all_supported_versions = request.registry['shavar.versioned_lists']
     list_name, list_ver = match_with_versioned_list(
-        app_ver, all_supported_versions.get(list_name), list_name)
-    registry_val = request.registry['shavar.serving'].get(list_name)
+        app_ver, state.versioned_lists.get(list_name), list_name)
+    registry_val = state.serving.get(list_name)
     return registry_val, list_ver
 
 
@@ -258,23 +764,10 @@ def lookup_prefixes(request, prefixes):
       ... }
     }
 
-    Prefixes that aren't found are ignored
+    Prefixes that aren't found are ignored.  They're looked up in the
+    GethashIndex of every list served rather than list by list.
     """
-
-    found = {}
-
-    for list_name, sblist in request.registry['shavar.serving'].items():
-        for prefix in prefixes:
-            list_o_chunks = sblist.find_prefix(prefix)
-            if not list_o_chunks:
-                continue
-            if list_name not in found:
-                found[list_name] = {}
-            for chunk in list_o_chunks:
-                if chunk.number not in found[list_name]:
-                    found[list_name][chunk.number] = []
-                found[list_name][chunk.number].extend(chunk.get_hashes(prefix))
-    return found
+    return get_serving_state(request).gethash_index.lookup(prefixes)
 
 
 class SafeBrowsingList(object):
@@ -295,7 +788,9 @@ class SafeBrowsingList(object):
 
         scheme = self.url.scheme.lower()
         interval = settings.get('refresh_check_interval', 10 * 60)
-        if (scheme == 'file' or not (self.url.scheme and self.url.netloc)):
+        if scheme == 'snapshot':
+            cls = SnapshotSource
+        elif (scheme == 'file' or not (self.url.scheme and self.url.netloc)):
             cls = FileSource
         elif scheme == 's3+file':
             cls = S3FileSource
@@ -304,11 +799,12 @@ class SafeBrowsingList(object):
         elif scheme == 's3+dir':
             cls = S3DirectorySource
         else:
-            raise ValueError('Only local single files, local directories, S3 '
-                             'single files, and S3 directory sources are '
-                             'supported at this time')
+            raise ValueError('Only local single files, local directories, '
+                             'local snapshots, S3 single files, and S3 '
+                             'directory sources are supported at this time')
 
-        self._source = cls(self.source_url, refresh_interval=interval)
+        self._source = cls(self.source_url, refresh_interval=interval,
+                           settings=settings)
         try:
             self._source.load()
         except NoDataError as e:
@@ -322,15 +818,20 @@ class SafeBrowsingList(object):
         Calculates the delta necessary for a given client to catch up to the
         server's idea of "current"
 
-        This current iteration is very simplistic algorithm
+        adds and subs are the chunk numbers the client claims to have, either
+        as ChunkRanges straight from parse_downloads() or any iterable of
+        chunk numbers.  The differences are computed range by range so the
+        cost follows the number of ranges rather than the number of chunks,
+        and memoized by the source until its data is reloaded.
         """
-        current_adds, current_subs = self._source.list_chunks()
+        if not isinstance(adds, ChunkRanges):
+            adds = ChunkRanges(adds)
+        if not isinstance(subs, ChunkRanges):
+            subs = ChunkRanges(subs)
 
         # FIXME Should we call issuperset() first to be sure we're not getting
         # weird stuff from the request?
-        a_delta = current_adds.difference(adds)
-        s_delta = current_subs.difference(subs)
-        return sorted(a_delta), sorted(s_delta)
+        return self._source.delta(adds, subs)
 
     def fetch(self, add_chunks=[], sub_chunks=[]):
         try:
@@ -0,0 +1,48 @@
+"""
+Counters that make it to the metrics log with or without a request
+
+mozsvc only logs the metrics annotated on a request, once it's handled.
+The background refresh threads, the threads loading lists and the startup
+load have no request to annotate so what they count is tallied here instead
+and logged by report_background_metrics(), on the same logger and in the
+same format as the request metrics.
+"""
+import collections
+import json
+import logging
+import threading
+
+from mozsvc.metrics import annotate_request
+import pyramid.threadlocal
+
+
+logger = logging.getLogger('mozsvc.metrics')
+
+_background = collections.Counter()
+_lock = threading.Lock()
+
+
+def incr(key, value=1):
+    """
+    Adds value to the metric key of the current request or, if there's
+    none, to the ones of the next background report
+    """
+    request = pyramid.threadlocal.get_current_request()
+    if request is not None and hasattr(request, 'metrics'):
+        annotate_request(request, key, value)
+        return
+    with _lock:
+        _background[key] += value
+
+
+def report_background_metrics():
+    """
+    Logs the metrics counted outside of requests since the last report, if
+    any, and returns them
+    """
+    with _lock:
+        metrics = dict(_background)
+        _background.clear()
+    if metrics:
+        logger.info(json.dumps(metrics), extra=metrics)
+    return metrics
@@ -1,110 +1,129 @@
+import contextlib
 import itertools
 import json
+import mmap
+import multiprocessing
 import os.path
 import posixpath
+import struct
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from shavar.exceptions import ParseError
 from shavar.types import Chunk, ChunkList, Downloads, DownloadsListInfo
 
 
 def parse_downloads(request):
+    """
+    Parses a /downloads request body in a single pass over the raw bytes.
+    Returns a Downloads list with one DownloadsListInfo per list line.
+    """
     parsed = Downloads()
 
     limit = request.registry.settings.get("shavar.max_downloads_chunks",
                                           10000)
+    no_mac = request.GET.get('pver') == '3.0'
 
-    for lineno, line in enumerate(request.body_file):
+    for lineno, line in enumerate(request.body.split(b'\n')):
         line = line.strip()
 
-        if not line or line.isspace():
+        if not line:
             continue
 
-        line = line.decode()
         # Did client provide max size preference?
-        if line.startswith("s;"):
+        if line.startswith(b"s;"):
             if lineno != 0:
-                return ParseError("Size request can only be the first line!")
-            req_size = line.split(";", 1)[1]
-            # Almost certainly redundant due to stripping the line above
-            req_size = req_size.strip()
+                raise ParseError("Size request can only be the first line!")
             try:
-                req_size = int(req_size)
+                parsed.req_size = int(line[2:])
             except ValueError:
                 raise ParseError("Invalid requested size")
-            parsed.req_size = req_size
             continue
 
-        if ";" not in line:
+        lname, sep, chunklist = line.partition(b";")
+        if not sep:
             raise ParseError("Bad downloads request: no semi-colon")
-
-        lname, chunklist = line.split(";", 1)
+        lname = lname.decode()
         if not lname or '-' not in lname:
             raise ParseError("Invalid list name: \"%s\"" % lname)
         info = DownloadsListInfo(lname, limit=limit)
 
-        chunks = chunklist.split(":")
         # Check for MAC
-        if len(chunks) >= 1 and chunks[-1] == "mac":
-            if request.GET.get('pver') == '3.0':
+        if chunklist == b"mac" or chunklist.endswith(b":mac"):
+            if no_mac:
                 raise ParseError('MAC not supported in protocol version 3')
             info.wants_mac = True
-            chunks.pop(-1)
+            chunklist = chunklist[:-4]
         # Client claims to have chunks for this list
-        if not chunks or (len(chunks) == 1 and not chunks[0]):
+        if not chunklist:
             parsed.append(info)
             continue
+
+        fields = chunklist.split(b":")
         # Uneven number of chunks should only occur if 'mac' was specified
-        if len(chunks) % 2 != 0:
+        if len(fields) % 2 != 0:
             raise ParseError("Invalid LISTINFO for %s" % lname)
 
-        while chunks:
-            ctype = chunks.pop(0)
-            if ctype not in ('a', 's'):
-                raise ParseError("Invalid CHUNKTYPE \"%s\" for %s" % (ctype,
-                                                                      lname))
-
-            list_of_chunks = chunks.pop(0)
-            for chunk in list_of_chunks.split(','):
-                try:
-                    chunk = int(chunk)
-                except ValueError:
-                    if chunk.find('-'):
-                        low, high = chunk.split('-', 1)
-                        # FIXME should probably be stricter about testing for
-                        #       pure integers only on the input
-                        try:
-                            low = int(low)
-                            high = int(high)
-                        except ValueError:
-                            raise ParseError("Invalid RANGE \"%s\" for %s" %
-                                             (chunk, lname))
-                        if low >= high:
-                            raise ParseError("Invalid RANGE \"%s\" for %s" %
-                                             (chunk, lname))
-
-                        info.add_range_claim(ctype, low, high)
-                else:  # Resist temptation to indent!  It's a try/except/else
-                    info.add_claim(ctype, chunk)
+        for i in range(0, len(fields), 2):
+            ctype = fields[i]
+            if ctype == b'a':
+                ctype = 'a'
+            elif ctype == b's':
+                ctype = 's'
+            else:
+                raise ParseError("Invalid CHUNKTYPE \"%s\" for %s"
+                                 % (ctype.decode('utf-8', 'replace'), lname))
+            claims = fields[i + 1]
+            if claims.isdigit():
+                # By far the most common claim: the one latest chunk
+                info.add_claim(ctype, int(claims))
+                continue
+            numbers = []
+            ranges = []
+            for chunk in claims.split(b','):
+                if chunk.isdigit():
+                    numbers.append(int(chunk))
+                    continue
+                low, dash, high = chunk.partition(b'-')
+                # Only plain ASCII digits, int() would also take signs,
+                # whitespace and underscores
+                if not (dash and low.isdigit() and high.isdigit()):
+                    raise ParseError("Invalid RANGE \"%s\" for %s"
+                                     % (chunk.decode('utf-8', 'replace'),
+                                        lname))
+                low = int(low)
+                high = int(high)
+                if low >= high:
+                    raise ParseError("Invalid RANGE \"%s\" for %s"
+                                     % (chunk.decode(), lname))
+                ranges.append((low, high))
+            info.add_claims(ctype, ranges, numbers)
         parsed.append(info)
     return parsed
 
 
 def parse_gethash(request):
-    parsed = []
+    """
+    Parses a /gethash request body and returns the set of unique prefixes.
+    The prefixes are sliced straight out of the buffered body.
+    """
+    body = request.body
 
     # Early check to be sure we have something within the limits of a
     # reasonably sized header.  Reasonable size defined as an arbitrary max
     # of 2**8 bytes and a minimum of 3("4:4", a single prefix).  256 is
     # probably waaaaaaaaaaay too large for a gethash request header.
-    eoh = request.body.find(b'\n')
+    eoh = body.find(b'\n', 0, 256)
+    if eoh == -1:
+        # Only look further to report the actual size
+        eoh = body.find(b'\n')
     if eoh < 3 or eoh >= 256:
         raise ParseError("Improbably small or large gethash header size: %d"
                          % eoh)
 
-    body_file = request.body_file
-
     # determine size of individual prefixes and length of payload
-    header = body_file.readline().decode()
+    header = body[:eoh + 1].decode(errors='replace')
     try:
         prefix_len, payload_len = [int(x) for x in header.split(':', 1)]
     except ValueError:
@@ -114,25 +133,17 @@ def parse_gethash(request):
         raise ParseError("Payload length invalid: \"%d\"" % payload_len)
 
     prefix_total = payload_len // prefix_len
-    prefixes_read = 0
-    total_read = 0
-    while prefixes_read < prefix_total:
-        prefix = body_file.read(prefix_len)
-        if len(prefix) < prefix_len:
-            break
-        total_read += len(prefix)
-        prefixes_read += 1
-        parsed.append(prefix)
-
+    start = eoh + 1
+    prefixes_read = min(prefix_total, (len(body) - start) // prefix_len)
     if prefixes_read != prefix_total:
         raise ParseError("Hash read mismatch: client claimed %d, read %d" %
                          (prefix_total, prefixes_read))
 
-    if total_read != payload_len:
-        raise ParseError("Mismatch on gethash parse: client: %d, actual: %d" %
-                         (payload_len, total_read))
-
-    return set(parsed)  # unique-ify
+    # Unpack every fixed width prefix out of a single view of the body
+    # rather than reading them one at a time off a stream
+    payload = memoryview(body)[start:start + payload_len]
+    return {prefix for (prefix,)  # unique-ify
+            in struct.iter_unpack('%ds' % prefix_len, payload)}
 
 
 def get_header(blob, eol):
@@ -144,10 +155,50 @@ def get_header(blob, eol):
     return header
 
 
-def parse_file_source(handle):
+def parse_chunk_header(header):
+    """
+    Validates a decoded chunk header and returns its fields as a tuple of
+    (add_sub, chunk_num, hash_len, read_len)
+    """
+    if header.count(':') != 3:
+        raise ParseError('Incorrect number of fields in chunk header: '
+                         '"%s"' % header)
+
+    add_sub, chunk_num, hash_len, read_len = header.split(':', 3)
+
+    if len(add_sub) != 1:
+        raise ParseError('Chunk type is too long: "%s"' % header)
+    if add_sub not in ('a', 's'):
+        raise ParseError('Invalid chunk type: "%s"' % header)
+
+    try:
+        chunk_num = int(chunk_num)
+        hash_len = int(hash_len)
+        read_len = int(read_len)
+    except ValueError:
+        raise ParseError('Non-integer chunk values: "%s"' % header)
+
+    if read_len % hash_len != 0:
+        raise ParseError('Chunk data length not a multiple of prefix '
+                         'size: "%s"' % header)
+    return add_sub, chunk_num, hash_len, read_len
+
+
+def parse_file_source(handle, use_mmap=False):
     """
     Parses a chunk list formatted file
+
+    With use_mmap the file is memory mapped and handed to
+    parse_buffer_source() instead of being read into memory.
     """
+    if use_mmap:
+        try:
+            buf = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped and have no chunks anyway
+            return ChunkList()
+        return parse_buffer_source(buf)
+
     # We should almost certainly* find the end of the first newline within the
     # first 32 bytes of the file.  It consists of a colon delimited string
     # with the following members:
@@ -184,47 +235,119 @@ def parse_file_source(handle):
         if eol < 8:
             raise ParseError('Impossibly short chunk header: "%s"' % eol)
         header = get_header(blob, eol)
+        add_sub, chunk_num, hash_len, read_len = parse_chunk_header(header)
 
-        if header.count(':') != 3:
-            raise ParseError('Incorrect number of fields in chunk header: '
-                             '"%s"' % header)
+        blob = blob[eol + 1:]
+        blob += handle.read(read_len - len(blob))
+        if blob is None or len(blob) < read_len:
+            raise ParseError('Chunk data truncated for chunk %d' % chunk_num)
 
-        add_sub, chunk_num, hash_len, read_len = header.split(':', 3)
+        parsed.insert_chunk(Chunk.from_buffer(add_sub, chunk_num, blob, 0,
+                                              read_len, hash_len))
 
-        if len(add_sub) != 1:
-            raise ParseError('Chunk type is too long: "%s"' % header)
-        if add_sub not in ('a', 's'):
-            raise ParseError('Invalid chunk type: "%s"' % header)
+    return parsed
 
-        try:
-            chunk_num = int(chunk_num)
-            hash_len = int(hash_len)
-            read_len = int(read_len)
-        except ValueError:
-            raise ParseError('Non-integer chunk values: "%s"' % header)
 
-        if read_len % hash_len != 0:
-            raise ParseError('Chunk data length not a multiple of prefix '
-                             'size: "%s"' % header)
+def parse_buffer_source(buf):
+    """
+    Parses chunk list formatted data from a bytes alike object such as an
+    mmap without copying it.  Chunks whose hashes are already sorted
+    reference their region of buf directly so buf stays alive, and mapped,
+    for as long as the chunks do.
+    """
+    parsed = ChunkList()
+    end = len(buf)
+    pos = 0
+    while True:
+        # Consume any unnecessary newlines in front of chunks
+        while pos < end and buf[pos:pos + 1] == b'\n':
+            pos += 1
 
-        blob = blob[eol + 1:]
-        blob += handle.read(read_len - len(blob))
-        if blob is None or len(blob) < read_len:
-            raise ParseError('Chunk data truncated for chunk %d' % chunk_num)
+        if pos >= end:
+            break
 
-        hashes = []
-        pos = 0
-        while pos < read_len:
-            hashes.append(blob[pos:pos + hash_len])
-            pos += hash_len
+        # See parse_file_source() for why 32 bytes is enough for a header
+        blob = buf[pos:pos + 32]
+        if len(blob) < 8:
+            raise ParseError("Incomplete chunk file? Could only read %d "
+                             "bytes of header." % len(blob))
+
+        eol = blob.find(b'\n')
+        if eol < 8:
+            raise ParseError('Impossibly short chunk header: "%s"' % eol)
+        header = get_header(blob, eol)
+        add_sub, chunk_num, hash_len, read_len = parse_chunk_header(header)
+
+        pos += eol + 1
+        if end - pos < read_len:
+            raise ParseError('Chunk data truncated for chunk %d' % chunk_num)
 
-        parsed.insert_chunk(Chunk(chunk_type=add_sub, number=chunk_num,
-                                  hashes=hashes))
+        parsed.insert_chunk(Chunk.from_buffer(add_sub, chunk_num, buf, pos,
+                                              read_len, hash_len))
+        pos += read_len
 
     return parsed
 
 
-def parse_dir_source(handle, exists_cb=os.path.exists, open_cb=open):
+def stat_fingerprint(path):
+    """
+    Fingerprint of a local chunk file telling whether it changed since it
+    was last loaded, None if it doesn't exist
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+# Worker process pools of parse_dir_source() by number of workers
+_process_pools = {}
+_process_pools_lock = threading.Lock()
+
+
+def _process_pool(workers):
+    """
+    The pool of workers processes shared by every parse_dir_source() call,
+    created on first use.  Its processes are started by a forkserver rather
+    than forked off the calling process, which runs threads (uWSGI's, the
+    refresh and load threads) whose locks, e.g. logging's or the S3
+    connection pool's, a fork could copy while held.
+    """
+    with _process_pools_lock:
+        pool = _process_pools.get(workers)
+        if pool is None:
+            pool = _process_pools[workers] = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('forkserver'))
+        return pool
+
+
+def _discard_process_pool(workers, pool):
+    # A worker died and took the pool with it, the next call gets a new one
+    with _process_pools_lock:
+        if _process_pools.get(workers) is pool:
+            del _process_pools[workers]
+    pool.shutdown(wait=False)
+
+
+def _load_chunk_file(chunk_file, exists_cb, open_cb, use_mmap):
+    if not exists_cb(chunk_file):
+        raise ParseError("Invalid chunk filename: \"%s\"" % chunk_file)
+
+    with open_cb(chunk_file, 'rb') as f:
+        chunk_list = parse_file_source(f, use_mmap=use_mmap)
+
+    # Only one chunk per file
+    if len(chunk_list) > 1:
+        raise ParseError("More than one chunk in chunk file \"%s\""
+                         % chunk_file)
+    return chunk_list
+
+
+def parse_dir_source(handle, exists_cb=os.path.exists, open_cb=open,
+                     use_mmap=False, workers=1, processes=False,
+                     loaded=None, fingerprint_cb=stat_fingerprint):
     """
     Expects a file alike object with the contents of a JSON formatted index
     file that has the following structure:
@@ -250,6 +373,22 @@ def parse_dir_source(handle, exists_cb=os.path.exists, open_cb=open):
     served will be parsed with parse_file_source().  If hashes and prefixes are
     provided, they will be verified against the data provided in the given
     chunk file.
+
+    use_mmap is passed on to parse_file_source() for every chunk file.
+
+    With workers greater than one the chunk files are loaded concurrently by
+    a pool of that many threads, or of processes if processes is true.  A
+    process pool is only worth it for CPU bound parsing of large local
+    files and needs exists_cb and open_cb to be picklable.  It's created
+    once and shared by every call, see _process_pool().  Either way the
+    resulting ChunkList and the error raised for a broken chunk are the same
+    as when loading them one by one.
+
+    loaded makes reloads incremental.  It's a dict, empty the first time,
+    remembering the fingerprint_cb() fingerprint and parsed chunks of every
+    chunk file.  Chunk files whose fingerprint didn't change since are not
+    opened again, their Chunk objects are reused instead.  It's updated in
+    place only if the index is loaded successfully.
     """
     try:
         index = json.load(handle)
@@ -262,39 +401,91 @@ def parse_dir_source(handle, exists_cb=os.path.exists, open_cb=open):
     if 'chunks' not in index:
         raise ParseError("Incorrectly formatted index: missing chunks")
 
+    # In-memory handles have no name, their chunk files are relative to the
+    # index just the same
+    handle_name = getattr(handle, 'name', '')
+    if isinstance(handle_name, int):
+        handle_name = str(handle_name)
     if 'basedir' in index:
-        basedir = posixpath.join(os.path.dirname(handle.name),
+        basedir = posixpath.join(os.path.dirname(handle_name),
                                  index['basedir'])
     else:
-        handle_name = handle.name
-        if isinstance(handle_name, int):
-            handle_name = str(handle_name)
         basedir = os.path.dirname(handle_name)
 
     parsed = ChunkList()
     int_key_chunks = {}
-    for key in index['chunks'].keys():
-        # A little massaging to make the data structure a little cleaner
-        try:
-            int_key_chunks[int(key)] = index['chunks'][key]
-        except KeyError:
-            raise ParseError("Some weird behaviour with the list of chunks "
-                             "in \"%s\"" % handle.filename)
-        chunk_file = posixpath.join(basedir, str(key))
-
-        if not exists_cb(chunk_file):
-            raise ParseError("Invalid chunk filename: \"%s\"" % chunk_file)
-
-        with open_cb(chunk_file, 'rb') as f:
-            chunk_list = parse_file_source(f)
-
-        # Only one chunk per file
-        if len(chunk_list) > 1:
-            raise ParseError("More than one chunk in chunk file \"%s\""
-                             % chunk_file)
-
+    chunk_files = []
+    pending_error = None
+    try:
+        for key in index['chunks'].keys():
+            # A little massaging to make the data structure a little cleaner
+            try:
+                int_key_chunks[int(key)] = index['chunks'][key]
+            except KeyError:
+                raise ParseError("Some weird behaviour with the list of "
+                                 "chunks in \"%s\"" % handle.filename)
+            chunk_files.append(posixpath.join(basedir, str(key)))
+    except Exception as e:
+        # Raised only once the chunks listed before the bad key are loaded,
+        # same as it would be loading them one at a time
+        pending_error = e
+
+    def insert(chunk_list):
         for chunk in itertools.chain(iter(chunk_list.adds.values()),
                                      iter(chunk_list.subs.values())):
             parsed.insert_chunk(chunk)
+
+    fingerprints = {}
+    chunk_lists = {}
+    if loaded is not None:
+        for chunk_file in chunk_files:
+            fingerprint = fingerprint_cb(chunk_file)
+            fingerprints[chunk_file] = fingerprint
+            previous = loaded.get(chunk_file)
+            if (fingerprint is not None and previous is not None
+                    and previous[0] == fingerprint):
+                chunk_lists[chunk_file] = previous[1]
+    to_load = [f for f in chunk_files if f not in chunk_lists]
+
+    def load_all(load):
+        # In index order so the first broken chunk is the one reported
+        for chunk_file in chunk_files:
+            if chunk_file not in chunk_lists:
+                chunk_lists[chunk_file] = load(chunk_file)
+            insert(chunk_lists[chunk_file])
+
+    if workers > 1 and len(to_load) > 1:
+        if processes:
+            # The chunks are copied back from the workers anyway
+            executor = contextlib.nullcontext(_process_pool(workers))
+            use_mmap = False
+        else:
+            executor = ThreadPoolExecutor(max_workers=workers)
+        with executor as pool:
+            futures = {}
+            try:
+                for chunk_file in to_load:
+                    futures[chunk_file] = pool.submit(
+                        _load_chunk_file, chunk_file, exists_cb, open_cb,
+                        use_mmap)
+                load_all(lambda chunk_file: futures[chunk_file].result())
+            except BaseException as e:
+                for future in futures.values():
+                    future.cancel()
+                if isinstance(e, BrokenProcessPool):
+                    _discard_process_pool(workers, pool)
+                raise
+    else:
+        load_all(lambda chunk_file: _load_chunk_file(chunk_file, exists_cb,
+                                                     open_cb, use_mmap))
+
+    if pending_error is not None:
+        raise pending_error
+
+    if loaded is not None:
+        loaded.clear()
+        for chunk_file in chunk_files:
+            loaded[chunk_file] = (fingerprints[chunk_file],
+                                  chunk_lists[chunk_file])
     index['chunks'] = int_key_chunks
     return parsed
@@ -0,0 +1,426 @@
+"""
+Process wide access to S3 shared by every list source
+
+S3Connections are checked out of a pool shared by every thread for each
+operation, so connections, and the HTTP connections boto keeps alive behind
+them, outlive the short lived threads loading the lists.  Buckets are looked
+up once instead of on every load and refresh check.  Objects whose
+ETag is already known are fetched with conditional GETs so that checking
+for changes and downloading them take a single round trip, and can be read
+straight off the response as they're parsed.  The round trips
+made through it are counted per operation.
+"""
+import collections
+import contextlib
+import logging
+import os
+import queue
+import shutil
+import tempfile
+import threading
+from urllib.parse import quote, unquote
+
+from boto.exception import S3ResponseError
+from boto.s3.connection import S3Connection
+
+from shavar.metrics import incr
+
+
+logger = logging.getLogger('shavar')
+
+DEFAULT_S3_POOL_SIZE = 16
+
+
+class S3DiskCache(object):
+    """
+    Local copies of S3 objects by bucket, key and ETag so that a restarted
+    process can read the objects that didn't change from disk instead of
+    downloading them again.  Only the latest copy of each key is kept.  The
+    directory can be shared by several processes, copies are written next to
+    their final path and renamed into place.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _key_dir(self, bucket_name, key_name):
+        return os.path.join(self.path, quote(bucket_name, safe=''),
+                            quote(key_name, safe=''))
+
+    def _copies(self, key_dir):
+        # Copies still being written are hidden
+        return [name for name in os.listdir(key_dir)
+                if not name.startswith('.')]
+
+    def latest(self, bucket_name, key_name):
+        "Returns the ETag of the copy of the key kept, None if there's none"
+        try:
+            names = self._copies(self._key_dir(bucket_name, key_name))
+        except OSError:
+            return None
+        if len(names) != 1:
+            return None
+        return '"%s"' % unquote(names[0])
+
+    def open(self, bucket_name, key_name, etag):
+        "Opens the copy of the key with the ETag etag, None if there's none"
+        try:
+            return open(os.path.join(self._key_dir(bucket_name, key_name),
+                                     quote(etag.strip('"'), safe='')), 'rb')
+        except OSError:
+            return None
+
+    def copy(self, bucket_name, key_name):
+        "Returns a _CacheCopy to write a new copy of the key to"
+        return _CacheCopy(self._key_dir(bucket_name, key_name), self)
+
+
+class _CacheCopy(object):
+    """
+    A copy of an S3 object being written to the cache.  Failing to write it
+    is logged and otherwise ignored, the cache is an optimization only.
+    """
+
+    def __init__(self, key_dir, cache):
+        self.key_dir = key_dir
+        self.cache = cache
+        self.fp = None
+        try:
+            os.makedirs(key_dir, exist_ok=True)
+            fd, self.tmp_path = tempfile.mkstemp(dir=key_dir, prefix='.')
+            self.fp = os.fdopen(fd, 'wb')
+        except OSError as e:
+            logger.warning('Could not cache S3 object in %s: %s'
+                           % (key_dir, e))
+
+    def write(self, data):
+        if self.fp is None:
+            return
+        try:
+            self.fp.write(data)
+        except OSError as e:
+            logger.warning('Could not cache S3 object in %s: %s'
+                           % (self.key_dir, e))
+            self.discard()
+
+    def commit(self, etag):
+        if self.fp is None:
+            return
+        name = quote(etag.strip('"'), safe='')
+        try:
+            self.fp.close()
+            self.fp = None
+            os.replace(self.tmp_path, os.path.join(self.key_dir, name))
+            for stale in self.cache._copies(self.key_dir):
+                if stale != name:
+                    os.unlink(os.path.join(self.key_dir, stale))
+        except OSError as e:
+            logger.warning('Could not cache S3 object in %s: %s'
+                           % (self.key_dir, e))
+            self.discard()
+
+    def discard(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+        try:
+            os.unlink(self.tmp_path)
+        except OSError:
+            pass
+
+
+class _S3Stream(object):
+    """
+    Reads the contents of a key opened for reading straight off the
+    response, writing them to copy, if given, to be cached once all of them
+    were read
+    """
+
+    def __init__(self, key, copy=None):
+        self.key = key
+        self.copy = copy
+        self.remaining = key.size
+        # Gives the connection read from back once closed
+        self.release = None
+
+    def read(self, size=-1):
+        if size == 0:
+            return b''
+        # boto reads everything for a size of 0
+        data = self.key.read(size if size and size > 0 else 0)
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        if self.copy is not None:
+            self.copy.write(data)
+            if not data or self.remaining == 0:
+                self.copy.commit(self.key.etag)
+                self.copy = None
+        return data
+
+    def close(self):
+        if self.copy is not None:
+            self.copy.discard()
+            self.copy = None
+        try:
+            self.key.close()
+        finally:
+            release, self.release = self.release, None
+            if release is not None:
+                release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _Tee(object):
+    "Writes to several file alike objects at once"
+
+    def __init__(self, *files):
+        self.files = files
+
+    def write(self, data):
+        for f in self.files:
+            f.write(data)
+
+
+class S3Client(object):
+    """
+    connection_kwargs are passed on to every S3Connection, e.g. to point
+    the client at another S3 endpoint.  Up to pool_size idle connections
+    are kept open, more are opened as needed by concurrent operations and
+    closed afterwards.  Objects are read from and written to cache, an
+    S3DiskCache, if one is given.
+    """
+
+    def __init__(self, metrics_prefix='shavar.s3', cache=None,
+                 pool_size=DEFAULT_S3_POOL_SIZE, **connection_kwargs):
+        self.metrics_prefix = metrics_prefix
+        self.cache = cache
+        self.connection_kwargs = connection_kwargs
+        self.round_trips = collections.Counter()
+        self._lock = threading.Lock()
+        # Idle connections, the most recently used first
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        # Buckets known to exist, their handles need no further lookups
+        self._known_buckets = set()
+
+    def _count(self, operation):
+        with self._lock:
+            self.round_trips[operation] += 1
+        if self.metrics_prefix:
+            incr('%s.%s' % (self.metrics_prefix, operation))
+
+    def _checkout(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            self._count('connect')
+            return S3Connection(**self.connection_kwargs)
+
+    def _checkin(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    @contextlib.contextmanager
+    def connection(self):
+        "Checks an S3Connection out of the pool for the with block"
+        conn = self._checkout()
+        try:
+            yield conn
+        finally:
+            self._checkin(conn)
+
+    def _bucket(self, conn, name):
+        if name in self._known_buckets:
+            return conn.get_bucket(name, validate=False)
+        self._count('get_bucket')
+        bucket = conn.get_bucket(name)
+        with self._lock:
+            self._known_buckets.add(name)
+        return bucket
+
+    def get_bucket(self, name):
+        """
+        Makes sure the bucket name exists, raising S3ResponseError if it
+        doesn't.  Only the first call in the process looks it up.  Returns a
+        handle on it, its connection goes back to the pool though, requests
+        go through the other methods.
+        """
+        with self.connection() as conn:
+            return self._bucket(conn, name)
+
+    def forget_bucket(self, name):
+        "Makes the next get_bucket() of name look it up again"
+        with self._lock:
+            self._known_buckets.discard(name)
+
+    def get_key(self, bucket_name, key_name):
+        """
+        Returns the key key_name of the bucket bucket_name, None if there's
+        no such key.  Raises S3ResponseError if there's no such bucket.
+        """
+        cached = (bucket_name in self._known_buckets)
+        with self.connection() as conn:
+            bucket = self._bucket(conn, bucket_name)
+            self._count('get_key')
+            key = bucket.get_key(key_name)
+            if key is None and cached:
+                # S3 doesn't tell a missing key from a missing bucket, make
+                # sure the bucket didn't go away since it was looked up
+                self.forget_bucket(bucket_name)
+                bucket = self._bucket(conn, bucket_name)
+                self._count('get_key')
+                key = bucket.get_key(key_name)
+        return key
+
+    def list(self, bucket_name, prefix=''):
+        "Returns all the keys of the bucket bucket_name starting with prefix"
+        with self.connection() as conn:
+            bucket = self._bucket(conn, bucket_name)
+            self._count('list')
+            return list(bucket.list(prefix=prefix))
+
+    def _get(self, key, fp):
+        self._count('get')
+        if self.cache is None:
+            key.get_contents_to_file(fp)
+            return
+        copy = self.cache.copy(key.bucket.name, key.name)
+        try:
+            key.get_contents_to_file(_Tee(fp, copy))
+        except BaseException:
+            copy.discard()
+            raise
+        copy.commit(key.etag)
+
+    def _open_cached(self, bucket_name, key_name, etag):
+        cached = self.cache.open(bucket_name, key_name, etag)
+        if cached is not None:
+            self._count('cache_hit')
+        return cached
+
+    def fetch(self, key, fp):
+        "Writes the contents of key to the file alike object fp"
+        if self.cache is not None and key.etag:
+            cached = self._open_cached(key.bucket.name, key.name, key.etag)
+            if cached is not None:
+                with cached:
+                    shutil.copyfileobj(cached, fp)
+                return
+        with self.connection() as conn:
+            # Listed through another connection, go through this one
+            key = self._bucket(conn, key.bucket.name).new_key(key.name)
+            self._get(key, fp)
+
+    def open(self, bucket_name, key_name, etag=None):
+        """
+        Opens the key key_name of the bucket bucket_name for reading unless
+        its ETag is still etag.  Returns a file alike object streaming the
+        contents off the response along with their ETag, None if the key
+        didn't change.  Raises S3ResponseError if there's no such key or
+        bucket.
+
+        Without an etag, a copy in the cache is revalidated and opened
+        instead if it's still current.
+
+        The connection streamed from stays checked out until the stream is
+        closed.
+        """
+        conn = self._checkout()
+        try:
+            opened = self._open(conn, bucket_name, key_name, etag)
+        except BaseException:
+            self._checkin(conn)
+            raise
+        if opened is not None and isinstance(opened[0], _S3Stream):
+            opened[0].release = lambda: self._checkin(conn)
+        else:
+            self._checkin(conn)
+        return opened
+
+    def _open(self, conn, bucket_name, key_name, etag):
+        cached_etag = None
+        if etag is None and self.cache is not None:
+            etag = cached_etag = self.cache.latest(bucket_name, key_name)
+        bucket = self._bucket(conn, bucket_name)
+        key = bucket.new_key(key_name)
+        headers = {'If-None-Match': etag} if etag else None
+        self._count('get')
+        unchanged = False
+        try:
+            key.open_read(headers=headers)
+        except S3ResponseError as e:
+            if e.status != 304:
+                if e.error_code == 'NoSuchBucket':
+                    # Went away since it was looked up, raises like
+                    # get_bucket()
+                    self.forget_bucket(bucket_name)
+                    self._bucket(conn, bucket_name)
+                raise
+            unchanged = True
+        else:
+            if etag and key.etag == etag:
+                # An endpoint that doesn't do conditional requests
+                key.close()
+                unchanged = True
+        if unchanged:
+            self._count('not_modified')
+            if cached_etag is None:
+                return None
+            cached = self._open_cached(bucket_name, key_name, cached_etag)
+            if cached is not None:
+                return cached, cached_etag
+            # Replaced by another process since, fetch it all
+            key = bucket.new_key(key_name)
+            self._count('get')
+            key.open_read()
+        copy = None
+        if self.cache is not None:
+            copy = self.cache.copy(bucket_name, key_name)
+        return _S3Stream(key, copy), key.etag
+
+    def fetch_if_changed(self, bucket_name, key_name, fp, etag=None):
+        """
+        Writes the contents of the key key_name of the bucket bucket_name to
+        the file alike object fp unless its ETag is still etag.  Returns the
+        ETag of the contents written, None if the key didn't change.  See
+        open().
+        """
+        opened = self.open(bucket_name, key_name, etag=etag)
+        if opened is None:
+            return None
+        stream, etag = opened
+        with stream:
+            shutil.copyfileobj(stream, fp)
+        return etag
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    "Returns the S3Client shared by the whole process"
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = S3Client()
+        return _client
+
+
+def set_s3_client(client):
+    global _client
+    with _client_lock:
+        _client = client
+    return _client
+
+
+def configure_s3_cache(settings):
+    "Sets up the disk cache of the shared S3Client from the app settings"
+    cache_dir = settings.get('shavar.s3_cache_dir')
+    get_s3_client().cache = S3DiskCache(cache_dir) if cache_dir else None
@@ -0,0 +1,204 @@
+"""
+Precompiled binary snapshots of list data
+
+A snapshot holds every chunk of a list together with its prefix index in a
+single file laid out so that it can be memory mapped and served from as is:
+
+    header      magic, format version and length of the metadata
+    metadata    JSON: list name, creation time, byte order and the offset
+                and size of every chunk and index table below
+    data        the sorted hashes of every chunk followed by, for each key
+                width, the sorted keys (leading bytes of the hashes) of the
+                prefix index and the chunk number (unsigned 32 bit ints) of
+                each of them
+
+Offsets in the metadata are relative to the start of the data section which
+begins at the first 8 byte boundary after the metadata.  Loading a snapshot
+only reads the metadata, all the hashes stay in the mapped pages which are
+shared with every other process mapping the same file.
+"""
+import argparse
+from array import array
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+
+from shavar.exceptions import ParseError
+from shavar.parse import parse_dir_source, parse_file_source
+from shavar.types import Chunk, ChunkList, PrefixIndex
+
+
+MAGIC = b'SHAVSNAP'
+FORMAT_VERSION = 1
+
+_HEADER = struct.Struct('<8sII')
+_ALIGNMENT = 8
+
+
+def _pad(length):
+    return -length % _ALIGNMENT
+
+
+def write_snapshot(chunks, handle, name=None):
+    """
+    Writes the ChunkList chunks to the binary file alike object handle in
+    the snapshot format
+    """
+    data = []
+    data_len = 0
+
+    def append(blob):
+        nonlocal data_len
+        offset = data_len
+        data.append(blob)
+        data.append(b'\0' * _pad(len(blob)))
+        data_len += len(blob) + _pad(len(blob))
+        return offset
+
+    chunk_entries = []
+    for chunk_list in (chunks.adds, chunks.subs):
+        for number in sorted(chunk_list):
+            chunk = chunk_list[number]
+            chunk_entries.append([chunk.type, chunk.number, chunk.hash_len,
+                                  chunk._stride, append(chunk.data),
+                                  len(chunk.data)])
+
+    index = chunks.prefix_index
+    if index.layered:
+        index = PrefixIndex(chunks.adds.values())
+    index_entries = []
+    for width, buf, offset, numbers in index.tables:
+        keys = buf[offset:offset + width * len(numbers)]
+        index_entries.append([width, append(keys), len(numbers),
+                              append(array('I', numbers).tobytes())])
+
+    metadata = json.dumps({
+        'name': name,
+        'created': int(time.time()),
+        'byteorder': sys.byteorder,
+        'chunks': chunk_entries,
+        'index': index_entries,
+    }).encode()
+    metadata += b' ' * _pad(_HEADER.size + len(metadata))
+
+    handle.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(metadata)))
+    handle.write(metadata)
+    for blob in data:
+        handle.write(blob)
+
+
+def parse_snapshot(handle):
+    """
+    Memory maps the snapshot file handle and returns a ChunkList, with its
+    prefix index, backed by the mapping.  Nothing is copied so the mapping
+    stays alive for as long as the chunks do.  Snapshot files must be
+    replaced, never rewritten in place, while they're in use.
+    """
+    try:
+        buf = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        raise ParseError("Empty snapshot file")
+
+    if len(buf) < _HEADER.size:
+        raise ParseError("Truncated snapshot header")
+    magic, version, metadata_len = _HEADER.unpack_from(buf)
+    if magic != MAGIC:
+        raise ParseError("Not a shavar snapshot")
+    if version != FORMAT_VERSION:
+        raise ParseError("Unsupported snapshot format version: %d" % version)
+
+    try:
+        metadata = json.loads(
+            buf[_HEADER.size:_HEADER.size + metadata_len].decode())
+    except ValueError as e:
+        raise ParseError("Could not parse snapshot metadata: %s" % e)
+    if metadata.get('byteorder') != sys.byteorder:
+        raise ParseError("Snapshot compiled for a %s endian host"
+                         % metadata.get('byteorder'))
+
+    base = _HEADER.size + metadata_len
+    view = memoryview(buf)
+
+    def region(offset, size):
+        start = base + offset
+        if start + size > len(buf):
+            raise ParseError("Snapshot data truncated")
+        return start
+
+    parsed = ChunkList()
+    tables = []
+    try:
+        for chunk_type, number, hash_len, stride, offset, size in \
+                metadata['chunks']:
+            parsed.insert_chunk(Chunk.from_buffer(
+                chunk_type, number, buf, region(offset, size), size, stride,
+                hash_size=hash_len, presorted=True))
+
+        for width, offset, count, numbers_offset in metadata['index']:
+            numbers_size = count * array('I').itemsize
+            start = region(numbers_offset, numbers_size)
+            tables.append((width, buf, region(offset, width * count),
+                           view[start:start + numbers_size].cast('I')))
+    except (KeyError, TypeError, ValueError) as e:
+        raise ParseError("Incorrectly formatted snapshot metadata: %s" % e)
+    parsed.index_prefixes(PrefixIndex.from_tables(tables))
+    return parsed
+
+
+def publish_snapshot(chunks, output, name=None):
+    """
+    Writes the ChunkList chunks to a snapshot at the path output.  The
+    snapshot is written next to output first and then renamed into place so
+    processes serving the previous one can carry on undisturbed.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(output) or '.',
+                                    prefix='.snapshot-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write_snapshot(chunks, f, name=name)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, output)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def compile_snapshot(source, output, name=None, use_mmap=False):
+    """
+    Compiles the chunk file, or directory (index.json) source, at the local
+    path source into a snapshot published to output
+    """
+    if os.path.isdir(source):
+        source = os.path.join(source, 'index.json')
+    if source.endswith('.json'):
+        with open(source, 'r') as f:
+            chunks = parse_dir_source(f, use_mmap=use_mmap)
+    else:
+        with open(source, 'rb') as f:
+            chunks = parse_file_source(f, use_mmap=use_mmap)
+
+    publish_snapshot(chunks, output, name=name)
+    return chunks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Compile shavar list data into a binary snapshot')
+    parser.add_argument('source',
+                        help='chunk file, or directory with an index.json')
+    parser.add_argument('output', help='snapshot file to write')
+    parser.add_argument('--name', help='list name recorded in the snapshot')
+    args = parser.parse_args(argv)
+
+    start = time.time()
+    chunks = compile_snapshot(args.source, args.output, name=args.name)
+    print("Wrote %d chunks to %s in %.2fs"
+          % (len(chunks), args.output, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,49 @@
+import fcntl
+import io
+import logging
 import os
 # posixpath instead of os.path because posixpath will always use / as the path
 # separator.  Basically a Windows portability consideration.
 import posixpath
-import tempfile
+import threading
 import time
-from urllib.parse import urlparse
+from urllib.parse import quote, urlparse
 
 from boto.exception import S3ResponseError
-from boto.s3.connection import S3Connection
+from pyramid.settings import asbool
 
+from shavar.cache import LRUCache
 from shavar.exceptions import NoDataError, ParseError
+from shavar.metrics import incr
 from shavar.parse import parse_dir_source, parse_file_source
-from shavar.types import ChunkList
+from shavar.s3 import get_s3_client
+from shavar.snapshot import parse_snapshot, publish_snapshot
+from shavar.types import ChunkList, ChunkRanges
+
+
+DEFAULT_DELTA_CACHE_SIZE = 1000
+DEFAULT_S3_LOAD_WORKERS = 8
+
+logger = logging.getLogger('shavar')
+
+
+class SourceData(object):
+    """
+    The chunks of a source along with the chunk numbers and ranges derived
+    from them.  Built in full before a source publishes it and never modified
+    afterwards so readers always see all of them from the same load.
+    """
+
+    __slots__ = ('chunks', 'chunk_index', 'chunk_ranges')
+
+    def __init__(self, chunks=None):
+        if chunks is None:
+            chunks = ChunkList()
+        self.chunks = chunks
+        self.chunk_index = {'adds': set(chunks.adds.keys()),
+                            'subs': set(chunks.subs.keys())}
+        self.chunk_ranges = {'adds': ChunkRanges(chunks.adds.keys()),
+                             'subs': ChunkRanges(chunks.subs.keys())}
 
 
 class Source(object):
@@ -19,59 +51,227 @@ class Source(object):
     Base class for data sources
     """
 
-    def __init__(self, source_url, refresh_interval):
+    def __init__(self, source_url, refresh_interval, settings=None):
         self.source_url = source_url
         self.url = urlparse(self.source_url)
         self.interval = int(refresh_interval)
+        self.settings = settings or {}
+        # Most clients report one of a handful of states so deltas are
+        # memoized by a digest of the claimed add and sub chunks
+        self.delta_cache = LRUCache(
+            self.settings.get('delta_cache_size', DEFAULT_DELTA_CACHE_SIZE),
+            metrics_prefix='shavar.downloads.delta_cache')
         self.last_refresh = 0
         self.last_check = 0
-        # Initialize with an empty data set so we can always continue to serve
-        self.chunks = ChunkList()
-        self.chunk_index = {'adds': set(()), 'subs': set(())}
+        # Held by the one thread checking for and loading new data
+        self._refresh_lock = threading.Lock()
+        # Initialize with an empty data set so we can always continue to serve.
+        # Loads replace it as a whole, never update it.
+        self.data = SourceData()
         self.prefixes = None
         self.no_data = True
+        # Snapshot shared with the other processes currently served and the
+        # lock making this process the one loading it, see shared_dir
+        self._shared_generation = None
+        self._loader_lock = None
 
     def load(self):
         raise NotImplementedError
 
+    @property
+    def chunks(self):
+        return self.data.chunks
+
+    @property
+    def chunk_index(self):
+        return self.data.chunk_index
+
+    @property
+    def chunk_ranges(self):
+        return self.data.chunk_ranges
+
+    @property
+    def background_refresh(self):
+        # Refreshed by a RefreshListsDataThread rather than by the requests
+        return asbool(self.settings.get('background_refresh', False))
+
+    @property
+    def load_workers(self):
+        # Number of chunk files of a directory source loaded concurrently
+        return int(self.settings.get('load_workers', 1))
+
+    @property
+    def shared_dir(self):
+        # Directory where one process publishes the data as a snapshot that
+        # every process serving the list memory maps, sharing the pages
+        return self.settings.get('shared_dir') or None
+
     def _populate_chunks(self, fp, parser_func, *args, **kwargs):
         try:
-            self.chunks = parser_func(fp, *args, **kwargs)
-            self.last_check = int(time.time())
+            chunks = parser_func(fp, *args, **kwargs)
+            if not chunks.indexed:
+                # Only the chunks that changed since the previous load need
+                # indexing when the parser could reuse the others
+                chunks.reindex_from(self.data.chunks)
+            if self.shared_dir:
+                chunks = self._share(chunks)
+            self._publish(chunks)
             self.last_refresh = int(time.time())
-            self.chunk_index = {'adds': set(self.chunks.adds.keys()),
-                                'subs': set(self.chunks.subs.keys())}
         except ParseError as e:
             raise ParseError('Error parsing "%s": %s' % (self.url.path, e))
 
+    def _publish(self, chunks):
+        # Published with a single assignment, requests in flight carry on
+        # with the data they started with
+        self.data = SourceData(chunks)
+        self.delta_cache.clear()
+        self.last_check = int(time.time())
+
+    def _shared_path(self):
+        os.makedirs(self.shared_dir, exist_ok=True)
+        return os.path.join(self.shared_dir,
+                            quote(self.source_url, safe='') + '.snapshot')
+
+    def _share(self, chunks):
+        """
+        Publishes chunks as the new generation of the shared snapshot and
+        returns the chunks of the snapshot, to serve instead of the private
+        copy.  Falls back on the latter if the snapshot can't be written.
+        """
+        try:
+            path = self._shared_path()
+            publish_snapshot(chunks, path, name=self.source_url)
+            return self._map_shared(path)
+        except (OSError, ParseError) as e:
+            logger.warning('Could not share "%s" through %s: %s'
+                           % (self.source_url, self.shared_dir, e))
+            return chunks
+
+    def _map_shared(self, path, generation=None):
+        """
+        Maps the shared snapshot at path and returns its chunks, None if it's
+        still the generation given
+        """
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if (st.st_ino, st.st_mtime_ns) == generation:
+                return None
+            chunks = parse_snapshot(f)
+        self._shared_generation = (st.st_ino, st.st_mtime_ns)
+        return chunks
+
+    def _shared_loader(self):
+        """
+        Whether this process is the one loading the data for all the
+        processes sharing it, the first to lock the snapshot gets to until
+        it exits
+        """
+        if self._loader_lock is not None:
+            pid, lock_file = self._loader_lock
+            if pid == os.getpid():
+                return True
+            # Forked since, the lock belongs to the parent
+            self._loader_lock = None
+        try:
+            lock_file = open(self._shared_path() + '.lock', 'a')
+        except OSError as e:
+            logger.warning('Could not lock "%s" snapshot: %s'
+                           % (self.source_url, e))
+            return True
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._loader_lock = (os.getpid(), lock_file)
+        return True
+
+    def _follow_shared(self):
+        # Picks up the latest generation published by the loading process
+        try:
+            chunks = self._map_shared(self._shared_path(),
+                                      self._shared_generation)
+        except FileNotFoundError:
+            return
+        except (OSError, ParseError) as e:
+            logger.warning('Could not map "%s" snapshot: %s'
+                           % (self.source_url, e))
+            return
+        if chunks is not None:
+            self._publish(chunks)
+            self.no_data = False
+
     def refresh(self):
         # Prevent constant refresh checks
         now = int(time.time())
-        if now - self.interval >= self.last_check:
-            self.last_check = now
-            if self.needs_refresh():
-                self.load()
+        if now - self.interval < self.last_check:
+            return False
+        # Only one thread at a time checks for and loads new data, the others
+        # carry on with the current data rather than queue up behind it
+        if not self._refresh_lock.acquire(blocking=False):
+            incr('shavar.refresh.contended')
+            return False
+        try:
+            # The previous holder may have just done it
+            if now - self.interval >= self.last_check:
+                self.last_check = now
+                start = time.time()
+                try:
+                    if self.shared_dir and not self._shared_loader():
+                        self._follow_shared()
+                    elif self.needs_refresh():
+                        incr('shavar.refresh.reload')
+                        self.load()
+                finally:
+                    incr('shavar.refresh.time', time.time() - start)
+        finally:
+            self._refresh_lock.release()
         return False
 
     def needs_refresh(self):
         return False
 
+    def _refresh_for_request(self):
+        if not self.background_refresh:
+            self.refresh()
+        return self.data
+
     def fetch(self, adds, subs):
-        self.refresh()
+        data = self._refresh_for_request()
 
         chunks = {'adds': [], 'subs': []}
         for chunk_num in adds:
-            chunks['adds'].append(self.chunks.adds[chunk_num])
+            chunks['adds'].append(data.chunks.adds[chunk_num])
         for chunk_num in subs:
-            chunks['subs'].append(self.chunks.subs[chunk_num])
+            chunks['subs'].append(data.chunks.subs[chunk_num])
         return chunks
 
     def list_chunks(self):
-        self.refresh()
-        return (self.chunk_index['adds'], self.chunk_index['subs'])
+        data = self._refresh_for_request()
+        return (data.chunk_index['adds'], data.chunk_index['subs'])
+
+    def list_chunk_ranges(self):
+        data = self._refresh_for_request()
+        return (data.chunk_ranges['adds'], data.chunk_ranges['subs'])
+
+    def delta(self, adds, subs):
+        """
+        Returns the sorted add and sub chunk numbers missing from the given
+        ChunkRanges claimed by a client
+        """
+        chunk_ranges = self._refresh_for_request().chunk_ranges
+        key = (adds.digest(), subs.digest())
+        cached = self.delta_cache.get(key)
+        if cached is not None and cached[0] is chunk_ranges:
+            a_delta, s_delta = cached[1]
+        else:
+            a_delta = tuple(chunk_ranges['adds'].difference(adds))
+            s_delta = tuple(chunk_ranges['subs'].difference(subs))
+            self.delta_cache.put(key, (chunk_ranges, (a_delta, s_delta)))
+        return list(a_delta), list(s_delta)
 
     def find_prefix(self, prefix):
-        return self.chunks.find_prefix(prefix)
+        return tuple(self.chunks.find_prefix(prefix))
 
 
 # FIXME  Some of the logic here probably needs to be migrated into the Source
@@ -90,9 +290,16 @@ class FileSource(Source):
                               % self.url.path)
 
         with open(self.url.path, 'rb') as f:
-            self._populate_chunks(f, parse_file_source)
+            self._populate_chunks(f, parse_file_source,
+                                  use_mmap=self.use_mmap)
         self.no_data = False
 
+    @property
+    def use_mmap(self):
+        # Memory map the chunk files instead of reading them in.  The files
+        # must be replaced, never rewritten in place, while they are in use.
+        return asbool(self.settings.get('mmap', False))
+
     def needs_refresh(self):
         if int(os.stat(self.url.path).st_mtime) <= self.last_refresh:
             return False
@@ -108,7 +315,7 @@ class DirectorySource(FileSource):
 
     index_name = 'index.json'
 
-    def __init__(self, source_url, refresh_interval):
+    def __init__(self, source_url, refresh_interval, settings=None):
         if (source_url[-1] == '/'
                 or source_url[-len(self.index_name):] != self.index_name):
             source_url = posixpath.join(source_url, self.index_name)
@@ -118,7 +325,11 @@ class DirectorySource(FileSource):
         if (source_url[6] != '/'):
             source_url = source_url[6:]
 
-        super(DirectorySource, self).__init__(source_url, refresh_interval)
+        super(DirectorySource, self).__init__(source_url, refresh_interval,
+                                              settings)
+        # Fingerprint and chunks of every chunk file loaded so reloads only
+        # parse the ones that changed
+        self.loaded_chunk_files = {}
 
     def load(self):
         if not os.path.exists(self.url.path):
@@ -127,7 +338,51 @@ class DirectorySource(FileSource):
                               % self.url.path)
 
         with open(self.url.path, 'r') as f:
-            self._populate_chunks(f, parse_dir_source)
+            self._populate_chunks(f, parse_dir_source,
+                                  use_mmap=self.use_mmap,
+                                  workers=self.load_workers,
+                                  processes=self.load_processes,
+                                  loaded=self.loaded_chunk_files)
+        self.no_data = False
+
+    @property
+    def load_processes(self):
+        # Parse the chunk files in worker processes rather than threads, for
+        # large chunk files where parsing rather than I/O dominates
+        return asbool(self.settings.get('load_processes', False))
+
+
+class SnapshotSource(FileSource):
+    """
+    Serves straight out of a memory mapped snapshot compiled with
+    shavar.snapshot so loading takes the same time whatever the size of the
+    list and the pages are shared by every process serving it.
+    """
+
+    scheme = 'snapshot://'
+
+    def __init__(self, source_url, refresh_interval, settings=None):
+        # Relative path, tweak slightly so urlparse will parse it correctly
+        if (source_url.startswith(self.scheme)
+                and source_url[len(self.scheme)] != '/'):
+            source_url = source_url[len(self.scheme):]
+
+        super(SnapshotSource, self).__init__(source_url, refresh_interval,
+                                             settings)
+
+    @property
+    def shared_dir(self):
+        # Already shared by every process mapping the same snapshot file
+        return None
+
+    def load(self):
+        if not os.path.exists(self.url.path):
+            self.no_data = True
+            raise NoDataError('Known list, no snapshot found: "%s"'
+                              % self.url.path)
+
+        with open(self.url.path, 'rb') as f:
+            self._populate_chunks(f, parse_snapshot)
         self.no_data = False
 
 
@@ -136,42 +391,71 @@ class S3FileSource(Source):
     Loads chunks from a single file in S3 in the on-the-wire format
     """
 
-    def __init__(self, source_url, refresh_interval):
-        super(S3FileSource, self).__init__(source_url, refresh_interval)
+    def __init__(self, source_url, refresh_interval, settings=None):
+        source_url = self.normalize_url(source_url)
+        super(S3FileSource, self).__init__(source_url, refresh_interval,
+                                           settings)
         self.current_etag = None
+        # Response and ETag opened by needs_refresh() for load() to parse
+        self._opened = None
+        self.key_name = self.s3_location(source_url)[1]
+
+    @classmethod
+    def normalize_url(cls, source_url):
+        return source_url
+
+    @classmethod
+    def s3_location(cls, source_url):
+        "Returns the names of the bucket and key source_url loads from"
+        url = urlparse(cls.normalize_url(source_url))
         # eliminate preceding slashes in the S3 key name
-        elems = list(posixpath.split(posixpath.normpath(self.url.path)))
+        elems = list(posixpath.split(posixpath.normpath(url.path)))
         while '/' == elems[0]:
             elems.pop(0)
-        self.key_name = posixpath.join(*elems)
-
-    def _get_key(self):
+        return url.netloc, posixpath.join(*elems)
+
+    def _missing_key(self):
+        return NoDataError('No chunk file found at "%s"' % self.source_url)
+
+    def _open(self, etag=None):
+        """
+        Opens the key for reading unless its ETag is still etag.  Returns a
+        file alike object streaming the contents and their ETag, None if the
+        key didn't change.
+        """
+        s3 = get_s3_client()
         try:
-            conn = S3Connection()
-            bucket = conn.get_bucket(self.url.netloc)
+            s3.get_bucket(self.url.netloc)
+            return s3.open(self.url.netloc, self.key_name, etag=etag)
         except S3ResponseError as e:
+            if e.status == 404 and e.error_code != 'NoSuchBucket':
+                self.no_data = True
+                raise self._missing_key()
             raise NoDataError("Could not find bucket \"%s\": %s"
                               % (self.url.netloc, e))
-        return bucket.get_key(self.key_name)
 
-    def load(self):
-        s3key = self._get_key()
-        if not s3key:
-            self.no_data = True
-            raise NoDataError('No chunk file found at "%s"' % self.source_url)
+    def _take_opened(self):
+        opened, self._opened = self._opened, None
+        if opened is None:
+            opened = self._open()
+        return opened
 
-        with tempfile.TemporaryFile() as fp:
-            s3key.get_contents_to_file(fp)
-            # Need to forcibly reset to the beginning of the file
-            fp.seek(0)
+    def load(self):
+        # Parsed as it's read off the response, nothing goes through the disk
+        fp, etag = self._take_opened()
+        with fp:
             self._populate_chunks(fp, parse_file_source)
-            self.current_etag = s3key.etag
+            self.current_etag = etag
         self.no_data = False
 
     def needs_refresh(self):
-        s3key = self._get_key()
-        if s3key.etag == self.current_etag:
+        # A conditional GET both checks for and downloads a new version
+        opened = self._open(self.current_etag)
+        if opened is None:
             return False
+        if self._opened is not None:
+            self._opened[0].close()
+        self._opened = opened
         return True
 
 
@@ -179,52 +463,80 @@ class S3DirectorySource(S3FileSource):
 
     index_name = 'index.json'
 
-    def __init__(self, source_url, refresh_interval):
-        if (source_url[-1] == '/'
-                or source_url[-len(self.index_name):] != self.index_name):
-            source_url = posixpath.join(source_url, self.index_name)
+    def __init__(self, source_url, refresh_interval, settings=None):
         super(S3DirectorySource, self).__init__(source_url,
-                                                refresh_interval)
+                                                refresh_interval, settings)
+        # ETag and chunks of every chunk file loaded so reloads only fetch
+        # and parse the ones that changed
+        self.loaded_chunk_files = {}
+
+    @classmethod
+    def normalize_url(cls, source_url):
+        if (source_url[-1] == '/'
+                or source_url[-len(cls.index_name):] != cls.index_name):
+            source_url = posixpath.join(source_url, cls.index_name)
+        return source_url
+
+    @property
+    def load_workers(self):
+        # Fetching chunk files is all waiting on S3, overlap those by default
+        return int(self.settings.get('load_workers',
+                                     DEFAULT_S3_LOAD_WORKERS))
+
+    def _missing_key(self):
+        return NoDataError('No index file found at "%s"' % self.source_url)
 
     def load(self):
-        # for the closures to minimize the number of connections to S3
-        conn = S3Connection()
+        s3 = get_s3_client()
 
         try:
-            bucket = conn.get_bucket(self.url.netloc)
+            s3.get_bucket(self.url.netloc)
         except S3ResponseError as e:
             if e.status == 404:
                 raise NoDataError("No such bucket \"{0}\""
                                   .format(self.url.netloc))
 
+        opened, etag = self._take_opened()
+        # The index is small, read it in and free the connection for the
+        # listing and the chunk files
+        with opened:
+            fp = io.BytesIO(opened.read())
+
+        # One listing tells which chunk files exist and, by their ETags,
+        # which changed since the last load instead of a HEAD request each
+        dirname = posixpath.dirname(self.url.path)
+        prefix = dirname.strip('/')
+        if prefix:
+            prefix += '/'
+        listing = {key.name.lstrip('/'): key
+                   for key in s3.list(self.url.netloc, prefix=prefix)}
+
         def s3exists(path):
             # Construct the path to the key
-            key = posixpath.join(posixpath.dirname(self.url.path), path)
-            return bucket.get_key(key)
+            key = posixpath.join(dirname, path)
+            return listing.get(key.lstrip('/'))
 
-        def s3open(path, mode):
+        def s3etag(path):
             key = s3exists(path)
-            fp = tempfile.TemporaryFile()
-            key.get_contents_to_file(fp)
+            return key.etag if key else None
+
+        def s3open(path, mode):
+            # Chunk files are small enough to be buffered in memory
+            fp = io.BytesIO()
+            s3.fetch(s3exists(path), fp)
             fp.seek(0)
             return fp
 
-        s3key = self._get_key()
-
-        if not s3key:
-            self.no_data = True
-            raise NoDataError('No index file found at "%s"'
-                              % posixpath.join(self.source_url))
-
-        with tempfile.TemporaryFile() as fp:
-            s3key.get_contents_to_file(fp)
-            fp.seek(0)
+        with fp:
             try:
                 self._populate_chunks(fp, parse_dir_source,
                                       exists_cb=s3exists,
-                                      open_cb=s3open)
+                                      open_cb=s3open,
+                                      workers=self.load_workers,
+                                      loaded=self.loaded_chunk_files,
+                                      fingerprint_cb=s3etag)
             except ParseError as e:
                 raise NoDataError("Parsing failure: {0}".format(str(e)))
 
-            self.current_etag = s3key.etag
+            self.current_etag = etag
         self.no_data = False
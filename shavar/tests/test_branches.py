@@ -0,0 +1,109 @@
+import http.server
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from shavar.branches import BranchDiscovery
+from shavar.tests.base import ShavarTestCase
+
+
+class StubGitHubHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.headers.get('If-None-Match'))
+        if server.delay:
+            time.sleep(server.delay)
+        if server.status != 200:
+            body = b''
+            self.send_response(server.status)
+        elif self.headers.get('If-None-Match') == server.etag:
+            body = b''
+            self.send_response(304)
+        else:
+            body = json.dumps(server.branches).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', server.etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class BranchDiscoveryTest(ShavarTestCase):
+
+    def setUp(self):
+        super(BranchDiscoveryTest, self).setUp()
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      StubGitHubHandler)
+        self.server.daemon_threads = True
+        self.server.requests = []
+        self.server.delay = 0
+        self.server.status = 200
+        self.server.etag = '"v1"'
+        self.server.branches = [{'name': '69.0'}, {'name': 'main'}]
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.url = 'http://127.0.0.1:%d/branches' % self.server.server_port
+        self.tmp = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.tmp, 'branches.json')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+        super(BranchDiscoveryTest, self).tearDown()
+
+    def discovery(self, **kwargs):
+        kwargs.setdefault('cache_path', self.cache_path)
+        return BranchDiscovery(self.url, **kwargs)
+
+    def test_ttl(self):
+        d = self.discovery()
+        for _ in range(3):
+            self.assertEqual(d.get_branches(), self.server.branches)
+        self.assertEqual(self.server.requests, [None])
+
+    def test_conditional_request(self):
+        d = self.discovery(ttl=0)
+        branches = d.get_branches()
+        self.assertEqual(d.get_branches(), branches)
+        self.assertEqual(self.server.requests, [None, '"v1"'])
+        self.server.etag = '"v2"'
+        self.server.branches = [{'name': '70.0'}]
+        self.assertEqual(d.get_branches(), [{'name': '70.0'}])
+
+    def test_persisted(self):
+        self.discovery().get_branches()
+        # A restart within the TTL doesn't ask GitHub again
+        self.assertEqual(self.discovery().get_branches(),
+                         self.server.branches)
+        self.assertEqual(len(self.server.requests), 1)
+        # Past it, the persisted ETag is revalidated
+        self.assertEqual(self.discovery(ttl=0).get_branches(),
+                         self.server.branches)
+        self.assertEqual(self.server.requests, [None, '"v1"'])
+
+    def test_fallback(self):
+        self.discovery().get_branches()
+        self.server.status = 500
+        self.assertEqual(self.discovery(ttl=0).get_branches(),
+                         self.server.branches)
+        # Nothing known at all, no versioned lists
+        self.assertEqual(self.discovery(cache_path=None).get_branches(), [])
+
+    def test_timeout(self):
+        self.discovery().get_branches()
+        self.server.delay = 1
+        start = time.time()
+        d = self.discovery(ttl=0, timeout=0.1)
+        self.assertEqual(d.get_branches(), self.server.branches)
+        self.assertLess(time.time() - start, 1)
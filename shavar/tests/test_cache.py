@@ -0,0 +1,58 @@
+from unittest import mock
+
+from pyramid import testing
+
+from shavar.cache import LRUCache
+from shavar.metrics import report_background_metrics
+from shavar.tests.base import ShavarTestCase
+
+
+class LRUCacheTest(ShavarTestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        # Touch 'a' so 'b' is the least recently used entry
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.get('b', 'nope'), 'nope')
+        self.assertEqual((cache.hits, cache.misses, cache.evictions),
+                         (1, 1, 1))
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_disabled(self):
+        cache = LRUCache('0')
+        cache.put('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+    def test_metrics(self):
+        request = testing.DummyRequest()
+        request.metrics = {}
+        cache = LRUCache(1, metrics_prefix='test.cache')
+        self.config.begin(request=request)
+        try:
+            cache.get('a')
+            cache.put('a', 1)
+            cache.get('a')
+            cache.put('b', 2)
+        finally:
+            self.config.end()
+        self.assertEqual(request.metrics, {'test.cache.miss': 1,
+                                           'test.cache.hit': 1,
+                                           'test.cache.eviction': 1})
+
+    def test_background_metrics(self):
+        # Whatever earlier tests counted outside of requests
+        report_background_metrics()
+        cache = LRUCache(1, metrics_prefix='test.cache')
+        cache.get('a')
+        cache.get('a')
+        with mock.patch('shavar.metrics.logger') as logger:
+            self.assertEqual(report_background_metrics(),
+                             {'test.cache.miss': 2})
+            self.assertEqual(report_background_metrics(), {})
+        self.assertEqual(logger.info.call_count, 1)
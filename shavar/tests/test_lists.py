@@ -1,20 +1,32 @@
 import os
 import posixpath
 import responses
+import shutil
+import tempfile
+from types import SimpleNamespace
+from unittest import mock
 
 import boto
 from boto.s3.key import Key
 from moto import mock_s3_deprecated as mock_s3
 
+from shavar import refresh_lists_data, RefreshThreadsStarter
 from shavar.exceptions import MissingListDataError
 from shavar.lists import (
     add_versioned_lists_to_registry,
     get_list,
+    get_serving_state,
+    includeme,
+    load_list,
     lookup_prefixes,
     Digest256,
     match_with_versioned_list,
-    get_versioned_list_name
+    get_versioned_list_name,
+    S3VersionListings,
+    ServingState
 )
+from shavar.s3 import get_s3_client
+from shavar.types import Chunk, ChunkList
 from shavar.tests.base import dummy, hashes, ShavarTestCase, test_file
 
 
@@ -93,6 +105,121 @@ class ListsTest(ShavarTestCase):
             ('71.0-mozpub-track-digest256', '71.0')
         )
 
+    def test_11_serving_state(self):
+        dumdum = dummy(body='4:4\n%s' % self.hg[:4], path='/gethash')
+        state = get_serving_state(dumdum)
+        self.assertEqual(list(state.sorted_names), sorted(state.serving))
+        self.assertEqual(state.list_names_set, set(state.list_names))
+        self.assertIs(state, dumdum.registry['shavar.serving_state'])
+        with self.assertRaises(TypeError):
+            state.serving['a'] = None
+        # A config refresh mid request doesn't show in it
+        sblist, _ = get_list(dumdum, 'mozpub-track-digest256')
+        dumdum.registry['shavar.serving_state'] = ServingState({}, {}, [])
+        self.assertIs(get_serving_state(dumdum), state)
+        self.assertIs(get_list(dumdum, 'mozpub-track-digest256')[0], sblist)
+        self.assertRaises(MissingListDataError, get_list,
+                          dummy(body=''), 'mozpub-track-digest256')
+
+    def test_12_gethash_index(self):
+        dumdum = dummy(body='4:4\n%s' % self.hg[:4], path='/gethash')
+        state = get_serving_state(dumdum)
+        prefixes = [self.hg[:4], self.hm, hashes['hub'][:4], self.hg[:2]]
+
+        def search_lists():
+            found = {}
+            for name, sblist in state.serving.items():
+                for prefix in prefixes:
+                    for chunk in sblist.find_prefix(prefix):
+                        found.setdefault(name, {}).setdefault(
+                            chunk.number, []).extend(
+                                chunk.get_hashes(prefix))
+            return found
+        self.assertEqual(lookup_prefixes(dumdum, prefixes), search_lists())
+
+        # Reloaded lists are searched one by one until they're indexed
+        # again, off the request path and in a layer of their own
+        abp = state.serving['moz-abp-shavar']
+        track = state.serving['mozpub-track-digest256']
+        index = state.gethash_index
+        before = index.generation
+        abp._source._publish(ChunkList(add_chunks=[
+            Chunk(number=21, hashes=[hashes['hub']], hash_size=32)]))
+        with mock.patch.object(index, '_update_in_background') as update:
+            found = lookup_prefixes(dumdum, prefixes)
+        update.assert_called_once_with()
+        self.assertIs(index.generation, before)
+        self.assertEqual(found, search_lists())
+        self.assertEqual(found['moz-abp-shavar'], {21: [hashes['hub']]})
+        lookup_prefixes(dumdum, prefixes)
+        with index._lock:
+            # Waits for the update
+            pass
+        self.assertIs(index.generation.base, before)
+        self.assertEqual(index.generation.names, ('moz-abp-shavar',))
+        self.assertEqual(lookup_prefixes(dumdum, prefixes), found)
+        # Only keys and references to the chunks are kept
+        keys, starts, refs = index.generation.tables[4]
+        self.assertEqual((keys, list(refs)), (hashes['hub'][:4], [0]))
+        self.assertEqual(index.generation.refs, (('moz-abp-shavar', 21),))
+
+        # A reload only has the chunks it changed indexed again and longer
+        # prefixes are confirmed past the key in the chunks
+        chunks = track._source.data.chunks
+        near_miss = self.hm[:4] + bytes(28)
+        track._source._publish(ChunkList(
+            add_chunks=list(chunks.adds.values()) + [
+                Chunk(number=99, hashes=[near_miss], hash_size=32)],
+            sub_chunks=list(chunks.subs.values())))
+        index.update()
+        self.assertEqual(index.generation.names, ('mozpub-track-digest256',))
+        keys, starts, refs = index.generation.tables[32]
+        self.assertEqual(keys, self.hm[:4])
+        self.assertEqual(index.generation.refs,
+                         (('mozpub-track-digest256', 99),))
+        self.assertEqual(index.generation.removed, frozenset())
+        self.assertEqual(lookup_prefixes(dumdum, prefixes), found)
+        self.assertEqual(lookup_prefixes(dumdum, [near_miss]),
+                         {'mozpub-track-digest256': {99: [near_miss]}})
+
+        # Versioned lists can be left out
+        serving = dict(state.serving)
+        serving['69.0-mozpub-track-digest256'] = track
+        versioned = {'mozpub-track-digest256': ['69.0']}
+        self.assertIn('69.0-mozpub-track-digest256', ServingState(
+            serving, versioned, [], previous=state).gethash_index.lookup(
+                [self.hm]))
+        without = ServingState(serving, versioned, [],
+                               gethash_versioned_lists=False, previous=state)
+        self.assertEqual(without.gethash_index.lookup([self.hm]),
+                         lookup_prefixes(dumdum, [self.hm]))
+        # Lists gone from a new state are dropped from its index
+        self.assertEqual(ServingState({}, {}, [], previous=state)
+                         .gethash_index.lookup(prefixes), {})
+        self.assertEqual(lookup_prefixes(dumdum, prefixes), found)
+
+    def test_13_gethash_prefix_cache(self):
+        dumdum = dummy(body='4:4\n%s' % self.hg[:4], path='/gethash')
+        previous = get_serving_state(dumdum)
+        state = ServingState(previous.serving, previous.versioned_lists,
+                             previous.list_names, previous=previous,
+                             prefix_cache_size=1)
+        index = state.gethash_index
+        found = index.lookup([self.hm])
+        self.assertIn('mozpub-track-digest256', found)
+        self.assertEqual(index.lookup([self.hm]), found)
+        self.assertEqual(index.lookup([bytes(32)]), {})
+        self.assertEqual((index.cache.hits, index.cache.misses,
+                          index.cache.evictions), (1, 2, 1))
+        # A new generation starts over with an empty cache
+        abp = state.serving['moz-abp-shavar']
+        abp._source._publish(ChunkList(add_chunks=[
+            Chunk(number=21, hashes=[hashes['hub']], hash_size=32)]))
+        index.update()
+        self.assertEqual(len(index.cache), 0)
+        self.assertEqual(index.lookup([hashes['hub'][:4]]),
+                         {'moz-abp-shavar': {21: [hashes['hub']]}})
+
 
 class AddVersionedListsTest(ShavarTestCase):
 
@@ -193,7 +320,7 @@ class AddVersionedListsTest(ShavarTestCase):
             'redirect_url_base': 'https://tracking.services.mozilla.com/',
         }
         serving = {
-            list_name: dummy(body='').registry['shavar.serving'][list_name],
+            list_name: get_serving_state(dummy(body='')).serving[list_name],
         }
         ver_lists = {
             list_name: [],
@@ -216,7 +343,7 @@ class AddVersionedListsTest(ShavarTestCase):
             'redirect_url_base': 'https://tracking.services.mozilla.com/',
         }
         serving = {
-            list_name: dummy(body='').registry['shavar.serving'][list_name],
+            list_name: get_serving_state(dummy(body='')).serving[list_name],
         }
         ver_lists = {
             list_name: [],
@@ -231,6 +358,133 @@ class AddVersionedListsTest(ShavarTestCase):
         self.assertIn('69.0-' + list_name, serving)
         self.assertNotIn('68.0-' + list_name, serving)
 
+    def test_3_versions_discovered_by_listing(self):
+        list_name = 'test-track-digest256'
+        settings = {
+            'type': 'digest256',
+            'source': 's3+file://tracking/delta_chunk_source',
+            'redirect_url_base': 'https://tracking.services.mozilla.com/',
+        }
+        serving = {}
+        ver_lists = {list_name: []}
+        listings = S3VersionListings()
+        s3 = get_s3_client()
+        lists = s3.round_trips['list']
+        with mock.patch('shavar.lists.load_list', wraps=load_list) as load:
+            for _ in range(2):
+                add_versioned_lists_to_registry(
+                    settings, serving, ver_lists, 'digest256', list_name,
+                    [{'name': '67.0'}, {'name': '68.0'}, {'name': '69.0'}],
+                    listings=listings
+                )
+        self.assertEqual(ver_lists[list_name], ['69.0', '69.0'])
+        self.assertEqual(list(serving), ['69.0-' + list_name])
+        # The missing versions were never attempted, one listing told
+        self.assertEqual(
+            [c[0][2]['source'] for c in load.call_args_list],
+            ['s3+file://tracking/69.0/delta_chunk_source'] * 2)
+        self.assertEqual(s3.round_trips['list'] - lists, 1)
+        self.assertEqual(list(listings.listings), [('tracking', '')])
+        # Sources elsewhere are loaded to tell as they used to
+        self.assertIsNone(listings.available(
+            's3+dir://pickle-farthing/testpub-bananas-digest256/', ['69.0']))
+        self.assertIsNone(listings.available(
+            'dir://tracking/list', ['69.0']))
+
+
+class Registry(dict):
+
+    def __init__(self, settings):
+        super(Registry, self).__init__()
+        self.settings = settings
+
+
+class ParallelLoadTest(ShavarTestCase):
+
+    branches = [{'name': '69.0'}, {'name': 'main'}, {'name': '70.0'}]
+
+    def setUp(self):
+        super(ParallelLoadTest, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        os.mkdir(os.path.join(self.root, 'lists'))
+        versions = {'a-track-digest256': ('69.0', '70.0'),
+                    'b-track-digest256': (),
+                    'c-track-digest256': ('70.0',)}
+        for list_name, list_versions in versions.items():
+            for path in ('tracking',) + tuple(
+                    'tracking/' + v for v in list_versions):
+                shutil.copytree(test_file('delta_dir_source'),
+                                os.path.join(self.root, path, list_name))
+            self.write_config(list_name)
+
+    def write_config(self, list_name, extra=''):
+        with open(os.path.join(self.root, 'lists', list_name + '.ini'),
+                  'w') as f:
+            f.write('[%s]\ntype = digest256\nversioned = true\n'
+                    'source = dir://%s/tracking/%s\n%s'
+                    % (list_name, os.path.relpath(self.root), list_name,
+                       extra))
+
+    def load(self, workers, registry=None):
+        if registry is None:
+            registry = Registry({
+                'shavar.lists_served': 'dir://%s/lists' % self.root,
+                'shavar.list_load_workers': workers})
+            registry['shavar.branch_discovery'] = mock.Mock(**{
+                'get_branches.return_value': self.branches})
+        includeme(SimpleNamespace(registry=registry, filename=None))
+        return registry
+
+    def test_same_as_serial(self):
+        serial = self.load(1)['shavar.serving_state']
+        parallel = self.load(4)['shavar.serving_state']
+        self.assertEqual(sorted(parallel.serving),
+                         ['69.0-a-track-digest256', '70.0-a-track-digest256',
+                          '70.0-c-track-digest256', 'a-track-digest256',
+                          'b-track-digest256', 'c-track-digest256'])
+        for state in (serial, parallel):
+            versioned = state.versioned_lists
+            self.assertEqual(versioned['a-track-digest256'], ('69.0', '70.0'))
+            self.assertEqual(versioned['c-track-digest256'], ('70.0',))
+        self.assertEqual(list(parallel.versioned_lists.items()),
+                         list(serial.versioned_lists.items()))
+        self.assertEqual(
+            [(name, sblist._source.source_url, sblist._source.chunks)
+             for name, sblist in parallel.serving.items()],
+            [(name, sblist._source.source_url, sblist._source.chunks)
+             for name, sblist in serial.serving.items()])
+
+    def test_config_refresh(self):
+        registry = self.load(4)
+        before = dict(registry['shavar.serving_state'].serving)
+        self.load(4, registry)
+        self.assertEqual(registry['shavar.serving_state'].serving, before)
+        for name, sblist in registry['shavar.serving_state'].serving.items():
+            self.assertIs(sblist, before[name])
+
+        # Changed, removed and added lists
+        self.write_config('a-track-digest256', 'delta_cache_size = 10\n')
+        os.unlink(os.path.join(self.root, 'lists', 'c-track-digest256.ini'))
+        shutil.copytree(test_file('delta_dir_source'),
+                        os.path.join(self.root, 'tracking',
+                                     'd-track-digest256'))
+        self.write_config('d-track-digest256')
+        self.load(4, registry)
+        serving = registry['shavar.serving_state'].serving
+        self.assertEqual(sorted(serving),
+                         ['69.0-a-track-digest256', '70.0-a-track-digest256',
+                          'a-track-digest256', 'b-track-digest256',
+                          'd-track-digest256'])
+        self.assertIs(serving['b-track-digest256'],
+                      before['b-track-digest256'])
+        for name in ('a-track-digest256', '69.0-a-track-digest256',
+                     '70.0-a-track-digest256'):
+            self.assertIsNot(serving[name], before[name])
+            self.assertEqual(serving[name].settings['delta_cache_size'], '10')
+        self.assertEqual(serving['d-track-digest256']._source.chunks,
+                         serving['b-track-digest256']._source.chunks)
+
 
 class DeltaListsTest(ShavarTestCase):
 
@@ -341,7 +595,34 @@ class DataRefreshTest(ShavarTestCase):
         dumdum = dummy(body='4:4\n%s' % self.hg[:4], path='/gethash')
         d = dumdum.registry.settings.get('shavar.refresh_check_interval')
         self.assertEqual(d, 29)
-        abp = dumdum.registry['shavar.serving']['moz-abp-shavar']
+        abp = get_serving_state(dumdum).serving['moz-abp-shavar']
         self.assertEqual(abp._source.interval, 29)
-        track = dumdum.registry['shavar.serving']['mozpub-track-digest256']
+        track = get_serving_state(dumdum).serving['mozpub-track-digest256']
         self.assertEqual(track._source.interval, 23)
+
+    def test_6_background_data_refresh(self):
+        dumdum = dummy(body='4:4\n%s' % self.hg[:4], path='/gethash')
+        serving = get_serving_state(dumdum).serving
+        abp = serving['moz-abp-shavar']
+        track = serving['mozpub-track-digest256']
+        with mock.patch.object(abp, 'refresh',
+                               side_effect=IOError('S3 is down')), \
+                mock.patch.object(track, 'refresh') as track_refresh:
+            # A failing list doesn't keep the others from being refreshed
+            refresh_lists_data(dumdum)
+        track_refresh.assert_called_once_with()
+
+    def test_7_refresh_threads_per_process(self):
+        starter = RefreshThreadsStarter(self.config)
+        with mock.patch('shavar.start_refresh_threads',
+                        side_effect=lambda config: [config]) as start, \
+                mock.patch('os.getpid', return_value=100):
+            starter(None)
+            starter(None)
+            self.assertEqual(start.call_count, 1)
+            self.assertEqual(starter.threads, [self.config])
+            # A worker forked after the first request starts its own
+            os.getpid.return_value = 101
+            starter(None)
+            starter(None)
+        self.assertEqual(start.call_count, 2)
@@ -4,8 +4,10 @@ from shavar.exceptions import ParseError
 from shavar.parse import (
     parse_downloads,
     parse_gethash,
+    parse_buffer_source,
     parse_file_source,
-    parse_dir_source)
+    parse_dir_source,
+    _process_pool)
 from shavar.types import (
     Chunk,
     ChunkList,
@@ -140,6 +142,40 @@ class ParseTest(ShavarTestCase):
         self.assertRaises(ParseError, parse_downloads,
                           dummy("mozpub-track-digest256"))
 
+        for body in ("mozpub-track-digest256;a:1,x",
+                     "mozpub-track-digest256;a:1,,2",
+                     "mozpub-track-digest256;a:5-3",
+                     "mozpub-track-digest256;a:-3",
+                     # Chunk numbers are plain ASCII digits, nothing else
+                     # int() would take
+                     "mozpub-track-digest256;a:1_000",
+                     "mozpub-track-digest256;a: 12",
+                     "mozpub-track-digest256;a:+5",
+                     "mozpub-track-digest256;a:1,+5",
+                     "mozpub-track-digest256;a:1_0-20",
+                     "mozpub-track-digest256;a:1-+5",
+                     "mozpub-track-digest256;a:1- 5",
+                     "mozpub-track-digest256;a:\u0661\u0662",
+                     "mozpub-track-digest256;x:1",
+                     "mozpub-track-digest256;a:1:s",
+                     "mozpub-track-digest256;\ns;200",
+                     "s;lots\nmozpub-track-digest256;",
+                     ";a:1"):
+            self.assertRaises(ParseError, parse_downloads, dummy(body))
+        self.assertRaises(ParseError, parse_downloads,
+                          dummy("mozpub-track-digest256;a:1:mac", pver="3.0"))
+
+    def test_parse_download_large_claims(self):
+        # Claims are kept as ranges so wide ranges and many single chunks
+        # are both cheap and still limited by max_downloads_chunks
+        body = "mozpub-track-digest256;a:%s:s:1-999" % ','.join(
+            str(n) for n in range(1, 2000, 2))
+        p = parse_downloads(dummy(body))
+        self.assertEqual(len(p[0].adds), 1000)
+        self.assertEqual(p[0].subs.ranges(), [(1, 999)])
+        self.assertRaises(LimitExceededError, parse_downloads,
+                          dummy(body + ",1000-1001"))
+
     def test_parse_gethash(self):
         h = b"4:32\n"
         d = (b"\xdd\x01J\xf5",
@@ -161,6 +197,11 @@ class ParseTest(ShavarTestCase):
         s = b"4:4\n\xdd\x01J\xf5"
         p = parse_gethash(dummy(s, path="/gethash"))
         self.assertEqual(p, set([b"\xdd\x01J\xf5"]))
+        # Repeated prefixes collapse and bytes past the claimed payload are
+        # ignored
+        s = b"4:12\n\xdd\x01J\xf5AaN\xaf\xdd\x01J\xf5\x00\x00"
+        p = parse_gethash(dummy(s, path="/gethash"))
+        self.assertEqual(p, set([b"\xdd\x01J\xf5", b"AaN\xaf"]))
 
     def test_parse_gethash_errors(self):
         # Too short
@@ -236,6 +277,20 @@ class ParseTest(ShavarTestCase):
         p = parse_file_source(open(test_file('delta_chunk_source'), 'rb'))
         self.assertEqual(p, DELTA_RESULT)
 
+    def test_parse_file_source_mmap(self):
+        with open(test_file('delta_chunk_source'), 'rb') as f:
+            p = parse_file_source(f, use_mmap=True)
+        self.assertEqual(p, DELTA_RESULT)
+        # Sorted hashes are served straight from the mapping
+        d = b''.join(sorted([self.hm, self.hg]))
+        buf = b"\na:17:32:%d\n%s\n" % (len(d), d)
+        p = parse_buffer_source(buf)
+        self.assertIs(p.adds[17]._data, buf)
+        self.assertEqual(p.adds[17].data, d)
+        self.assertEqual(p.adds[17].hashes, set([self.hm, self.hg]))
+        self.assertRaises(ParseError, parse_buffer_source, buf[:-10])
+        self.assertRaises(ParseError, parse_buffer_source, b"a:17:32:5\n")
+
     def test_parse_file_source_errors(self):
         pass
 
@@ -247,3 +302,30 @@ class ParseTest(ShavarTestCase):
         # Test with the use of basedir
         p = parse_dir_source(open(test_file('index.json')))
         self.assertEqual(p, DELTA_RESULT)
+        p = parse_dir_source(
+            open(test_file('delta_dir_source/index.json'), 'rb'),
+            use_mmap=True
+        )
+        self.assertEqual(p, DELTA_RESULT)
+
+    def test_parse_dir_source_workers(self):
+        for processes in (False, True):
+            p = parse_dir_source(
+                open(test_file('delta_dir_source/index.json'), 'rb'),
+                workers=3, processes=processes
+            )
+            self.assertEqual(p, DELTA_RESULT)
+        # The worker processes outlive a load, for the next one
+        self.assertIs(_process_pool(3), _process_pool(3))
+        # The first broken chunk in index order is the one reported, like
+        # when loading them one at a time
+        for workers in (1, 3):
+            with self.assertRaises(ParseError) as ecm:
+                parse_dir_source(
+                    open(test_file('delta_dir_source/index.json'), 'rb'),
+                    exists_cb=lambda path: path[-1] not in '46',
+                    workers=workers
+                )
+            self.assertEqual(str(ecm.exception),
+                             'Invalid chunk filename: "%s"'
+                             % test_file('delta_dir_source/4'))
@@ -0,0 +1,214 @@
+import io
+import os
+import shutil
+import tempfile
+import threading
+from unittest import mock
+
+import boto
+from boto.exception import S3ResponseError
+from boto.s3.key import Key
+from moto import mock_s3_deprecated as mock_s3
+
+from shavar.metrics import report_background_metrics
+from shavar.s3 import S3Client, S3DiskCache, get_s3_client
+from shavar.tests.base import ShavarTestCase
+
+
+class S3ClientTest(ShavarTestCase):
+
+    bucket_name = 'wheelie-bin'
+
+    def setUp(self):
+        super(S3ClientTest, self).setUp()
+        self.mock = mock_s3()
+        self.mock.start()
+        bucket = boto.connect_s3().create_bucket(self.bucket_name)
+        k = Key(bucket)
+        k.name = 'lists/list.ini'
+        k.set_contents_from_string('[list]\n')
+        self.s3 = S3Client()
+
+    def tearDown(self):
+        self.mock.stop()
+        super(S3ClientTest, self).tearDown()
+
+    def test_shared_client(self):
+        self.assertIs(get_s3_client(), get_s3_client())
+
+    def test_bucket_looked_up_once(self):
+        for _ in range(3):
+            key = self.s3.get_key(self.bucket_name, 'lists/list.ini')
+        self.assertEqual(key.name, 'lists/list.ini')
+        self.assertEqual(self.s3.round_trips['connect'], 1)
+        self.assertEqual(self.s3.round_trips['get_bucket'], 1)
+        self.assertEqual(self.s3.round_trips['get_key'], 3)
+        self.assertRaises(S3ResponseError, self.s3.get_bucket, 'no-bukkit')
+
+    def test_background_metrics(self):
+        # Whatever earlier tests counted outside of requests
+        report_background_metrics()
+        # e.g. a load thread
+        thread = threading.Thread(target=self.s3.get_key, args=(
+            self.bucket_name, 'lists/list.ini'))
+        thread.start()
+        thread.join()
+        metrics = report_background_metrics()
+        self.assertEqual(metrics['shavar.s3.connect'], 1)
+        self.assertEqual(metrics['shavar.s3.get_key'], 1)
+
+    def test_list_and_fetch(self):
+        keys = self.s3.list(self.bucket_name, prefix='lists/')
+        self.assertEqual([k.name for k in keys], ['lists/list.ini'])
+        self.assertEqual(self.s3.list(self.bucket_name, prefix='nope/'), [])
+        fp = io.BytesIO()
+        self.s3.fetch(keys[0], fp)
+        self.assertEqual(fp.getvalue(), b'[list]\n')
+        self.assertEqual(self.s3.round_trips['list'], 2)
+        self.assertEqual(self.s3.round_trips['get'], 1)
+
+    def test_missing_key_checks_bucket(self):
+        self.s3.get_bucket(self.bucket_name)
+        self.assertIsNone(self.s3.get_key(self.bucket_name, 'nope'))
+        self.assertEqual(self.s3.round_trips['get_bucket'], 2)
+        # The bucket going away is noticed even though it was looked up
+        bucket = boto.connect_s3().get_bucket(self.bucket_name)
+        for key in bucket.list():
+            key.delete()
+        bucket.delete()
+        self.assertRaises(S3ResponseError, self.s3.get_key,
+                          self.bucket_name, 'lists/list.ini')
+
+    def test_connection_pool(self):
+        # Connections outlive the threads that used them
+        for _ in range(3):
+            thread = threading.Thread(target=self.s3.get_key, args=(
+                self.bucket_name, 'lists/list.ini'))
+            thread.start()
+            thread.join()
+        self.assertEqual(self.s3.round_trips['connect'], 1)
+
+        # Concurrent operations get a connection each, pool_size are kept
+        s3 = S3Client(pool_size=1)
+        with s3.connection() as first, s3.connection() as second:
+            self.assertIsNot(first, second)
+        with s3.connection() as conn:
+            self.assertIn(conn, (first, second))
+        self.assertEqual(s3.round_trips['connect'], 2)
+        self.assertEqual(s3._pool.qsize(), 1)
+
+        # Streams hold on to theirs until closed
+        stream, _ = s3.open(self.bucket_name, 'lists/list.ini')
+        self.assertEqual(s3._pool.qsize(), 0)
+        with stream:
+            self.assertEqual(stream.read(), b'[list]\n')
+        self.assertEqual(s3._pool.qsize(), 1)
+        self.assertIsNone(s3.open(self.bucket_name, 'lists/list.ini',
+                                  etag=stream.key.etag))
+        self.assertRaises(S3ResponseError, s3.open, self.bucket_name, 'nope')
+        self.assertEqual(s3._pool.qsize(), 1)
+        self.assertEqual(s3.round_trips['connect'], 2)
+
+    def test_fetch_if_changed(self):
+        fp = io.BytesIO()
+        etag = self.s3.fetch_if_changed(self.bucket_name, 'lists/list.ini',
+                                        fp)
+        self.assertEqual(fp.getvalue(), b'[list]\n')
+        self.assertIsNotNone(etag)
+        # Not sent again if the endpoint ignores If-None-Match, as moto does
+        self.assertIsNone(self.s3.fetch_if_changed(
+            self.bucket_name, 'lists/list.ini', io.BytesIO(), etag=etag))
+        with mock.patch.object(Key, 'open_read', side_effect=(
+                S3ResponseError(304, 'Not Modified'))) as get:
+            self.assertIsNone(self.s3.fetch_if_changed(
+                self.bucket_name, 'lists/list.ini', io.BytesIO(), etag=etag))
+        self.assertEqual(get.call_args[1]['headers'],
+                         {'If-None-Match': etag})
+        self.assertEqual(self.s3.round_trips['get'], 3)
+        self.assertEqual(self.s3.round_trips['not_modified'], 2)
+        with self.assertRaises(S3ResponseError) as ecm:
+            self.s3.fetch_if_changed(self.bucket_name, 'nope', io.BytesIO())
+        self.assertEqual(ecm.exception.error_code, 'NoSuchKey')
+
+
+class S3DiskCacheTest(ShavarTestCase):
+
+    bucket_name = 'wheelie-bin'
+    key_name = 'lists/list.ini'
+
+    def setUp(self):
+        super(S3DiskCacheTest, self).setUp()
+        self.mock = mock_s3()
+        self.mock.start()
+        bucket = boto.connect_s3().create_bucket(self.bucket_name)
+        self.key = Key(bucket)
+        self.key.name = self.key_name
+        self.key.set_contents_from_string('[list]\n')
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = S3DiskCache(self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        self.mock.stop()
+        super(S3DiskCacheTest, self).tearDown()
+
+    def fetch_if_changed(self, s3, etag=None):
+        fp = io.BytesIO()
+        etag = s3.fetch_if_changed(self.bucket_name, self.key_name, fp,
+                                   etag=etag)
+        return etag, fp.getvalue()
+
+    def test_warm_start(self):
+        s3 = S3Client(cache=self.cache)
+        etag, data = self.fetch_if_changed(s3)
+        self.assertEqual(data, b'[list]\n')
+        self.assertEqual(self.cache.latest(self.bucket_name, self.key_name),
+                         etag)
+
+        # A restarted process revalidates its copy rather than download it
+        s3 = S3Client(cache=self.cache)
+        with mock.patch.object(Key, 'open_read', side_effect=(
+                S3ResponseError(304, 'Not Modified'))) as get:
+            self.assertEqual(self.fetch_if_changed(s3),
+                             (etag, b'[list]\n'))
+        self.assertEqual(get.call_args[1]['headers'],
+                         {'If-None-Match': etag})
+        # Known ETags, as from a listing, need no round trip at all
+        fp = io.BytesIO()
+        s3.fetch(s3.list(self.bucket_name)[0], fp)
+        self.assertEqual(fp.getvalue(), b'[list]\n')
+        self.assertEqual(s3.round_trips['get'], 1)
+        self.assertEqual(s3.round_trips['cache_hit'], 2)
+
+    def test_changed(self):
+        s3 = S3Client(cache=self.cache)
+        old_etag, _ = self.fetch_if_changed(s3)
+        self.key.set_contents_from_string('[changed]\n')
+        etag, data = self.fetch_if_changed(S3Client(cache=self.cache))
+        self.assertNotEqual(etag, old_etag)
+        self.assertEqual(data, b'[changed]\n')
+        # Only the latest copy is kept
+        self.assertEqual(self.cache.latest(self.bucket_name, self.key_name),
+                         etag)
+        self.assertIsNone(self.cache.open(self.bucket_name, self.key_name,
+                                          old_etag))
+
+    def test_partial_read(self):
+        stream, etag = S3Client(cache=self.cache).open(self.bucket_name,
+                                                       self.key_name)
+        with stream:
+            self.assertEqual(stream.read(3), b'[li')
+        # Only complete copies make it to the cache
+        self.assertIsNone(self.cache.latest(self.bucket_name, self.key_name))
+        self.assertEqual(os.listdir(os.path.join(self.cache_dir,
+                                                 self.bucket_name,
+                                                 'lists%2Flist.ini')), [])
+
+    def test_unwritable(self):
+        # Can't create directories under a file, even as root
+        path = os.path.join(self.cache_dir, 'file')
+        open(path, 'w').close()
+        cache = S3DiskCache(path)
+        etag, data = self.fetch_if_changed(S3Client(cache=cache))
+        self.assertEqual(data, b'[list]\n')
+        self.assertIsNone(cache.latest(self.bucket_name, self.key_name))
@@ -0,0 +1,75 @@
+import io
+import os
+import shutil
+import tempfile
+
+from shavar.exceptions import ParseError
+from shavar.snapshot import (
+    compile_snapshot,
+    parse_snapshot,
+    write_snapshot)
+from shavar.types import Chunk, ChunkList
+from shavar.tests.base import (
+    DELTA_RESULT,
+    hashes,
+    test_file,
+    ShavarTestCase)
+
+
+class SnapshotTest(ShavarTestCase):
+
+    def setUp(self):
+        super(SnapshotTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'list.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(SnapshotTest, self).tearDown()
+
+    def test_round_trip(self):
+        chunks = ChunkList(add_chunks=[
+            Chunk(number=1, hashes=[hashes['moz'], hashes['goog']]),
+            Chunk(number=2, hashes=[hashes['moz'][:4], hashes['hub'][:4]],
+                  hash_size=4)],
+            sub_chunks=[Chunk(chunk_type='s', number=3,
+                              hashes=[hashes['py']])])
+        with open(self.path, 'wb') as f:
+            write_snapshot(chunks, f, name='test-track-digest256')
+        with open(self.path, 'rb') as f:
+            parsed = parse_snapshot(f)
+        self.assertEqual(parsed, chunks)
+        self.assertTrue(parsed.indexed)
+        self.assertEqual(parsed.find_prefix(hashes['moz'][:4]),
+                         [parsed.adds[1], parsed.adds[2]])
+        self.assertEqual(parsed.find_prefix(hashes['goog']),
+                         [parsed.adds[1]])
+        self.assertEqual(parsed.find_prefix(hashes['py'][:4]), [])
+        self.assertEqual(parsed.adds[1].get_hashes(hashes['goog'][:4]),
+                         [hashes['goog']])
+
+    def test_compile_snapshot(self):
+        compile_snapshot(test_file('delta_dir_source'), self.path)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(parse_snapshot(f), DELTA_RESULT)
+        self.assertEqual(os.listdir(self.tmpdir), ['list.snapshot'])
+
+    def test_parse_snapshot_errors(self):
+        def parse(data):
+            with open(self.path, 'wb') as f:
+                f.write(data)
+            with open(self.path, 'rb') as f:
+                return parse_snapshot(f)
+
+        with self.assertRaises(ParseError) as ecm:
+            parse(b'')
+        self.assertEqual(str(ecm.exception), "Empty snapshot file")
+        with self.assertRaises(ParseError) as ecm:
+            parse(b'a:1:32:32\n' + hashes['moz'])
+        self.assertEqual(str(ecm.exception), "Not a shavar snapshot")
+
+        snapshot = io.BytesIO()
+        write_snapshot(DELTA_RESULT, snapshot)
+        with self.assertRaises(ParseError) as ecm:
+            parse(snapshot.getvalue()[:-8])
+        self.assertEqual(str(ecm.exception), "Snapshot data truncated")
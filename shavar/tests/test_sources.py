@@ -1,19 +1,27 @@
+from hashlib import sha256
+import json
 import os
 import posixpath
+import shutil
 import tempfile
+import threading
 import time
+from unittest import mock
 
 import boto
 from boto.s3.key import Key
 from moto import mock_s3_deprecated as mock_s3
 
 from shavar.exceptions import NoDataError
+from shavar.metrics import report_background_metrics
+from shavar.snapshot import compile_snapshot
 from shavar.sources import (
     DirectorySource,
     FileSource,
     S3DirectorySource,
-    S3FileSource)
-from shavar.types import ChunkList
+    S3FileSource,
+    SnapshotSource)
+from shavar.types import ChunkList, ChunkRanges
 from shavar.tests.base import (
     DELTA_RESULT,
     ShavarTestCase,
@@ -55,6 +63,54 @@ class FileSourceTest(ShavarTestCase):
         os.utime(self.source.name, (times.st_atime, times.st_mtime + 2))
         self.assertTrue(f.needs_refresh())
 
+    def test_background_refresh(self):
+        f = FileSource("file://" + self.source.name, 0,
+                       settings={'background_refresh': 'true'})
+        f.load()
+        data = f.data
+        with open(self.source.name, 'wb') as source:
+            source.write(self.add)
+        times = os.stat(self.source.name)
+        os.utime(self.source.name, (times.st_atime, times.st_mtime + 2))
+        # Requests never refresh, they're served what was loaded last
+        self.assertEqual(f.list_chunks(), (set([17]), set([18])))
+        self.assertEqual(len(f.fetch([17], [18])['subs']), 1)
+        self.assertIs(f.data, data)
+        f.refresh()
+        self.assertIsNot(f.data, data)
+        self.assertEqual(f.list_chunks(), (set([17]), set()))
+        self.assertEqual(f.chunk_ranges['subs'], ChunkRanges())
+
+    def test_refresh_single_flight(self):
+        f = FileSource("file://" + self.source.name, 0)
+        f.load()
+        # Whatever earlier tests counted outside of requests
+        report_background_metrics()
+        checking = threading.Event()
+        release = threading.Event()
+
+        def slow_check():
+            checking.set()
+            release.wait(5)
+            return True
+        with mock.patch.object(f, 'needs_refresh', side_effect=slow_check), \
+                mock.patch.object(f, 'load') as load:
+            thread = threading.Thread(target=f.refresh)
+            thread.start()
+            self.assertTrue(checking.wait(5))
+            # Doesn't wait on nor repeat the reload already in progress
+            self.assertFalse(f.refresh())
+            self.assertEqual(f.list_chunks(), (set([17]), set([18])))
+            release.set()
+            thread.join()
+        self.assertEqual(load.call_count, 1)
+        # Counted without a request, as the background refreshes are.  Both
+        # refresh() and list_chunks() ran into the reload in progress.
+        metrics = report_background_metrics()
+        self.assertEqual(metrics['shavar.refresh.contended'], 2)
+        self.assertEqual(metrics['shavar.refresh.reload'], 1)
+        self.assertIn('shavar.refresh.time', metrics)
+
     def test_list_chunks(self):
         f = FileSource("file://" + self.source.name, 1)
         f.load()
@@ -64,6 +120,13 @@ class FileSourceTest(ShavarTestCase):
         f = FileSource("file://tarantula", 1)
         self.assertRaises(NoDataError, f.load)
 
+    def test_find_prefix(self):
+        f = FileSource("file://" + self.source.name, 1)
+        f.load()
+        found = f.find_prefix(self.hm[:4])
+        self.assertEqual([c.number for c in found], [17])
+        self.assertEqual(f.find_prefix(b'\x00\x00\x00\x00'), ())
+
 #    def test_fetch(self):
 #        vals = {self.hm[:4]: [17], self.hg[:4]: [17]}
 #        f = FileSource("file://" + self.source.name)
@@ -71,6 +134,35 @@ class FileSourceTest(ShavarTestCase):
 #        self.assertEqual(f.fetch([17], [18]), vals)
 
 
+def chunks_by_number(chunk_list):
+    chunks = dict(chunk_list.adds)
+    chunks.update(chunk_list.subs)
+    return chunks
+
+
+def record_gets(gets):
+    "Patches boto to append the name and headers of every GET to gets"
+    open_read = Key.open_read
+
+    def recording_open_read(key, headers=None, *args, **kwargs):
+        # Called again on every read of an opened key
+        if key.resp is None:
+            gets.append((key.name.lstrip('/'), headers))
+        return open_read(key, headers, *args, **kwargs)
+    return mock.patch.object(Key, 'open_read', recording_open_read)
+
+
+def add_chunk(path, number, url):
+    "Adds an add chunk of url to the directory source at path"
+    with open(os.path.join(path, str(number)), 'wb') as f:
+        f.write(b'a:%d:32:32\n' % number + sha256(url).digest())
+    with open(os.path.join(path, 'index.json')) as f:
+        index = json.load(f)
+    index['chunks'][str(number)] = {'path': str(number)}
+    with open(os.path.join(path, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+
 class TestDirectorySource(ShavarTestCase):
 
     def test_load(self):
@@ -91,6 +183,105 @@ class TestDirectorySource(ShavarTestCase):
         d = DirectorySource("dir://tarantula", 1)
         self.assertRaises(NoDataError, d.load)
 
+    def test_incremental_reload(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        for fname in ('index.json', '1', '2', '3', '4', '5', '6'):
+            shutil.copy(test_file(posixpath.join('delta_dir_source', fname)),
+                        path)
+        d = DirectorySource("dir://{0}".format(path), 1)
+        d.load()
+        before = chunks_by_number(d.chunks)
+
+        # Publish chunk 7 and touch chunk 5
+        add_chunk(path, 7, b'https://example.com/')
+        times = os.stat(os.path.join(path, '5'))
+        os.utime(os.path.join(path, '5'),
+                 (times.st_atime, times.st_mtime + 2))
+        d.load()
+        after = chunks_by_number(d.chunks)
+        self.assertEqual(sorted(after), [1, 2, 3, 4, 5, 6, 7])
+        for number in (1, 2, 3, 4, 6):
+            self.assertIs(after[number], before[number])
+        self.assertIsNot(after[5], before[5])
+        self.assertEqual(after[5], before[5])
+        self.assertEqual(
+            d.find_prefix(sha256(b'https://example.com/').digest()[:4]),
+            (after[7],))
+
+    def test_shared(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        shared_dir = os.path.join(path, 'shared')
+        source_dir = os.path.join(path, 'source')
+        shutil.copytree(test_file('delta_dir_source'), source_dir)
+        settings = {'shared_dir': shared_dir}
+        # Two sources of the same list stand in for two worker processes
+        loader = DirectorySource("dir://{0}".format(source_dir), 0,
+                                 settings=settings)
+        loader.load()
+        worker = DirectorySource("dir://{0}".format(source_dir), 0,
+                                 settings=settings)
+        self.assertEqual(loader.chunks, DELTA_RESULT)
+        self.assertEqual(len(os.listdir(shared_dir)), 1)
+        self.assertTrue(loader._shared_loader())
+
+        # The loader publishes a new generation the worker maps
+        add_chunk(source_dir, 7, b'https://example.com/')
+        times = os.stat(loader.url.path)
+        os.utime(loader.url.path, (times.st_atime, int(time.time()) + 2))
+        loader.refresh()
+        with mock.patch.object(worker, 'load') as load:
+            worker.refresh()
+        self.assertFalse(load.called)
+        self.assertFalse(worker.no_data)
+        self.assertEqual(worker.chunks, loader.chunks)
+        self.assertEqual(worker.list_chunks(),
+                         (set([1, 2, 4, 5, 7]), set([3, 6])))
+        self.assertEqual(
+            worker.find_prefix(sha256(b'https://example.com/').digest()[:4]),
+            (worker.chunks.adds[7],))
+        data = worker.data
+        worker.refresh()
+        self.assertIs(worker.data, data)
+
+    def test_delta_cache(self):
+        path = test_file("delta_dir_source")
+        d = DirectorySource("dir://{0}".format(path), 1)
+        d.load()
+        for _ in range(2):
+            self.assertEqual(d.delta(ChunkRanges([1, 2]), ChunkRanges([3])),
+                             ([4, 5], [6]))
+        self.assertEqual(d.delta(ChunkRanges(), ChunkRanges()),
+                         ([1, 2, 4, 5], [3, 6]))
+        self.assertEqual((d.delta_cache.hits, d.delta_cache.misses), (1, 2))
+        d.load()
+        self.assertEqual(len(d.delta_cache), 0)
+
+
+class TestSnapshotSource(ShavarTestCase):
+
+    def setUp(self):
+        super(TestSnapshotSource, self).setUp()
+        self.snapshot = tempfile.NamedTemporaryFile()
+        compile_snapshot(test_file("delta_dir_source"), self.snapshot.name)
+
+    def tearDown(self):
+        self.snapshot.close()
+        super(TestSnapshotSource, self).tearDown()
+
+    def test_load(self):
+        d = SnapshotSource("snapshot://{0}".format(self.snapshot.name), 1)
+        d.load()
+        self.assertEqual(d.chunks, DELTA_RESULT)
+        self.assertEqual(d.list_chunks(), (set([1, 2, 4, 5]), set([3, 6])))
+        self.assertEqual(d.delta(ChunkRanges([1, 2]), ChunkRanges([3])),
+                         ([4, 5], [6]))
+
+    def test_no_data(self):
+        d = SnapshotSource("snapshot://tarantula", 1)
+        self.assertRaises(NoDataError, d.load)
+
 
 class TestS3FileSource(ShavarTestCase):
 
@@ -126,9 +317,18 @@ class TestS3FileSource(ShavarTestCase):
                                                         self.key_name),
                              0.5)
             f.load()
+            self.assertFalse(f.needs_refresh())
+            etag = f.current_etag
             # Change the content of the file to change the MD5 reported
-            k.set_contents_from_string("%s\n%s" % (self.sub, self.add))
-            self.assertTrue(f.needs_refresh())
+            k.set_contents_from_string(self.add)
+            gets = []
+            with record_gets(gets):
+                self.assertTrue(f.needs_refresh())
+                f.load()
+            # Checking for changes fetched the new contents for the load
+            self.assertEqual(gets, [(self.key_name, {'If-None-Match': etag})])
+            self.assertEqual(f.chunks, ChunkList(add_chunks=simple_adds))
+            self.assertEqual(f.current_etag, k.etag)
 
     def test_no_data(self):
         with mock_s3():
@@ -169,11 +369,36 @@ class TestS3DirectorySource(ShavarTestCase):
                           'rb') as f:
                     k.set_contents_from_file(f)
 
+            # moto's mocked sockets aren't thread safe, fetch serially
             d = S3DirectorySource("s3+dir://{0}/{1}".format(self.bucket_name,
-                                                            self.list_name), 1)
+                                                            self.list_name), 1,
+                                  settings={'load_workers': '1'})
             d.load()
             self.assertEqual(d.chunks, DELTA_RESULT)
 
+            # Reloads only fetch the chunk files that are new or changed
+            before = chunks_by_number(d.chunks)
+            k = Key(b)
+            k.name = posixpath.join(self.list_name, '7')
+            k.set_contents_from_string(
+                b'a:7:32:32\n' + sha256(b'https://example.com/').digest())
+            k = Key(b)
+            k.name = posixpath.join(self.list_name, 'index.json')
+            index = json.loads(k.get_contents_as_string())
+            index['chunks']['7'] = {'path': '7'}
+            k.set_contents_from_string(json.dumps(index))
+            gets = []
+            with record_gets(gets):
+                d.load()
+            self.assertEqual([name for name, _ in gets],
+                             [posixpath.join(self.list_name, name)
+                              for name in ('index.json', '7')])
+            after = chunks_by_number(d.chunks)
+            for number in range(1, 7):
+                self.assertIs(after[number], before[number])
+            self.assertEqual(after[7].hashes,
+                             set([sha256(b'https://example.com/').digest()]))
+
     def test_no_data(self):
         source_url = "s3+dir://tarantula/bigandblue/"
         index_url = posixpath.join(source_url, 'index.json')
@@ -0,0 +1,203 @@
+import hashlib
+import pickle
+import random
+
+from shavar.types import (
+    Chunk,
+    ChunkList,
+    ChunkRanges,
+    DownloadsListInfo,
+    LimitExceededError,
+    PrefixIndex)
+from shavar.tests.base import hashes, ShavarTestCase
+
+
+class PrefixIndexTest(ShavarTestCase):
+
+    def setUp(self):
+        super(PrefixIndexTest, self).setUp()
+        self.chunks = ChunkList(
+            add_chunks=[Chunk(number=1, hashes=[hashes['moz'],
+                                                hashes['goog']]),
+                        Chunk(number=2, hashes=[hashes['goog']]),
+                        Chunk(number=3, hashes=[hashes['hub']])],
+            sub_chunks=[Chunk(chunk_type='s', number=4,
+                              hashes=[hashes['py']])])
+
+    def test_lookup(self):
+        adds = self.chunks.adds
+        index = PrefixIndex(adds.values())
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.lookup(hashes['goog'][:4], adds), [1, 2])
+        self.assertEqual(index.lookup(hashes['goog'], adds), [1, 2])
+        self.assertEqual(index.lookup(hashes['hub'][:4], adds), [3])
+        self.assertEqual(index.lookup(hashes['moz'][:1], adds), [1])
+        self.assertEqual(index.lookup(hashes['goog'] + b'\x00', adds), [])
+        # Sub chunks are never part of the index
+        self.assertEqual(index.lookup(hashes['py'][:4], adds), [])
+        # Only the keys are indexed, not whole hashes
+        (width, buf, offset, numbers), = index.tables
+        self.assertEqual(width, PrefixIndex.KEY_SIZE)
+        self.assertEqual(len(buf), width * len(numbers))
+
+    def test_lookup_checks_past_key(self):
+        # Same key as goog, different hash
+        twin = hashes['goog'][:4] + bytes(28)
+        adds = dict(self.chunks.adds)
+        adds[5] = Chunk(number=5, hashes=[twin])
+        index = PrefixIndex(adds.values())
+        self.assertEqual(index.lookup(hashes['goog'][:4], adds), [1, 2, 5])
+        self.assertEqual(index.lookup(hashes['goog'], adds), [1, 2])
+        self.assertEqual(index.lookup(twin, adds), [5])
+        self.assertEqual(index.lookup(twin[:5], adds), [5])
+
+    def test_find_prefix_matches_scan(self):
+        for prefix in [h[:n] for h in hashes.values() for n in (1, 4, 32)]:
+            expected = [c for c in self.chunks.adds.values()
+                        if any(h.startswith(prefix) for h in c.hashes)]
+            self.assertEqual(self.chunks.find_prefix(prefix), expected)
+        missing = hashlib.sha256(b'https://example.com/').digest()
+        self.assertEqual(self.chunks.find_prefix(missing[:4]), [])
+
+    def test_insert_chunk_resets_index(self):
+        self.assertEqual(self.chunks.find_prefix(hashes['py'][:4]), [])
+        new = Chunk(number=5, hashes=[hashes['py']])
+        self.chunks.insert_chunk(new)
+        self.assertEqual(self.chunks.find_prefix(hashes['py'][:4]), [new])
+
+    def test_updated(self):
+        replaced = Chunk(number=2, hashes=[hashes['py']])
+        added = Chunk(number=5, hashes=[hashes['goog']])
+        big = ChunkList(add_chunks=[Chunk(number=n, hashes=[
+            hashlib.sha256(b'%d' % n).digest()]) for n in range(10, 30)])
+        index = PrefixIndex(list(self.chunks.adds.values())
+                            + list(big.adds.values()))
+        # Small enough changes are stacked on top of the original index
+        layered = index.updated([replaced, added],
+                                [self.chunks.adds[2]])
+        adds = dict(big.adds)
+        adds.update({1: self.chunks.adds[1], 2: replaced,
+                     3: self.chunks.adds[3], 5: added})
+        self.assertTrue(layered.layered)
+        self.assertEqual(len(layered), len(index) + 1)
+        self.assertEqual(layered.lookup(hashes['goog'][:4], adds), [1, 5])
+        self.assertEqual(layered.lookup(hashes['goog'], adds), [1, 5])
+        self.assertEqual(layered.lookup(hashes['py'][:4], adds), [2])
+        self.assertEqual(layered.lookup(hashes['hub'][:4], adds), [3])
+        # Removing a chunk stacked in an upper layer hides it too
+        again = layered.updated([], [added])
+        del adds[5]
+        self.assertEqual(again.lookup(hashes['goog'], adds), [1])
+        # Rebuilding from scratch is due once the layers grow too big or
+        # too deep
+        self.assertIsNone(index.updated(list(big.adds.values())))
+        deep = index
+        for n in range(PrefixIndex.max_depth):
+            deep = deep.updated([Chunk(number=100 + n, hashes=[
+                hashlib.sha256(b'x%d' % n).digest()])])
+            self.assertIsNotNone(deep)
+        self.assertIsNone(deep.updated([]))
+
+    def test_reindex_from(self):
+        self.chunks.index_prefixes()
+        reloaded = ChunkList(
+            add_chunks=[self.chunks.adds[1], self.chunks.adds[3],
+                        Chunk(number=2, hashes=[hashes['py']])])
+        reloaded.reindex_from(self.chunks)
+        self.assertTrue(reloaded.prefix_index.layered)
+        self.assertEqual(reloaded.find_prefix(hashes['goog'][:4]),
+                         [reloaded.adds[1]])
+        self.assertEqual(reloaded.find_prefix(hashes['py'][:4]),
+                         [reloaded.adds[2]])
+        # Nothing in common, the index is rebuilt from scratch
+        fresh = ChunkList(add_chunks=[Chunk(number=1,
+                                            hashes=[hashes['hub']])])
+        fresh.reindex_from(self.chunks)
+        self.assertFalse(fresh.prefix_index.layered)
+        self.assertEqual(fresh.find_prefix(hashes['hub'][:4]),
+                         [fresh.adds[1]])
+
+
+class ChunkTest(ShavarTestCase):
+
+    def test_packed_hashes(self):
+        c = Chunk(number=1, hashes=[hashes['moz'], hashes['goog'],
+                                    hashes['moz']])
+        self.assertEqual(len(c), 2)
+        self.assertEqual(c.hashes, set([hashes['moz'], hashes['goog']]))
+        self.assertEqual(c.data, b''.join(sorted([hashes['moz'],
+                                                  hashes['goog']])))
+        self.assertEqual(c, Chunk(number=1, hashes=set([hashes['goog'],
+                                                        hashes['moz']])))
+        self.assertNotEqual(c, Chunk(number=1, hashes=[hashes['moz']]))
+        self.assertFalse(hasattr(c, '__dict__'))
+        self.assertRaises(ValueError, Chunk, number=2,
+                          hashes=[hashes['moz'], hashes['goog'][:4]])
+
+    def test_prefix_lookups(self):
+        c = Chunk(number=1, hashes=[hashes['moz'], hashes['goog']])
+        self.assertTrue(c.find_prefix(hashes['moz'][:4]))
+        self.assertTrue(c.find_prefix(hashes['goog']))
+        self.assertFalse(c.find_prefix(hashes['hub'][:4]))
+        self.assertFalse(c.find_prefix(hashes['goog'] + b'\x00'))
+        self.assertEqual(c.get_hashes(hashes['goog'][:4]), [hashes['goog']])
+        self.assertEqual(c.get_hashes(hashes['hub'][:4]), [])
+        self.assertEqual(c.get_hashes(b''), sorted(c.hashes))
+
+    def test_pickle(self):
+        buf = b'\xff' * 8 + b''.join(sorted([hashes['moz'], hashes['goog']]))
+        c = Chunk.from_buffer('s', 3, buf, 8, 64, 32)
+        restored = pickle.loads(pickle.dumps(c))
+        self.assertEqual(restored, c)
+        self.assertEqual(restored.data, c.data)
+        self.assertTrue(restored.find_prefix(hashes['moz'][:4]))
+
+
+class ChunkRangesTest(ShavarTestCase):
+
+    def test_add_merges(self):
+        r = ChunkRanges()
+        r.add(10, 20)
+        r.add(1)
+        r.add(30, 40)
+        self.assertEqual(r.ranges(), [(1, 1), (10, 20), (30, 40)])
+        # Adjacent and overlapping ranges are merged
+        r.add(21, 29)
+        r.add(2, 15)
+        self.assertEqual(r.ranges(), [(1, 40)])
+        self.assertEqual(len(r), 40)
+        self.assertEqual(list(r), list(range(1, 41)))
+        self.assertIn(40, r)
+        self.assertNotIn(41, r)
+        self.assertEqual(ChunkRanges([5, 3, 4, 9, 5]).ranges(),
+                         [(3, 5), (9, 9)])
+        self.assertRaises(ValueError, r.add, 5, 4)
+
+    def test_difference_matches_sets(self):
+        rand = random.Random(42)
+        for _ in range(200):
+            a = set(rand.sample(range(60), rand.randint(0, 40)))
+            b = set(rand.sample(range(60), rand.randint(0, 40)))
+            diff = ChunkRanges(a).difference(ChunkRanges(b))
+            self.assertEqual(list(diff), sorted(a - b))
+            self.assertEqual(diff, ChunkRanges(a - b))
+
+    def test_digest(self):
+        self.assertEqual(ChunkRanges([1, 2, 3, 7]).digest(),
+                         ChunkRanges.from_ranges([(7, 7), (1, 3)]).digest())
+        self.assertNotEqual(ChunkRanges([1, 2, 3]).digest(),
+                            ChunkRanges([1, 3]).digest())
+        # Clients can claim chunk numbers too big for 64 bits
+        huge = ChunkRanges([2 ** 64, 2 ** 70])
+        self.assertEqual(huge.digest(),
+                         ChunkRanges([2 ** 70, 2 ** 64]).digest())
+        self.assertNotEqual(huge.digest(), ChunkRanges([2 ** 64]).digest())
+
+    def test_claim_limit(self):
+        info = DownloadsListInfo('moz-abp-shavar', limit=100)
+        info.add_range_claim('a', 1, 100)
+        info.add_range_claim('a', 50, 60)
+        self.assertEqual(len(info.adds), 100)
+        self.assertRaises(LimitExceededError, info.add_claim, 'a', 101)
+        self.assertRaises(LimitExceededError, info.add_range_claim, 's',
+                          1, 10 ** 9)
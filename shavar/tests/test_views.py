@@ -115,6 +115,18 @@ class DeltaViewTests(ShavarTestCase):
         response = downloads_view(request)
         self.assertEqual(response.body, expected.encode())
 
+    def test_1_downloads_view_huge_claim(self):
+        from shavar.views import downloads_view
+        # Chunk numbers too big for 64 bits are claims of chunks like any
+        # other, here of chunks that don't exist
+        request = dummy("mozpub-track-digest256;a:18446744073709551616\n",
+                        path='/downloads')
+        response = downloads_view(request)
+        self.assertEqual(response.status_code, 200)
+        unclaimed = downloads_view(dummy("mozpub-track-digest256;\n",
+                                         path='/downloads'))
+        self.assertEqual(response.body, unclaimed.body)
+
     def test_2_gethash_view(self):
         from shavar.views import gethash_view
         prefixes = (b"\xd0\xe1\x96\xa0"
@@ -1,6 +1,42 @@
+from array import array
+from bisect import bisect_left, bisect_right
+import hashlib
+import itertools
+
+
+def bisect_records(buf, count, stride, key, offset=0):
+    """
+    Binary search over ``count`` sorted, fixed width records of ``stride``
+    bytes packed into ``buf`` starting at ``offset``.  Only the first
+    len(key) bytes of each record are compared so a key shorter than the
+    record width finds the first record starting with it.  Returns the index
+    of the first record that sorts at or after ``key``.
+    """
+    key_len = len(key)
+    lo, hi = 0, count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start = offset + mid * stride
+        if buf[start:start + key_len] < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
 
 class Chunk(object):
-    "Object for ease of interacting with parsed chunk data"
+    """
+    Object for ease of interacting with parsed chunk data
+
+    The hashes are kept sorted and de-duplicated in a single contiguous
+    buffer rather than as a set of individual bytes objects, which keeps the
+    per-hash overhead down to the size of the hash itself.  The buffer may
+    be shared, e.g. a memory mapped chunk file, in which case the chunk only
+    references its own region of it.
+    """
+
+    __slots__ = ('type', 'number', 'hash_len', '_data', '_offset', '_size',
+                 '_stride')
 
     def __init__(self, chunk_type='a', number=None, hashes=[], hash_size=32):
         if chunk_type not in ('a', 's'):
@@ -11,9 +47,53 @@ class Chunk(object):
 
         self.type = chunk_type
         self.number = number
-        self.hashes = set(hashes)
         self.hash_len = hash_size
-        self._prefix_cache = {}
+
+        hashes = sorted(set(hashes))
+        stride = len(hashes[0]) if hashes else hash_size
+        for hash_ in hashes:
+            if len(hash_) != stride:
+                raise ValueError('Hashes of differing lengths in chunk %d'
+                                 % number)
+        self._data = b''.join(hashes)
+        self._offset = 0
+        self._size = len(self._data)
+        self._stride = stride
+
+    @classmethod
+    def from_buffer(cls, chunk_type, number, buf, offset, size, stride,
+                    hash_size=32, presorted=False):
+        """
+        Creates a chunk from the size bytes of packed, stride wide hashes
+        found at offset in buf, which can be anything that slices to bytes
+        (bytes, mmap).  If the hashes are already sorted and unique the chunk
+        references buf directly instead of copying them.  With presorted the
+        caller vouches for that and the hashes aren't checked.
+        """
+        if not size:
+            return cls(chunk_type, number, hash_size=hash_size)
+        if not presorted:
+            previous = None
+            for pos in range(offset, offset + size, stride):
+                hash_ = buf[pos:pos + stride]
+                if previous is not None and hash_ <= previous:
+                    return cls(chunk_type, number, hash_size=hash_size,
+                               hashes=[buf[p:p + stride] for p in
+                                       range(offset, offset + size, stride)])
+                previous = hash_
+        chunk = cls(chunk_type, number, hash_size=hash_size)
+        chunk._data = buf
+        chunk._offset = offset
+        chunk._size = size
+        chunk._stride = stride
+        return chunk
+
+    def __reduce__(self):
+        # Only the chunk's own region of a shared buffer travels, e.g. back
+        # from a parsing worker process
+        return (_restore_chunk, (self.__class__, self.type, self.number,
+                                 bytes(self.data), self._stride,
+                                 self.hash_len))
 
     def __repr__(self):
         return "%s(chunk_type='%s', number=%d, hashes=%s, hash_size=%d)" \
@@ -24,34 +104,217 @@ class Chunk(object):
         if (type(self) != type(other)
                 or self.type != other.type
                 or self.number != other.number
-                or self.hashes != other.hashes
+                or self._stride != other._stride
+                or self.data != other.data
                 or self.hash_len != other.hash_len):
             return False
         return True
 
+    def __len__(self):
+        return self._size // self._stride
+
+    @property
+    def data(self):
+        "All of the hashes concatenated together in sorted order"
+        if self._offset == 0 and self._size == len(self._data):
+            return self._data
+        return self._data[self._offset:self._offset + self._size]
+
+    @property
+    def hashes(self):
+        stride = self._stride
+        data = self._data
+        return frozenset(data[pos:pos + stride]
+                         for pos in range(self._offset,
+                                          self._offset + self._size, stride))
+
+    def _first_match(self, prefix):
+        count = len(self)
+        i = bisect_records(self._data, count, self._stride, prefix,
+                           self._offset)
+        if i < count:
+            start = self._offset + i * self._stride
+            if self._data[start:start + len(prefix)] == prefix:
+                return i
+        return None
+
     def find_prefix(self, prefix):
-        if prefix in self._prefix_cache:
-            return True
-        for hash_ in self.hashes:
-            if hash_.startswith(prefix):
-                self._prefix_cache[prefix] = True
-                return True
-        return False
+        if len(prefix) > self._stride:
+            return False
+        return self._first_match(prefix) is not None
 
     def get_hashes(self, prefix):
         hashes = []
-        for hash_ in self.hashes:
-            if hash_.startswith(prefix):
-                hashes.append(hash_)
+        if len(prefix) > self._stride:
+            return hashes
+        i = self._first_match(prefix)
+        if i is None:
+            return hashes
+        stride = self._stride
+        data = self._data
+        for pos in range(self._offset + i * stride,
+                         self._offset + self._size, stride):
+            hash_ = data[pos:pos + stride]
+            if not hash_.startswith(prefix):
+                break
+            hashes.append(hash_)
         return hashes
 
 
+class PrefixIndex(object):
+    """
+    Sorted index of the hashes in a set of chunks mapped back to the number
+    of the chunk that contains them.
+
+    Only the first KEY_SIZE bytes of every hash are indexed, packed into one
+    contiguous buffer per key width along with the number of the chunk of
+    each of them, so that the index stays a fraction of the size of the
+    hashes themselves.  A lookup is a binary search for the key of the
+    prefix and longer prefixes are confirmed in the sorted hashes of the
+    chunks the key points to, so it costs O(log n) regardless of the number
+    of chunks or hashes in the list.
+
+    An index can also be stacked on top of an older one by updated() so
+    that only the chunks that changed need indexing.
+    """
+
+    # Bytes of every hash indexed
+    KEY_SIZE = 4
+
+    # Most layers updated() stacks up before asking for a rebuild
+    max_depth = 8
+
+    def __init__(self, chunks=()):
+        records = {}
+        for chunk in chunks:
+            stride = chunk._stride
+            width = min(stride, self.KEY_SIZE)
+            data = chunk._data
+            pairs = records.setdefault(width, [])
+            for pos in range(chunk._offset, chunk._offset + chunk._size,
+                             stride):
+                pairs.append((data[pos:pos + width], chunk.number))
+        self._tables = []
+        for width, pairs in sorted(records.items()):
+            pairs.sort()
+            self._tables.append((width,
+                                 b''.join(k for k, _ in pairs), 0,
+                                 array('I', (n for _, n in pairs))))
+        self._size = sum(len(numbers) for _, _, _, numbers in self._tables)
+        # The older index this one is stacked on, the numbers of its chunks
+        # that are gone or replaced, and the entries stacked above it
+        self._base = None
+        self._removed = frozenset()
+        self._depth = 0
+        self._stacked = 0
+
+    @classmethod
+    def from_tables(cls, tables):
+        """
+        Wraps already built tables, e.g. read out of a snapshot, without
+        rebuilding them.  See tables.
+        """
+        index = cls()
+        index._tables = list(tables)
+        index._size = sum(len(numbers) for _, _, _, numbers in index._tables)
+        return index
+
+    def updated(self, added=(), removed=()):
+        """
+        Returns an index of the same chunks less the removed ones plus the
+        added ones.  Only the added chunks are indexed, in a layer stacked
+        on top of this index with the removed (or replaced) chunks filtered
+        out of its lookups.  Returns None once the stacked layers are big
+        enough that rebuilding the index from scratch is due.
+        """
+        added_size = sum(len(chunk) for chunk in added)
+        size = self._size + added_size - sum(len(chunk) for chunk in removed)
+        stacked = self._stacked + added_size
+        if self._depth >= self.max_depth or stacked * 4 > size:
+            return None
+        index = PrefixIndex(added)
+        index._base = self
+        index._removed = frozenset(chunk.number for chunk in removed)
+        index._depth = self._depth + 1
+        index._stacked = stacked
+        index._size = size
+        return index
+
+    @property
+    def layered(self):
+        "Whether this index is stacked on top of an older one"
+        return self._base is not None
+
+    @property
+    def tables(self):
+        """
+        One (width, buffer, offset, chunk numbers) tuple per key width
+        holding the sorted keys, the first width bytes of the hashes, packed
+        into buffer from offset on and the number of the chunk each of them
+        belongs to.  Layered indexes only return the tables of their top
+        layer.
+        """
+        return list(self._tables)
+
+    def __len__(self):
+        return self._size
+
+    def _keyed(self, prefix):
+        # Yields the numbers of the chunks with a key matching prefix and
+        # whether the rest of prefix still needs to be checked
+        if self._base is not None:
+            removed = self._removed
+            for number, partial in self._base._keyed(prefix):
+                if number not in removed:
+                    yield number, partial
+        prefix_len = len(prefix)
+        for width, buf, offset, numbers in self._tables:
+            key = prefix[:width]
+            key_len = len(key)
+            count = len(numbers)
+            i = bisect_records(buf, count, width, key, offset)
+            while i < count:
+                start = offset + i * width
+                if buf[start:start + key_len] != key:
+                    break
+                yield numbers[i], prefix_len > width
+                i += 1
+
+    def lookup(self, prefix, chunks):
+        """
+        Returns the sorted numbers of the chunks with a hash matching
+        prefix.  chunks maps the numbers of the chunks indexed to the chunks
+        themselves, e.g. ChunkList.adds, for the prefixes longer than the
+        keys to be checked against their hashes.
+        """
+        found = set()
+        checked = set()
+        for number, partial in self._keyed(prefix):
+            if number in found:
+                continue
+            if partial:
+                if number in checked:
+                    continue
+                checked.add(number)
+                if not chunks[number].find_prefix(prefix):
+                    continue
+            found.add(number)
+        return sorted(found)
+
+
+def _restore_chunk(cls, chunk_type, number, data, stride, hash_size):
+    # The data is already sorted and unique, no need to check it again
+    return cls.from_buffer(chunk_type, number, data, 0, len(data), stride,
+                           hash_size=hash_size, presorted=True)
+
+
 class ChunkList(object):
     "Simplify interaction with server side lists of chunks"
 
     def __init__(self, add_chunks=[], sub_chunks=[]):
         self.adds = {}
         self.subs = {}
+        self._prefix_index = None
         for chunk in add_chunks:
             self.adds[chunk.number] = chunk
         for chunk in sub_chunks:
@@ -73,12 +336,51 @@ class ChunkList(object):
     def __len__(self):
         return len(self.adds) + len(self.subs)
 
+    @property
+    def indexed(self):
+        "Whether the prefix index used by find_prefix() is built"
+        return self._prefix_index is not None
+
+    def index_prefixes(self, index=None):
+        """
+        (Re)builds the prefix index used by find_prefix(), or installs index
+        if one was already built for these chunks
+        """
+        if index is None:
+            index = PrefixIndex(self.adds.values())
+        self._prefix_index = index
+        return index
+
+    def reindex_from(self, previous):
+        """
+        Builds the prefix index from the one of previous, the ChunkList this
+        one replaces, indexing only the chunks that aren't shared with it.
+        """
+        index = previous._prefix_index
+        if index is None:
+            return self.index_prefixes()
+        added = [chunk for number, chunk in self.adds.items()
+                 if previous.adds.get(number) is not chunk]
+        removed = [chunk for number, chunk in previous.adds.items()
+                   if self.adds.get(number) is not chunk]
+        if added or removed:
+            index = index.updated(added, removed)
+        if index is None:
+            return self.index_prefixes()
+        return self.index_prefixes(index)
+
+    @property
+    def prefix_index(self):
+        # Built lazily but normally primed by the sources right after a load
+        # so no request has to pay for it.
+        index = self._prefix_index
+        if index is None:
+            index = self.index_prefixes()
+        return index
+
     def find_prefix(self, prefix):
-        list_o_chunks = []
-        for number, chunk in self.adds.items():
-            if chunk.find_prefix(prefix):
-                list_o_chunks.append(chunk)
-        return list_o_chunks
+        return [self.adds[number]
+                for number in self.prefix_index.lookup(prefix, self.adds)]
 
     def insert_chunk(self, chunk):
         chunk_list = self.adds
@@ -87,6 +389,7 @@ class ChunkList(object):
         if chunk.number in chunk_list:
             raise ValueError("Duplicate chunk number: %d" % chunk.number)
         chunk_list[chunk.number] = chunk
+        self._prefix_index = None
 
 
 class Downloads(list):
@@ -106,6 +409,167 @@ class Downloads(list):
         return True
 
 
+class ChunkRanges(object):
+    """
+    Set of chunk numbers stored as sorted, non-overlapping, inclusive
+    (low, high) ranges.
+
+    Adding a range and computing differences cost time proportional to the
+    number of ranges rather than the number of chunk numbers they cover,
+    which is what we want for clients claiming "a:1-9000".  Iterating yields
+    the individual chunk numbers in ascending order.
+    """
+
+    __slots__ = ('_lows', '_highs', '_count')
+
+    def __init__(self, numbers=()):
+        self._lows = []
+        self._highs = []
+        self._count = 0
+        if numbers:
+            self.update((), numbers)
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        "Builds a ChunkRanges from an iterable of inclusive (low, high) pairs"
+        chunk_ranges = cls()
+        for low, high in ranges:
+            chunk_ranges.add(low, high)
+        return chunk_ranges
+
+    def add(self, low, high=None):
+        "Adds the inclusive range low-high, or just low if high isn't given"
+        if high is None:
+            high = low
+        if low > high:
+            raise ValueError("Invalid range: %d-%d" % (low, high))
+        if not self._lows:
+            self._lows = [low]
+            self._highs = [high]
+            self._count = high - low + 1
+            return
+        # Every existing range overlapping or adjacent to the new one is
+        # merged into it
+        i = bisect_left(self._highs, low - 1)
+        j = bisect_right(self._lows, high + 1)
+        if i < j:
+            low = min(low, self._lows[i])
+            high = max(high, self._highs[j - 1])
+            for k in range(i, j):
+                self._count -= self._highs[k] - self._lows[k] + 1
+        self._lows[i:j] = [low]
+        self._highs[i:j] = [high]
+        self._count += high - low + 1
+
+    def update(self, ranges, numbers=()):
+        """
+        Adds every inclusive (low, high) pair in ranges and every chunk
+        number in numbers.  Cheaper than calling add() for each of them as
+        everything is sorted and merged in one go.
+        """
+        numbers = sorted(numbers)
+        if numbers:
+            # Collapse the runs of consecutive numbers first
+            lows = [numbers[0]]
+            highs = []
+            high = numbers[0]
+            for number in numbers:
+                if number > high + 1:
+                    highs.append(high)
+                    lows.append(number)
+                high = number
+            highs.append(high)
+            if not ranges and not self._lows:
+                self._lows = lows
+                self._highs = highs
+                self._count = sum(highs) - sum(lows) + len(lows)
+                return
+            ranges = itertools.chain(ranges, zip(lows, highs))
+        if self._lows:
+            ranges = itertools.chain(self.ranges(), ranges)
+
+        lows = []
+        highs = []
+        cur_low = cur_high = None
+        for low, high in sorted(ranges):
+            if low > high:
+                raise ValueError("Invalid range: %d-%d" % (low, high))
+            if cur_high is not None and low <= cur_high + 1:
+                if high > cur_high:
+                    cur_high = high
+            else:
+                if cur_high is not None:
+                    lows.append(cur_low)
+                    highs.append(cur_high)
+                cur_low, cur_high = low, high
+        if cur_high is not None:
+            lows.append(cur_low)
+            highs.append(cur_high)
+        self._lows = lows
+        self._highs = highs
+        self._count = sum(highs) - sum(lows) + len(lows)
+
+    def ranges(self):
+        return list(zip(self._lows, self._highs))
+
+    def digest(self):
+        "Returns a digest that is the same for any two equal ChunkRanges"
+        # Clients can claim chunk numbers of any size, which no fixed width
+        # encoding fits
+        return hashlib.sha1(repr((self._lows, self._highs)).encode()).digest()
+
+    def difference(self, other):
+        "Returns a new ChunkRanges with the numbers not found in other"
+        result = ChunkRanges()
+        o_ranges = other.ranges()
+        j = 0
+        for low, high in self.ranges():
+            # Skip the ranges of other entirely below this one
+            while j < len(o_ranges) and o_ranges[j][1] < low:
+                j += 1
+            k = j
+            while k < len(o_ranges) and o_ranges[k][0] <= high:
+                o_low, o_high = o_ranges[k]
+                if o_low > low:
+                    result._append(low, o_low - 1)
+                low = o_high + 1
+                if low > high:
+                    break
+                k += 1
+            if low <= high:
+                result._append(low, high)
+        return result
+
+    def _append(self, low, high):
+        # Only valid for ranges above and not adjacent to the last one
+        self._lows.append(low)
+        self._highs.append(high)
+        self._count += high - low + 1
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for low, high in zip(self._lows, self._highs):
+            for number in range(low, high + 1):
+                yield number
+
+    def __contains__(self, number):
+        i = bisect_right(self._lows, number) - 1
+        return i >= 0 and number <= self._highs[i]
+
+    def __eq__(self, other):
+        if (type(self) != type(other)
+                or self._lows != other._lows
+                or self._highs != other._highs):
+            return False
+        return True
+
+    def __repr__(self):
+        return "%s.from_ranges(%s)" % (self.__class__.__name__,
+                                       self.ranges())
+
+
 class LimitExceededError(Exception):
     """
     Raised when a /downloads request would exceed the limit of the number
@@ -120,34 +584,38 @@ class DownloadsListInfo(object):
         self.name = list_name
         self.wants_mac = wants_mac
         self.limit = limit
-        if len(adds) > self.limit:
-            raise LimitExceededError("Number of add chunks(%d) exceeds limit:"
-                                     " %d" % (len(adds), self.limit))
-        self.adds = set(adds)
-        if len(subs) > self.limit:
-            raise LimitExceededError("Number of sub chunks(%d) exceeds limit:"
-                                     " %d" % (len(subs), self.limit))
-        self.subs = set(subs)
+        self.adds = ChunkRanges(adds) if adds else ChunkRanges()
+        self.subs = ChunkRanges(subs) if subs else ChunkRanges()
+        if adds or subs:
+            self._check_limit('add', self.adds)
+            self._check_limit('sub', self.subs)
+
+    def _check_limit(self, typ, claims):
+        if len(claims) > self.limit:
+            raise LimitExceededError("Number of %s chunks(%d) exceeds limit:"
+                                     " %d" % (typ, len(claims), self.limit))
 
     def add_claim(self, typ, chunk_num):
-        # We do bounds checking after the fact because sets only store unique
-        # items and don't duplicate
+        self.add_range_claim(typ, chunk_num, chunk_num)
+
+    def add_range_claim(self, typ, low, high):
         if typ == 's':
-            self.subs.add(chunk_num)
-            if len(self.subs) > self.limit:
-                raise LimitExceededError("Number of sub chunks(%d) exceeds"
-                                         " limit: %d" % (len(self.subs),
-                                                         self.limit))
+            self.subs.add(low, high)
+            self._check_limit('sub', self.subs)
         else:
-            self.adds.add(chunk_num)
-            if len(self.adds) > self.limit:
-                raise LimitExceededError("Number of add chunks(%d) exceeds"
-                                         " limit: %d" % (len(self.adds),
-                                                         self.limit))
+            self.adds.add(low, high)
+            self._check_limit('add', self.adds)
 
-    def add_range_claim(self, typ, low, high):
-        for i in range(low, high + 1):
-            self.add_claim(typ, i)
+    def add_claims(self, typ, ranges, numbers=()):
+        "Adds many (low, high) range and single chunk number claims at once"
+        # The ranges only store unique chunk numbers so bounds checking after
+        # the fact gives the real count
+        if typ == 's':
+            self.subs.update(ranges, numbers)
+            self._check_limit('sub', self.subs)
+        else:
+            self.adds.update(ranges, numbers)
+            self._check_limit('add', self.adds)
 
     def __eq__(self, other):
         if (type(self) != type(other)
@@ -14,7 +14,7 @@ from pyramid.httpexceptions import (
 
 from sentry_sdk import capture_exception
 from shavar.exceptions import ConfigurationError, ParseError
-from shavar.lists import get_list, lookup_prefixes
+from shavar.lists import get_list, get_serving_state, lookup_prefixes
 from shavar.parse import parse_downloads, parse_gethash
 
 
@@ -75,7 +75,7 @@ def _setting(request, section, key, default=None):
 
 
 def list_view(request):
-    lists = sorted(request.registry['shavar.serving'].keys())
+    lists = get_serving_state(request).sorted_names
 
     body = '\n'.join(lists) + '\n'
     return HTTPOk(content_type='text/plain', text=body)
@@ -97,6 +97,8 @@ def downloads_view(request):
     delay = backoff_delay or default_interval or 30 * 60
 
     resp_payload = {'interval': delay, 'lists': {}}
+    # One consistent set of lists for the whole request
+    state = get_serving_state(request)
 
     try:
         parsed = parse_downloads(request)
@@ -106,9 +108,7 @@ def downloads_view(request):
 
     for list_info in parsed:
         # Do we even serve that list?
-        if list_info.name not in _setting(
-            request, 'shavar', 'list_names_served', tuple()
-        ):
+        if list_info.name not in state.list_names_set:
             logger.warn('Unknown list "%s" reported; ignoring'
                         % list_info.name)
             annotate_request(request, "shavar.downloads.unknown.list", 1)
@@ -186,7 +186,7 @@ def format_downloads(request, resp_payload):
         # TODO  Should we prioritize subs over adds?
         for chunk in chain(ldata['adds'], ldata['subs']):
             if be_broken:
-                d = b''.join(chunk.hashes)
+                d = chunk.data
                 data = "{type}:{chunk_num}:{hash_len}:{payload_len}\n".format(
                     type=chunk.type,
                     chunk_num=chunk.number,